@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Hextile decoding micro benchmark.
+
+Generated MFD pages (rfbserver.MFDScreen) are Hextile encoded by
+rfbserver.py and fed to RFBClient in network sized chunks. Prints decode
+time and the number of Python function calls per 16x16 tile.
+
+usage: python3 benchmarks/hextile.py [frames]
+"""
+
+import sys
+
+from zrle_vs_raw import WIDTH, HEIGHT, mfd_frames, server_init, decode, CountingClient, NullTransport, CHUNK
+
+import rfbserver
+
+
+class CallbackClient(CountingClient):
+    def __init__(self):
+        CountingClient.__init__(self)
+        self.callbacks = 0
+
+    def commitUpdate(self, rectangles=None):
+        self.callbacks += 1
+
+    def fillRectangle(self, x, y, width, height, color):
+        self.callbacks += 1
+
+    def updateRectangle(self, x, y, width, height, data):
+        self.callbacks += 1
+
+
+def count_calls(stream):
+    """python function calls of the decoder (without the callbacks)
+       and builtin calls needed to decode the stream"""
+    client = CallbackClient()
+    client.connection_made(NullTransport())
+    calls = {'call': 0, 'c_call': 0}
+
+    def profiler(frame, event, arg):
+        if event in calls:
+            calls[event] += 1
+
+    view = memoryview(stream)
+    sys.setprofile(profiler)
+    try:
+        for pos in range(0, len(stream), CHUNK):
+            client.data_received(view[pos:pos + CHUNK])
+    finally:
+        sys.setprofile(None)
+    return calls['call'] - client.callbacks, calls['c_call']
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    tiles = count * ((WIDTH + 15) // 16) * ((HEIGHT + 15) // 16)
+    encoder = rfbserver.HextileEncoder()
+    updates = b''.join(rfbserver.encode_frame(encoder, frame, WIDTH, HEIGHT)
+                       for frame in mfd_frames(count))
+    stream = server_init() + updates
+    elapsed, decoded = decode(stream)
+    assert decoded == count
+    calls, builtin_calls = count_calls(stream)
+    print("Hextile %d bytes, decode %.2f ms per frame, %.1f us per tile" %
+          (len(updates), elapsed * 1000 / count, elapsed * 1e6 / tiles))
+    print("calls per tile: %.2f python (without callbacks), %.2f builtin" %
+          (calls / tiles, builtin_calls / tiles))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Decode throughput of several MFDs, in one process and with one decoder
+process per MFD writing into shared memory framebuffers.
+
+Every MFD decodes the same ZRLE session (see zrle_vs_raw.py) into a
+ShadowFramebuffer. With processes, the pixels are in a SharedFramebuffer
+and each frame is published to the dirty rectangle ring, as in the
+client with Option.processes.
+
+usage: python3 benchmarks/mfd_processes.py [frames] [max MFDs]
+"""
+
+import multiprocessing
+import multiprocessing.resource_tracker
+import os
+import sys
+import time
+
+from zrle_vs_raw import WIDTH, HEIGHT, mfd_frames, server_init, NullTransport, CHUNK
+
+import rfb
+import rfbserver
+import shadowfb
+
+
+class ShadowClient(rfb.RFBClient):
+    def __init__(self, shadow):
+        rfb.RFBClient.__init__(self, None)
+        self.shadow = shadow
+        self.updates = 0
+
+    def updateRectangle(self, x, y, width, height, data):
+        self.shadow.update(x, y, width, height, data)
+
+    def fillRectangle(self, x, y, width, height, color):
+        self.shadow.fill(color, [(x, y, width, height)])
+
+    def fillRectangles(self, color, rectangles):
+        self.shadow.fill(color, rectangles)
+
+    def commitUpdate(self, rectangles=None):
+        self.updates += 1
+        if isinstance(self.shadow, shadowfb.SharedFramebuffer):
+            self.shadow.publish()
+        else:
+            self.shadow.takeDirty()
+
+
+def decode(stream, shadow):
+    client = ShadowClient(shadow)
+    client.connection_made(NullTransport())
+    view = memoryview(stream)
+    for pos in range(0, len(stream), CHUNK):
+        client.data_received(view[pos:pos + CHUNK])
+    return client.updates
+
+
+def worker(stream, ready, start, done):
+    shadow = shadowfb.SharedFramebuffer(WIDTH, HEIGHT, 4)
+    ready.release()
+    start.wait()
+    decode(stream, shadow)
+    # perf_counter is the same clock in all processes
+    done.put(time.perf_counter())
+    shadow.close()
+
+
+def in_process(stream, mfds):
+    start = time.perf_counter()
+    for n in range(mfds):
+        decode(stream, shadowfb.ShadowFramebuffer(WIDTH, HEIGHT, 4))
+    return time.perf_counter() - start
+
+
+def in_processes(stream, mfds):
+    context = multiprocessing.get_context('fork')
+    ready = context.Semaphore(0)
+    start = context.Event()
+    done = context.Queue()
+    processes = [context.Process(target=worker, args=(stream, ready, start, done))
+                 for n in range(mfds)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        ready.acquire()
+    begin = time.perf_counter()
+    start.set()
+    finished = max(done.get() for process in processes)
+    for process in processes:
+        process.join()
+    return finished - begin
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    cores = os.cpu_count() or 1
+    most = int(sys.argv[2]) if len(sys.argv) > 2 else max(cores, 2)
+    encoder = rfbserver.ZRLEEncoder()
+    stream = server_init() + b''.join(rfbserver.encode_frame(encoder, frame, WIDTH, HEIGHT)
+                                      for frame in mfd_frames(count))
+    print("%d cores, %d frames per MFD" % (cores, count))
+    # one shared memory tracker for all workers, started up front
+    multiprocessing.resource_tracker.ensure_running()
+    for mfds in range(1, most + 1):
+        serial = in_process(stream, mfds)
+        parallel = in_processes(stream, mfds)
+        print("%d MFDs: one process %7.1f frames/s, process per MFD %7.1f frames/s (x%.2f)" %
+              (mfds, mfds * count / serial, mfds * count / parallel, serial / parallel))
+
+
+if __name__ == '__main__':
+    main()
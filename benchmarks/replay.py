@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Decode time of a recorded session (see capture.py and Option.capture).
+
+The capture is fed to RFBClient as fast as possible in the recorded
+chunks, the callbacks do nothing. Run it before and after a decoder
+change on the same recordings. With --profile one more run counts
+the time per handler and encoding (RFBClient.enableProfiling).
+
+usage: python3 benchmarks/replay.py capture-file [runs] [--profile]
+"""
+
+import sys
+import time
+
+from zrle_vs_raw import CountingClient, NullTransport
+
+import capture
+
+
+class ReplayClient(CountingClient):
+    """asks for the pixel format of the recorded client"""
+
+    def __init__(self, pixformat):
+        CountingClient.__init__(self)
+        self.pixformat = pixformat
+
+    def vncConnectionMade(self):
+        if self.pixformat:
+            self.setPixelFormat(**self.pixformat)
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if arg != '--profile']
+    profile = len(args) < len(sys.argv) - 1
+    if not args:
+        print(__doc__)
+        return
+    replay = capture.Replay(args[0])
+    runs = int(args[1]) if len(args) > 1 else 5
+    best = None
+    for run in range(runs):
+        client = ReplayClient(replay.pixformat)
+        client.connection_made(NullTransport())
+        start = time.perf_counter()
+        replay.feed(client)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%d bytes, %d updates (%d in the index), recorded in %.1f s" %
+          (replay.size, client.updates, len(replay.updates), replay.duration))
+    print("decode %.3f s, %.1f MB/s, %.0f updates/s (best of %d)" %
+          (best, replay.size / best / 1e6, client.updates / best, runs))
+    if profile:
+        client = ReplayClient(replay.pixformat)
+        client.connection_made(NullTransport())
+        client.enableProfiling()
+        start = time.perf_counter()
+        replay.feed(client)
+        print("profiled run %.3f s" % (time.perf_counter() - start))
+        print(client.profile.report())
+    replay.close()
+
+
+if __name__ == '__main__':
+    main()
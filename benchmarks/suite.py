@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""
+Benchmark suite: protocol decoding, client events and rendering.
+
+  decode   RFBClient parsing and decoding, MB/s and rectangles/s per
+           encoding, callbacks do nothing
+  events   VNCClient turning the same streams into render events
+  render   applying the events and presenting with SDL, on the dummy
+           video driver unless SDL_VIDEODRIVER is set: texture only,
+           shadow framebuffer and tile cache
+
+The streams are MFD sessions made by rfbserver.py (bgr888) in every
+encoding, plus the recordings given with --capture (see capture.py).
+Every measurement is the best of --repeat rounds of at least MIN_TIME
+seconds.
+
+Results are written as JSON with --output. With --baseline, every
+result is compared with the same one of an earlier run and the exit
+status is 1 when one is slower by more than --tolerance.
+
+usage: python3 benchmarks/suite.py [--group decode] [--frames 100]
+       [--capture file] [--output new.json] [--baseline old.json]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+from zrle_vs_raw import NullTransport, CHUNK
+
+# before SDL is initialized
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import sdl2.ext
+
+import capture
+import orbitermfdclient
+import rfb
+import rfbserver
+
+GROUPS = ('decode', 'events', 'render')
+
+ENCODINGS = ('raw', 'rre', 'corre', 'hextile', 'zrle', 'tight')
+
+# shortest round of a measurement, short runs are too noisy
+MIN_TIME = 0.2
+
+# render variants: name, shadow framebuffer, tile cache bytes
+RENDER_VARIANTS = (('texture', False, 0), ('shadow', True, 0), ('tiles', False, 4 << 20))
+
+
+class Stream:
+    """a server stream, fed in network sized chunks or the recorded ones"""
+
+    def __init__(self, name, data=None, replay=None):
+        self.name = name
+        self.data = data
+        self.replay = replay
+        # setPixelFormat() arguments of the recording
+        self.pixformat = replay.pixformat if replay is not None else None
+        self.size = len(data) if data is not None else replay.size
+
+    def chunks(self):
+        if self.replay is not None:
+            return self.replay.data()
+        view = memoryview(self.data)
+        return (view[pos:pos + CHUNK] for pos in range(0, len(view), CHUNK))
+
+
+def synthetic_streams(frames):
+    streams = []
+    for name in ENCODINGS:
+        encodings = [rfbserver.ENCODING_NAMES[name], rfb.COPY_RECTANGLE_ENCODING,
+                     rfb.PSEUDO_LAST_RECT]
+        # a page change (full redraw) every 25 frames
+        streams.append(Stream(name, rfbserver.session(encodings, frames, page_frames=25)))
+    return streams
+
+
+def best(repeat, run):
+    """time per run() call, the best of repeat rounds of at least
+       MIN_TIME seconds. returns (seconds, last result)"""
+    start = time.perf_counter()
+    result = run()
+    calls = max(1, int(MIN_TIME / max(time.perf_counter() - start, 1e-6)))
+    elapsed = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        for call in range(calls):
+            result = run()
+        seconds = (time.perf_counter() - start) / calls
+        elapsed = seconds if elapsed is None else min(elapsed, seconds)
+    return elapsed, result
+
+
+# ------------------------------------------------------
+# decode
+# ------------------------------------------------------
+
+class DecodeClient(rfb.RFBClient):
+    def __init__(self, pixformat=None):
+        rfb.RFBClient.__init__(self, None)
+        self.pixformat = pixformat
+        self.updates = 0
+        self.rects = 0
+
+    def vncConnectionMade(self):
+        if self.pixformat:
+            self.setPixelFormat(**self.pixformat)
+
+    def commitUpdate(self, rectangles=None):
+        self.updates += 1
+        self.rects += len(rectangles or ())
+
+    def fillRectangle(self, x, y, width, height, color):
+        pass
+
+
+def bench_decode(stream, repeat):
+    def run():
+        client = DecodeClient(stream.pixformat)
+        client.connection_made(NullTransport())
+        for data in stream.chunks():
+            client.data_received(data)
+        return client
+
+    seconds, client = best(repeat, run)
+    return {
+        'seconds': seconds,
+        'bytes': stream.size,
+        'updates': client.updates,
+        'rectangles': client.rects,
+        'mb_per_s': stream.size / seconds / 1e6,
+        'rects_per_s': client.rects / seconds,
+        'ms_per_update': seconds * 1000 / client.updates,
+        'metric': 'mb_per_s',
+    }
+
+
+# ------------------------------------------------------
+# events
+# ------------------------------------------------------
+
+def _client_option(stream):
+    """Option with the pixel format of the stream, None when the client
+       has no such format"""
+    option = orbitermfdclient.Option()
+    if stream.pixformat is None:
+        return option
+    for name, (pixformat, sdlformat) in orbitermfdclient.PIXEL_FORMATS.items():
+        if pixformat == stream.pixformat:
+            option.pixel_format = name
+            return option
+    return None
+
+
+def decode_frames(stream, option, loop):
+    """the events of every frame, as the render loop gets them"""
+    client = orbitermfdclient.VNCClient(loop, None, option)
+    client.connection_made(NullTransport())
+    frames = []
+    # without the connection messages
+    with contextlib.redirect_stdout(io.StringIO()):
+        for data in stream.chunks():
+            client.data_received(data)
+            frames.extend(client.nextFrames())
+    client.pacer.stop()
+    return frames
+
+
+def bench_events(stream, option, loop, repeat):
+    seconds, frames = best(repeat, lambda: decode_frames(stream, option, loop))
+    events = sum(len(frame) for frame in frames)
+    return {
+        'seconds': seconds,
+        'bytes': stream.size,
+        'frames': len(frames),
+        'events': events,
+        'events_per_s': events / seconds,
+        'mb_per_s': stream.size / seconds / 1e6,
+        'metric': 'mb_per_s',
+    }
+
+
+# ------------------------------------------------------
+# render
+# ------------------------------------------------------
+
+def bench_render(frames, option, renderer, shadow, tile_cache, repeat):
+    """apply and present every frame, the framebuffer starts empty"""
+    sdlformat = orbitermfdclient.PIXEL_FORMATS[option.pixel_format][1]
+
+    def run():
+        framebuffer = orbitermfdclient.Framebuffer(renderer, sdlformat, shadow, tile_cache)
+        for evs in frames:
+            framebuffer.apply(evs)
+            framebuffer.draw()
+            renderer.present()
+        tiles = framebuffer.tiles
+        framebuffer.destroy()
+        return tiles
+
+    seconds, tiles = best(repeat, run)
+    result = {
+        'seconds': seconds,
+        'frames': len(frames),
+        'ms_per_frame': seconds * 1000 / len(frames),
+        'frames_per_s': len(frames) / seconds,
+        'metric': 'frames_per_s',
+    }
+    if tiles is not None:
+        # of the last run
+        result['tile_hits'] = tiles.hits
+        result['tile_misses'] = tiles.misses
+        result['tile_evictions'] = tiles.evictions
+    return result
+
+
+# ------------------------------------------------------
+# results
+# ------------------------------------------------------
+
+def compare(results, baseline, tolerance):
+    """prints the change of every result against baseline, returns the
+       names of the ones slower by more than tolerance"""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None or old.get('metric') != result['metric']:
+            print("%-40s new" % name)
+            continue
+        metric = result['metric']
+        change = result[metric] / old[metric] - 1
+        slower = change < -tolerance
+        if slower:
+            regressions.append(name)
+        print("%-40s %12.2f %-12s %+6.1f%%%s" % (name, result[metric], metric, change * 100,
+                                                "  REGRESSION" if slower else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Client benchmark suite.")
+    parser.add_argument('--group', action='append', choices=GROUPS,
+                        help="run only this group, may be repeated")
+    parser.add_argument('--frames', type=int, default=100, help="frames per synthetic stream")
+    parser.add_argument('--repeat', type=int, default=5, help="rounds per measurement")
+    parser.add_argument('--capture', action='append', default=[], help="recorded session")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare with the results in this JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="slowdown counted as a regression (0.1 = 10%%)")
+    args = parser.parse_args()
+    groups = args.group or GROUPS
+
+    streams = synthetic_streams(args.frames)
+    for path in args.capture:
+        streams.append(Stream('capture:' + os.path.basename(path), replay=capture.Replay(path)))
+
+    results = {}
+    if 'decode' in groups:
+        for stream in streams:
+            results['decode/' + stream.name] = bench_decode(stream, args.repeat)
+    if 'events' in groups or 'render' in groups:
+        # the pacer schedules on the loop, it is never run
+        loop = asyncio.new_event_loop()
+        if 'render' in groups:
+            sdl2.ext.init()
+            window = sdl2.ext.Window("benchmark", size=(320, 240))
+            renderer = sdl2.ext.Renderer(window, flags=sdl2.render.SDL_RENDERER_SOFTWARE)
+        for stream in streams:
+            option = _client_option(stream)
+            if option is None:
+                print("%s: pixel format not supported by the client, skipped" % stream.name)
+                continue
+            if 'events' in groups:
+                results['events/' + stream.name] = bench_events(stream, option, loop, args.repeat)
+            if 'render' in groups:
+                frames = decode_frames(stream, option, loop)
+                for variant, shadow, tile_cache in RENDER_VARIANTS:
+                    name = 'render/%s/%s' % (stream.name, variant)
+                    results[name] = bench_render(frames, option, renderer, shadow, tile_cache,
+                                                 args.repeat)
+        loop.close()
+
+    for name, result in results.items():
+        metric = result['metric']
+        print("%-40s %12.2f %s" % (name, result[metric], metric))
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'frames': args.frames,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            old = json.load(baseline)
+        print("\ncompared with %s (%s, %s):" % (args.baseline, old.get('time'), old.get('machine')))
+        if compare(results, old['results'], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
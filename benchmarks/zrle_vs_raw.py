@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Bytes on the wire and decode time of ZRLE compared to RAW.
+
+The MFD page of rfbserver.py (changing text lines, a scrolling graph)
+is encoded by its ZRLE encoder and fed to RFBClient in network sized
+chunks.
+
+usage: python3 benchmarks/zrle_vs_raw.py [frames]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rfb
+import rfbserver
+
+WIDTH = 320
+HEIGHT = 240
+CHUNK = 1448            # typical TCP payload
+
+
+def mfd_frames(count, width=WIDTH, height=HEIGHT):
+    """32 bpp frames of the MFD page of rfbserver.py, pixels R, G, B, 0"""
+    screen = rfbserver.MFDScreen(width, height, page_frames=0)
+    screen.redraw()
+    for n in range(count):
+        yield bytes(screen.pixels)
+        screen.step()
+
+
+def server_init(width=WIDTH, height=HEIGHT):
+    return rfbserver.server_init(width, height)
+
+
+def encode_raw(frame, width=WIDTH, height=HEIGHT):
+    return rfbserver.encode_frame(rfbserver.RawEncoder(), frame, width, height)
+
+
+class NullTransport:
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class CountingClient(rfb.RFBClient):
+    def __init__(self):
+        rfb.RFBClient.__init__(self, None)
+        self.updates = 0
+
+    def commitUpdate(self, rectangles=None):
+        self.updates += 1
+
+    def fillRectangle(self, x, y, width, height, color):
+        pass
+
+
+def decode(stream):
+    client = CountingClient()
+    client.connection_made(NullTransport())
+    view = memoryview(stream)
+    start = time.perf_counter()
+    for pos in range(0, len(stream), CHUNK):
+        client.data_received(view[pos:pos + CHUNK])
+    return time.perf_counter() - start, client.updates
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    frames = list(mfd_frames(count))
+    encoder = rfbserver.ZRLEEncoder()
+    streams = {
+        'RAW': b''.join(encode_raw(frame) for frame in frames),
+        'ZRLE': b''.join(rfbserver.encode_frame(encoder, frame, WIDTH, HEIGHT) for frame in frames),
+    }
+    for name, updates in streams.items():
+        elapsed, decoded = decode(server_init() + updates)
+        assert decoded == count
+        print("%-5s %9d bytes on wire (%7.0f per frame), decode %7.2f ms per frame" %
+              (name, len(updates), len(updates) / count, elapsed * 1000 / count))
+
+
+if __name__ == '__main__':
+    main()
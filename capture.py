@@ -0,0 +1,284 @@
+"""
+Recording and replay of the server side of RFB sessions.
+
+A capture file holds the bytes received from the server as they came
+in, each chunk with its arrival time, followed by an index of the
+chunks and of the framebuffer update boundaries:
+
+    header   magic, index offset, chunk count, update count, start time,
+             the pixel format the client asked for
+    records  per chunk: time, length, data
+    index    per chunk: file offset of the data, stream offset, time, length
+             per update: stream offset of the message, time
+
+A capture that was not closed has no index, the chunks are found by
+walking the records. Replay maps the file with mmap and feeds slices of
+it to an RFBClient, at the recorded pace or as fast as possible.
+
+The other client messages are not recorded, replay into a client with
+the same encodings as the recorded one.
+
+MIT License
+"""
+
+import asyncio
+import mmap
+import struct
+import sys
+import time
+
+MAGIC = b'RFBCAP1\n'
+# magic, index offset (0 while recording), chunks, updates, start
+# (time.time()), SetPixelFormat pixel format (zero when not set)
+_HEADER = struct.Struct("=8sQQQd16s")
+_PIXEL_FORMAT = "!BBBBHHHBBBxxx"
+# time since the start, length
+_RECORD = struct.Struct("=dI")
+_CHUNK = struct.Struct("=QQdI")
+_UPDATE = struct.Struct("=Qd")
+
+
+class Capture:
+    """writes the chunks given to write(), update() marks where a
+       framebuffer update starts"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.started = time.time()
+        self.file.write(_HEADER.pack(MAGIC, 0, 0, 0, self.started, b''))
+        self.start = time.perf_counter()
+        self.pixformat = b''
+        # stream bytes recorded
+        self.size = 0
+        self.chunks = []
+        self.updates = []
+
+    def write(self, data):
+        if self.file is None:
+            # closed, the connection is going away
+            return
+        now = time.perf_counter() - self.start
+        size = len(data)
+        self.chunks.append((self.file.tell() + _RECORD.size, self.size, now, size))
+        self.file.write(_RECORD.pack(now, size))
+        self.file.write(data)
+        self.size += size
+
+    def setPixelFormat(self, pixformat):
+        """the client changed the pixel format, packed PIXEL_FORMAT"""
+        self.pixformat = bytes(pixformat)
+
+    def update(self, position):
+        """a framebuffer update message starts at stream offset position,
+           may be called from the decoder thread"""
+        self.updates.append((position, time.perf_counter() - self.start))
+
+    def close(self):
+        """writes the index"""
+        if self.file is None:
+            return
+        index = self.file.tell()
+        self.file.write(b''.join(_CHUNK.pack(*chunk) for chunk in self.chunks))
+        self.file.write(b''.join(_UPDATE.pack(*update) for update in self.updates))
+        self.file.seek(0)
+        self.file.write(_HEADER.pack(MAGIC, index, len(self.chunks), len(self.updates),
+                                     self.started, self.pixformat))
+        self.file.close()
+        self.file = None
+
+
+class ReplayTransport:
+    """stands in for the socket, client messages are dropped"""
+
+    def __init__(self):
+        self.closing = False
+        self.task = None
+        self.reading = asyncio.Event()
+        self.reading.set()
+
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        self.closing = True
+        self.reading.set()
+
+    def pause_reading(self):
+        self.reading.clear()
+
+    def resume_reading(self):
+        self.reading.set()
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+class Replay:
+    """a capture file mapped into memory"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, index, chunks, updates, self.started, pixformat = _HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s is not an RFB capture" % path)
+        if index:
+            self.chunks = [_CHUNK.unpack_from(self.map, index + n * _CHUNK.size)
+                           for n in range(chunks)]
+            index += chunks * _CHUNK.size
+            self.updates = [_UPDATE.unpack_from(self.map, index + n * _UPDATE.size)
+                            for n in range(updates)]
+        else:
+            # not closed, no update boundaries
+            self.chunks = self._scan()
+            self.updates = []
+        # setPixelFormat() arguments of the recorded client, or None
+        self.pixformat = None
+        if any(pixformat):
+            self.pixformat = dict(zip(
+                ('bpp', 'depth', 'bigendian', 'truecolor', 'redmax', 'greenmax', 'bluemax',
+                 'redshift', 'greenshift', 'blueshift'),
+                struct.unpack(_PIXEL_FORMAT, pixformat)))
+        last = self.chunks[-1] if self.chunks else (0, 0, 0.0, 0)
+        # stream bytes and seconds recorded
+        self.size = last[1] + last[3]
+        self.duration = last[2]
+
+    def _scan(self):
+        chunks = []
+        offset = _HEADER.size
+        position = 0
+        end = len(self.map)
+        while offset + _RECORD.size <= end:
+            when, size = _RECORD.unpack_from(self.map, offset)
+            offset += _RECORD.size
+            if offset + size > end:
+                break
+            chunks.append((offset, position, when, size))
+            offset += size
+            position += size
+        return chunks
+
+    def close(self):
+        try:
+            self.view.release()
+            self.map.close()
+        except BufferError:
+            # a client still holds chunks, the map goes with the last one
+            pass
+        self.file.close()
+
+    def _chunk(self, n, start=0, end=None):
+        """stream bytes start to end of chunk n, zero copy"""
+        offset, position, when, size = self.chunks[n]
+        start = max(start - position, 0)
+        end = size if end is None else min(end - position, size)
+        return self.view[offset + start:offset + end]
+
+    def _first(self, position):
+        """the chunk holding stream offset position"""
+        low, high = 0, len(self.chunks)
+        while low < high:
+            middle = (low + high) // 2
+            chunk = self.chunks[middle]
+            if chunk[1] + chunk[3] <= position:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def updateOffset(self, update):
+        """stream offset of framebuffer update number update, the end of
+           the stream past the last"""
+        if update < len(self.updates):
+            return self.updates[update][0]
+        return self.size
+
+    def data(self, start=0, end=None):
+        """stream bytes start to end in the recorded chunks"""
+        end = self.size if end is None else min(end, self.size)
+        n = self._first(start)
+        while n < len(self.chunks) and self.chunks[n][1] < end:
+            yield self._chunk(n, start, end)
+            n += 1
+
+    def feed(self, client, start=0, end=None):
+        """passes stream bytes start to end to client.data_received as
+           fast as possible"""
+        for data in self.data(start, end):
+            client.data_received(data)
+
+    async def play(self, client, transport, speed=1.0, start=0):
+        """replays from stream offset start, at speed times the recorded
+           pace or as fast as possible with speed 0. the earlier bytes
+           are fed right away: zlib streams and the pixel format depend
+           on them, so framebuffer updates are only reached from the
+           beginning. stops when the transport is closed"""
+        loop = asyncio.get_running_loop()
+        self.feed(client, 0, start)
+        n = self._first(start)
+        if n < len(self.chunks):
+            origin = loop.time() - (self.chunks[n][2] / speed if speed else 0)
+        while n < len(self.chunks) and not transport.is_closing():
+            if speed:
+                delay = origin + self.chunks[n][2] / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                # let the loop render and handle input
+                await asyncio.sleep(0)
+            if not transport.reading.is_set():
+                await transport.reading.wait()
+                continue
+            client.data_received(self._chunk(n, start))
+            n += 1
+
+
+async def replay(client, path, speed=1.0, start_update=0):
+    """plays a capture into client like a server connection, returns
+       (transport, client) as loop.create_connection does. the client
+       sees connection_lost at the end"""
+    capture = Replay(path)
+    transport = ReplayTransport()
+    client.connection_made(transport)
+
+    async def play():
+        try:
+            await capture.play(client, transport, speed, capture.updateOffset(start_update))
+        finally:
+            transport.close()
+            client.connection_lost(None)
+            capture.close()
+
+    transport.task = asyncio.get_running_loop().create_task(play())
+    return transport, client
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("usage: python3 capture.py capture-file")
+        return
+    capture = Replay(sys.argv[1])
+    print("%s: recorded %s" % (capture.path, time.ctime(capture.started)))
+    print("%d bytes in %d chunks, %d framebuffer updates, %.1f s" %
+          (capture.size, len(capture.chunks), len(capture.updates), capture.duration))
+    if len(capture.updates) > 1:
+        first, last = capture.updates[0][1], capture.updates[-1][1]
+        if last > first:
+            print("%.1f updates/s, %.0f bytes/s" %
+                  ((len(capture.updates) - 1) / (last - first), capture.size / capture.duration))
+    capture.close()
+
+
+if __name__ == '__main__':
+    main()
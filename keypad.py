@@ -0,0 +1,162 @@
+"""
+Keypad input off the render loop.
+
+A scanner thread reads a keypad backend at a fixed rate, debounces every
+key and hands press and release edges to the asyncio loop with
+call_soon_threadsafe. Chords turns the edges into key and chord actions.
+
+MIT License
+"""
+
+import threading
+import time
+
+
+class MatrixBackend:
+    """adafruit_matrixkeypad on the RPi GPIO pins.
+       rows, cols: board pin numbers (board.D<n>), keys: one tuple of
+       key names per row"""
+
+    def __init__(self, rows, cols, keys):
+        import digitalio
+        import board
+        import adafruit_matrixkeypad
+        rows = [digitalio.DigitalInOut(getattr(board, 'D%d' % pin)) for pin in rows]
+        cols = [digitalio.DigitalInOut(getattr(board, 'D%d' % pin)) for pin in cols]
+        self.keypad = adafruit_matrixkeypad.Matrix_Keypad(rows, cols, keys)
+
+    def scan(self):
+        """keys held down now"""
+        return frozenset(self.keypad.pressed_keys)
+
+
+class SimulatedBackend:
+    """keys are pressed and released from code, for tests and machines
+       without a keypad. contacts bounce for bounce seconds"""
+
+    def __init__(self, bounce=0.0):
+        self.bounce = bounce
+        self._lock = threading.Lock()
+        # key -> (down, time of the change)
+        self._keys = {}
+
+    def press(self, key):
+        with self._lock:
+            self._keys[key] = (True, time.monotonic())
+
+    def release(self, key):
+        with self._lock:
+            self._keys[key] = (False, time.monotonic())
+
+    def scan(self):
+        now = time.monotonic()
+        with self._lock:
+            keys = list(self._keys.items())
+        pressed = set()
+        for key, (down, since) in keys:
+            if now - since < self.bounce:
+                # a bouncing contact reads at random, alternate
+                down = int((now - since) * 1000) % 2 == 0
+            if down:
+                pressed.add(key)
+        return frozenset(pressed)
+
+
+class KeypadScanner:
+    """scans backend rate times per second in a thread. a key changes
+       state when it reads the same for debounce seconds, then
+       callback(key, down) is called in the loop"""
+
+    def __init__(self, backend, loop, callback, rate=100.0, debounce=0.02):
+        self.backend = backend
+        self.loop = loop
+        self.callback = callback
+        self.interval = 1.0 / rate
+        self.debounce = debounce
+        # debounced keys held down
+        self.pressed = set()
+        # last scan and when keys last read differently
+        self._raw = frozenset()
+        self._changed = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.scans = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='keypad', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.scan(time.monotonic())
+
+    def scan(self, now):
+        """one scan, called by the thread"""
+        self.scans += 1
+        raw = self.backend.scan()
+        for key in raw ^ self._raw:
+            self._changed[key] = now
+        self._raw = raw
+        for key, since in list(self._changed.items()):
+            if now - since < self.debounce:
+                continue
+            del self._changed[key]
+            down = key in raw
+            if down == (key in self.pressed):
+                continue
+            if down:
+                self.pressed.add(key)
+            else:
+                self.pressed.discard(key)
+            self.loop.call_soon_threadsafe(self.callback, key, down)
+
+
+class Chords:
+    """key edges -> (action, down) where action is a key or a frozenset
+       of keys held together. a key that is part of a chord is reported
+       when it is released before the chord is complete (a tap), other
+       keys right away."""
+
+    def __init__(self, chords=()):
+        self.chords = [frozenset(chord) for chord in chords]
+        self.chordKeys = frozenset().union(*self.chords)
+        self.held = set()
+        # chord keys held, not reported yet
+        self.deferred = set()
+        # keys and chords reported as down
+        self.down = set()
+
+    def edge(self, key, down):
+        """returns the actions for one key edge"""
+        actions = []
+        if down:
+            self.held.add(key)
+            for chord in self.chords:
+                if key in chord and chord <= self.held and chord not in self.down:
+                    # the chord wins over the keys it is made of
+                    self.deferred -= chord
+                    self.down.add(chord)
+                    return [(chord, True)]
+            if key in self.chordKeys:
+                self.deferred.add(key)
+            else:
+                self.down.add(key)
+                actions.append((key, True))
+        else:
+            self.held.discard(key)
+            for chord in [chord for chord in self.chords if key in chord and chord in self.down]:
+                self.down.discard(chord)
+                actions.append((chord, False))
+            if key in self.deferred:
+                self.deferred.discard(key)
+                actions.extend([(key, True), (key, False)])
+            elif key in self.down:
+                self.down.discard(key)
+                actions.append((key, False))
+        return actions
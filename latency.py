@@ -0,0 +1,123 @@
+"""
+End to end latency of the MFD client.
+
+Every MFD keeps rolling histograms of
+
+    first_byte  framebuffer update request sent -> update message received
+    commit      request sent -> update decoded (commitUpdate)
+    present     request sent -> renderer.present() of the update
+    button      soft button pressed -> present of the first frame
+                committed after the press
+
+A histogram counts into logarithmic buckets, recording is a bisect and
+an increment. It covers the last one to two windows: the counts of the
+current window and of the previous one.
+
+MIT License
+"""
+
+import bisect
+import time
+
+# bucket upper bounds in seconds, 4 per octave from 50 us to 13 s
+BOUNDS = [50e-6 * 2 ** (n / 4) for n in range(73)]
+
+# seconds of one histogram window
+WINDOW = 10.0
+
+NAMES = ('first_byte', 'commit', 'present', 'button')
+
+
+class Histogram:
+    """latencies in logarithmic buckets over the last one to two
+       windows"""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.started = time.perf_counter()
+        # the last bucket counts everything above BOUNDS[-1]
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.previous = [0] * (len(BOUNDS) + 1)
+        self.max = 0.0
+        self.previousMax = 0.0
+
+    def _rotate(self, now):
+        if now - self.started < 2 * self.window:
+            self.previous = self.counts
+            self.previousMax = self.max
+        else:
+            # nothing recorded for a whole window
+            self.previous = [0] * len(self.counts)
+            self.previousMax = 0.0
+        self.counts = [0] * len(self.counts)
+        self.max = 0.0
+        self.started = now
+
+    def record(self, seconds, now):
+        if now - self.started >= self.window:
+            self._rotate(now)
+        self.counts[bisect.bisect_left(BOUNDS, seconds)] += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def summary(self, now):
+        """count, percentiles and max in ms, the percentiles are bucket
+           upper bounds. None without samples"""
+        if now - self.started >= self.window:
+            self._rotate(now)
+        counts = [a + b for a, b in zip(self.counts, self.previous)]
+        total = sum(counts)
+        if not total:
+            return None
+        largest = max(self.max, self.previousMax)
+        result = {'count': total, 'max': round(largest * 1000, 2)}
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            rank = fraction * total
+            seen = 0
+            for n, count in enumerate(counts):
+                seen += count
+                if seen >= rank:
+                    break
+            bound = BOUNDS[n] if n < len(BOUNDS) else largest
+            result[name] = round(min(bound, largest) * 1000, 2)
+        return result
+
+
+class Latency:
+    """the histograms of one MFD"""
+
+    def __init__(self, window=WINDOW):
+        self.histograms = {name: Histogram(window) for name in NAMES}
+        # soft button press waiting for a frame, and for its present
+        self.pressTime = None
+        self.pressCommitted = None
+
+    def pressed(self, now):
+        """a soft button went down"""
+        if self.pressTime is None:
+            self.pressTime = now
+
+    def committed(self, requested, started, now):
+        """a frame is complete. requested: send time of the request it
+           answers, started: arrival of the update message (None when
+           unknown)"""
+        histograms = self.histograms
+        if requested is not None:
+            if started is not None and started >= requested:
+                histograms['first_byte'].record(started - requested, now)
+            histograms['commit'].record(now - requested, now)
+        if self.pressTime is not None and self.pressCommitted is None:
+            self.pressCommitted = self.pressTime
+            self.pressTime = None
+
+    def presented(self, requested, now):
+        """the oldest frame applied was requested at requested"""
+        if requested is not None:
+            self.histograms['present'].record(now - requested, now)
+        if self.pressCommitted is not None:
+            self.histograms['button'].record(now - self.pressCommitted, now)
+            self.pressCommitted = None
+
+    def summary(self, now):
+        """name -> Histogram.summary()"""
+        return {name: histogram.summary(now) for name, histogram in self.histograms.items()}
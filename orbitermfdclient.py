@@ -13,16 +13,39 @@ import sdl2.ext
 import time
 import asyncio
 import ctypes
+import sys
+import array
+import itertools
+import collections
+import re
 import struct
+import configparser
+import json
+import os
+import multiprocessing
+import threading
+import queue
+import zlib
 
-from sdl2 import render, rect, surface
+import keypad
+import capture
+import latency
+
+from sdl2 import render, rect, surface, mouse
+
+try:
+    import shadowfb
+except ImportError:
+    # numpy is not installed
+    shadowfb = None
 
 from os import uname
 
-if "x86" in uname().machine.lower():
-    rpi = False
-elif "arm" in uname().machine.lower():
-    rpi = True
+# VNCMFD plugin configuration, next to this script
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'VNCMFD.ini')
+
+# armv7l on 32 bit Raspberry Pi OS, aarch64 on 64 bit
+rpi = uname().machine.lower().startswith(('arm', 'aarch64'))
 
 fl = None
 fl = sdl2.SDL_WINDOW_BORDERLESS
@@ -31,84 +54,144 @@ fl = fl | sdl2.SDL_WINDOW_FULLSCREEN_DESKTOP
     
 if rpi:
     print("Machine: RPi")
-    import RPi.GPIO as GPIO
-    import digitalio
-    import board
-    import adafruit_matrixkeypad
-    cols = [digitalio.DigitalInOut(x) for x in (board.D25, board.D8, board.D7, board.D12, board.D16, board.D20, board.D21)]
-    #rows = [digitalio.DigitalInOut(x) for x in (board.D13, board.D12, board.D11, board.D10)]
-    rows = [digitalio.DigitalInOut(x) for x in (board.D24, board.D26)]
-    keys = (("1", "2", "3", "4", "5", "6", "x"),
-            ("q", "w", "e", "r", "t", "y", "c")
-            )
-    keypad = adafruit_matrixkeypad.Matrix_Keypad(rows, cols, keys)
-
-def key2xy(key):
-
-    print("key2xy:", key)
-    x = 1
-    y = 1
-    if key == ord("1"):
-        x = 20
-        y = 25
-    elif key == ord("2"):
-        x = 20
-        y = 65
-    elif key == ord("3"):
-        x = 20
-        y = 105
-    elif key == ord("4"):
-        x = 20
-        y = 145
-    elif key == ord("5"):
-        x = 20
-        y = 185
-    elif key == ord("6"):
-        x = 20
-        y = 225
-
-    elif key == ord("q"):
-        x = 300
-        y = 25
-    elif key == ord("w"):
-        x = 300
-        y = 65
-    elif key == ord("e"):
-        x = 300
-        y = 105
-    elif key == ord("r"):
-        x = 300
-        y = 145
-    elif key == ord("t"):
-        x = 300
-        y = 185
-    elif key == ord("y"):
-        x = 300
-        y = 225
-
-    # power button (disabled, not used)
-    elif key == ord("z"):
-        x = 140
-        y = 105
-    # select button
-    elif key == ord("x"):
-        #x = 140
-        x = 70
-        y = 1
-    # menu button
-    elif key == ord("c"):
-        #x = 255
-        x = 120
-        y = 1
-    
-    # exit viewer
-    elif key == ord("p"):
-        print("P key. Exitting!")
-        sdl2.ext.quit()
-        exit()
-    #print("x=", x, ", y=", y)
-    return x, y
-        
+
+# keypad matrix on the RPi GPIO: board pin numbers and the key of each
+# row / column contact
+KEYPAD_COLS = (25, 8, 7, 12, 16, 20, 21)
+#KEYPAD_ROWS = (13, 12, 11, 10)
+KEYPAD_ROWS = (24, 26)
+KEYPAD_KEYS = (("1", "2", "3", "4", "5", "6", "x"),
+               ("q", "w", "e", "r", "t", "y", "c"),
+               )
+
+# keyboard (and keypad) shortcuts: MFD button number -> key.
+# a VNCMFD.ini section can set its own with Button{N}Key, keys
+# joined with + are a chord (Button100Key = x+c)
+BUTTON_KEYS = {
+    0: '1', 1: '2', 2: '3', 3: '4', 4: '5', 5: '6',
+    6: 'q', 7: 'w', 8: 'e', 9: 'r', 10: 't', 11: 'y',
+    100: 'z',   # power
+    101: 'x',   # select
+    102: 'c',   # menu
+}
+
+# exit viewer
+KEY_QUIT = ord('p')
+# show / hide the latency overlay
+KEY_OVERLAY = ord('o')
+
+# down and up are pre-packed pointerEvent messages at the button center
+Button = collections.namedtuple('Button', 'number x y width height down up')
+
+
+class ButtonMap:
+    """MFD soft buttons of one VNCMFD.ini section. Keys and pointer
+       positions map to buttons with a dict lookup / rectangle test,
+       the pointer messages for the button centers are packed once."""
+
+    def __init__(self, buttons=(), keys=None):
+        self.buttons = list(buttons)
+        self.keys = {}
+        numbers = {button.number: button for button in self.buttons}
+        for number, key in (keys or {}).items():
+            if number in numbers:
+                self.keys[key] = numbers[number]
+
+    @classmethod
+    def load(cls, mfd, keys=BUTTON_KEYS):
+        """buttons from a configparser section. keys: default shortcuts,
+           Button{N}Key in the section wins"""
+        width = mfd.getint('XSize', 320)
+        height = mfd.getint('YSize', 240)
+        default_width = mfd.getint('ButtonDefaultWidth', 39)
+        default_height = mfd.getint('ButtonDefaultHeight', 30)
+        left = mfd.getint('LeftButtons', 6)
+        right = mfd.getint('RightButtons', 6)
+        # side buttons, evenly spread in their column unless placed
+        numbers = list(range(left + right))
+        # other buttons need a position
+        for option in mfd:
+            match = re.fullmatch(r'button(\d+)x', option)
+            if match and int(match.group(1)) not in numbers:
+                numbers.append(int(match.group(1)))
+        buttons = []
+        for number in numbers:
+            name = 'Button%d' % number
+            if mfd.getboolean(name + 'Disable', False):
+                continue
+            bw = mfd.getint(name + 'Width', default_width)
+            bh = mfd.getint(name + 'Height', default_height)
+            if number < left:
+                slot, index, bx = height / left, number, 0
+            elif number < left + right:
+                slot, index, bx = height / right, number - left, width - bw
+            else:
+                slot, index, bx = None, 0, 0
+            bx = mfd.getint(name + 'X', bx)
+            if slot is None:
+                by = mfd.getint(name + 'Y', None)
+                if by is None:
+                    continue
+            else:
+                by = mfd.getint(name + 'Y', int(index * slot + (slot - bh) / 2))
+            cx = bx + bw // 2
+            cy = by + bh // 2
+            buttons.append(Button(number, bx, by, bw, bh,
+                                  pack_pointer_event(cx, cy, 1),
+                                  pack_pointer_event(cx, cy, 0)))
+        shortcuts = dict(keys)
+        for number in numbers:
+            key = mfd.get('Button%dKey' % number)
+            if key:
+                shortcuts[number] = key.strip('"')
+        return cls(buttons, {number: keysym(key) for number, key in shortcuts.items()})
+
+    def button(self, key):
+        """button for a keysym or chord, None if the key is not bound"""
+        return self.keys.get(key)
+
+    def chords(self):
+        """bound chords, frozensets of keysyms"""
+        return [key for key in self.keys if isinstance(key, frozenset)]
+
+    def buttonAt(self, x, y):
+        """button under the pointer, None if there is none"""
+        for button in self.buttons:
+            if button.x <= x < button.x + button.width and button.y <= y < button.y + button.height:
+                return button
+        return None
+
+
+def keysym(key):
+    """a single character or a (hex) number, keys joined with + are a
+       chord (a frozenset of keysyms)"""
+    if len(key) == 1:
+        return ord(key)
+    if '+' in key:
+        return frozenset(keysym(part) for part in key.split('+'))
+    return int(key, 0)
+
+
+def pack_pointer_event(x, y, buttonmask):
+    """same message as RFBClient.pointerEvent()"""
+    return struct.pack("!BBHH", 5, buttonmask, x, y)
+
+
+def load_options(path=CONFIG_FILE):
+    """one Option per [MFD...] section of VNCMFD.ini. the default key
+       shortcuts go to the first MFD, the others need Button{N}Key"""
+    config = configparser.ConfigParser(strict=False)
+    config.read(path)
+    options = []
+    for section in config.sections():
+        if not section.upper().startswith('MFD'):
+            continue
+        option = Option()
+        option.configure(config[section], BUTTON_KEYS if not options else {})
+        options.append(option)
+    return options
+
+
 class Option:
     def __init__(self):
         self.host = '192.168.10.11'
@@ -121,34 +204,426 @@ class Option:
         #self.height = 540
 
         self.encoding = [ rfb.RAW_ENCODING ]
+        # slow links (Wi-Fi): prefer the compressed encoding
+        #self.encoding = [ rfb.ZRLE_ENCODING, rfb.RAW_ENCODING ]
+        # several MFDs on a shared link: tight, JPEG needs PIL installed
+        #self.encoding = [ rfb.TIGHT_ENCODING, rfb.RAW_ENCODING ]
+        # pixel format on the wire, see PIXEL_FORMATS. smaller formats
+        # cut RAW/Hextile traffic by 2 (rgb565) or 4 (rgb332)
+        self.pixel_format = 'bgr888'
+        # tight zlib level (0..9) and JPEG quality (0..9, None: no JPEG)
+        self.tight_compress = 6
+        self.tight_quality = None
+        # when the renderer falls behind, apply all complete frames
+        # and present only the newest one
+        self.skip_frames = True
+        # the render loop wakes up at once for a new frame. SDL input
+        # is polled every input_interval seconds: SDL events can only
+        # be pumped by the thread owning the window, there is nothing
+        # to wait on. while no input and no frame arrives the interval
+        # doubles up to idle_interval
+        self.input_interval = 0.001
+        self.idle_interval = 0.05
+        # print idle CPU load and update to present latency
+        self.stats = False
+        # keep a copy of the screen in memory (needs numpy), only dirty
+        # regions are uploaded, copyrect is done in memory
+        self.shadow = False
+        # framebuffer update requests per second (UpdateFrequency in
+        # VNCMFD.ini), 0: request the next update as soon as one is done
+        self.update_frequency = 10
+        # incremental requests in flight, more hides the network latency
+        # but costs server CPU and link load
+        self.max_requests = 1
+        # soft buttons, from VNCMFD.ini
+        self.buttons = ButtonMap()
+        self.section = 'MFD1'
+        # decode every MFD in its own process (needs numpy), the pixels
+        # are shared with the display process, which only uploads the
+        # dirty regions and presents
+        self.processes = False
+        # keypad backend: 'matrix' (GPIO), 'simulated' or None. it is
+        # scanned keypad_rate times per second in a thread, a key has
+        # to read the same for keypad_debounce seconds
+        self.keypad = 'matrix' if rpi else None
+        self.keypad_rate = 100
+        self.keypad_debounce = 0.02
+        # decode in a thread, the loop only passes on the received data.
+        # reading from the socket pauses while max_frames frames wait
+        # for the renderer or decoder_buffer bytes for the decoder
+        self.decoder_thread = False
+        self.max_frames = 4
+        self.decoder_buffer = 1 << 20
+        # pixel data waiting for the renderer, above it the waiting
+        # updates are dropped and the whole screen is requested again
+        self.max_queue_bytes = 8 << 20
+        # several MFDs: 'regions' side by side in one fullscreen window,
+        # 'windows' one fullscreen window per display
+        self.layout = 'regions'
+        # the server sends the cursor shape instead of painting it into
+        # the screen, it is shown by SDL (hidden on the RPi)
+        self.local_cursor = True
+        # record the server stream to this file ('{section}' is the MFD
+        # name), see capture.py
+        self.capture = None
+        # play a capture instead of connecting, speed times the recorded
+        # pace, 0 as fast as possible. the updates before replay_start
+        # are decoded without waiting
+        self.replay = None
+        self.replay_speed = 1.0
+        self.replay_start = 0
+        # latency percentiles drawn over the MFDs (toggled with o), and
+        # printed as a JSON line every latency_log seconds (0: never)
+        self.overlay = False
+        self.latency_log = 0
+        # count calls, bytes and time per protocol handler and encoding
+        # (rfb.Profile), printed at exit
+        self.profile = False
+        # bytes of uploaded tiles (up to 64x64) kept in atlas textures,
+        # a tile seen again is copied from there. 0: no cache. not used
+        # with the shadow framebuffer
+        self.tile_cache = 0
+
+    def load(self, path=CONFIG_FILE, section='MFD1'):
+        """take port, screen size and update frequency from a VNCMFD.ini
+           section"""
+        config = configparser.ConfigParser(strict=False)
+        if not config.read(path) or not config.has_section(section):
+            return False
+        self.configure(config[section])
+        return True
+
+    def configure(self, mfd, keys=BUTTON_KEYS):
+        """settings from a configparser section, keys: default button
+           shortcuts"""
+        self.section = mfd.name
+        self.port = mfd.getint('VNCPort', self.port)
+        self.width = mfd.getint('XSize', self.width)
+        self.height = mfd.getint('YSize', self.height)
+        self.update_frequency = mfd.getfloat('UpdateFrequency', self.update_frequency)
+        self.buttons = ButtonMap.load(mfd, keys)
 
     def remote_url(self):
         return 'vnc://%s:%s' % (self.host, self.port)
 
+    def encodings(self):
+        """encodings for setEncodings(), with the tight levels and
+           pseudo encodings"""
+        encodings = list(self.encoding)
+        if rfb.TIGHT_ENCODING in encodings:
+            encodings.append(rfb.PSEUDO_COMPRESS_LEVEL_0 + self.tight_compress)
+            if self.tight_quality is not None and rfb.HAVE_JPEG:
+                encodings.append(rfb.PSEUDO_QUALITY_LEVEL_0 + self.tight_quality)
+        encodings.extend([rfb.PSEUDO_LAST_RECT, rfb.PSEUDO_DESKTOP_SIZE])
+        if self.local_cursor:
+            encodings.append(rfb.PSEUDO_CURSOR)
+        return encodings
+
+
+# wire pixel formats: setPixelFormat() arguments and the SDL texture
+# format with the same memory layout, so pixels are uploaded as they are.
+# (SDL has no BGR233, rgb332 is the 8 bit format)
+_bigendian = int(sys.byteorder == 'big')
+PIXEL_FORMATS = {
+    'bgr888': (dict(bpp=32, depth=24, bigendian=_bigendian, truecolor=1,
+                    redmax=255, greenmax=255, bluemax=255,
+                    redshift=0, greenshift=8, blueshift=16),
+               sdl2.pixels.SDL_PIXELFORMAT_BGR888),
+    'rgb565': (dict(bpp=16, depth=16, bigendian=_bigendian, truecolor=1,
+                    redmax=31, greenmax=63, bluemax=31,
+                    redshift=11, greenshift=5, blueshift=0),
+               sdl2.pixels.SDL_PIXELFORMAT_RGB565),
+    'rgb332': (dict(bpp=8, depth=8, bigendian=_bigendian, truecolor=1,
+                    redmax=7, greenmax=7, bluemax=3,
+                    redshift=5, greenshift=2, blueshift=0),
+               sdl2.pixels.SDL_PIXELFORMAT_RGB332),
+}
+
+# cursor mask byte -> alpha of its 8 pixels
+_MASK_ALPHA = [bytes(0xff if byte >> (7 - bit) & 1 else 0 for bit in range(8))
+               for byte in range(256)]
+
+
+def pixel_pointer(data):
+    """ctypes view of pixel data for SDL calls, without copying when
+       data is a writable buffer (memoryview of the receive buffer)"""
+    try:
+        return (ctypes.c_char * len(data)).from_buffer(data)
+    except TypeError:
+        # read only buffer (bytes), ctypes passes it as is
+        return data
+
 
 EV_RESIZE = 0
 EV_UPDATE_RECT = 1
 EV_COPY_RECT = 2
 EV_FILL_RECT = 3
+EV_CURSOR = 4
+
+
+def _covered(covers, x, y, width, height):
+    """True when one of the (left, top, right, bottom) covers contains
+       the rectangle"""
+    for (left, top, right, bottom) in covers:
+        if left <= x and top <= y and x + width <= right and y + height <= bottom:
+            return True
+    return False
+
+
+class EventQueue:
+    """Events of the frames waiting for the renderer.
+       An update or fill covering an older event of the frame being
+       received makes it obsolete, it is dropped. Committed frames are
+       not changed. Fills of one color in a row become one event, a
+       rectangle continuing the previous one is merged with it. Copies
+       and resizes read the framebuffer, events before them are kept.
+       Above max_bytes of pixel data everything but resizes is dropped,
+       the client then asks for the whole screen."""
+
+    # smaller rectangles (pixels) do not look for events they cover
+    min_cover = 64 * 64
+
+    def __init__(self, max_bytes=8 << 20, across_frames=True):
+        """across_frames: the renderer applies all waiting frames at
+           once, take() drops events of older frames covered by newer
+           ones"""
+        self.maxBytes = max_bytes
+        self.acrossFrames = across_frames
+        # waiting events, oldest first, None where dropped
+        self.events = []
+        # end of each committed frame in events
+        self.ends = []
+        # events before this index are not dropped or merged
+        self.barrier = 0
+        # pixel data held by the update events
+        self.bytes = 0
+        # events before this index hold no views of the receive buffer
+        self.copied = 0
+        self.dropped = 0
+        self.merged = 0
+        self.refreshes = 0
+
+    def __len__(self):
+        """committed frames"""
+        return len(self.ends)
+
+    def _floor(self):
+        # committed frames are not changed, they may be presented alone
+        if not self.ends:
+            return self.barrier
+        return max(self.barrier, self.ends[-1])
+
+    def add(self, ev):
+        """add an event to the frame being received. returns True
+           when the memory limit was hit and the screen must be
+           requested again"""
+        kind = ev[0]
+        if kind == EV_UPDATE_RECT:
+            port, data, pitch = ev[1]
+            if port.w * port.h >= self.min_cover:
+                self._cover(port.x, port.y, port.x + port.w, port.y + port.h)
+            self.events.append(ev)
+            self.bytes += len(data)
+            if self.bytes > self.maxBytes:
+                self._overflow()
+                return True
+        elif kind == EV_FILL_RECT:
+            color, rectangles = ev[1]
+            for (x, y, width, height) in rectangles:
+                if width * height >= self.min_cover:
+                    self._cover(x, y, x + width, y + height)
+            last = self.events[-1] if len(self.events) > self._floor() else None
+            if last is not None and last[0] == EV_FILL_RECT and last[1][0] == color:
+                self._merge(last[1][1], rectangles)
+            else:
+                # the list is extended by the following fills
+                merged = []
+                self._merge(merged, rectangles)
+                self.events.append((EV_FILL_RECT, (color, merged)))
+        else:
+            # copy and resize
+            self.events.append(ev)
+            self.barrier = len(self.events)
+        return False
+
+    def _cover(self, left, top, right, bottom):
+        """drop what is inside the rectangle"""
+        events = self.events
+        for i in range(self._floor(), len(events)):
+            ev = events[i]
+            if ev is None:
+                continue
+            if ev[0] == EV_UPDATE_RECT:
+                port = ev[1][0]
+                if (left <= port.x and top <= port.y and
+                        port.x + port.w <= right and port.y + port.h <= bottom):
+                    events[i] = None
+                    self.bytes -= len(ev[1][1])
+                    self.dropped += 1
+            elif ev[0] == EV_FILL_RECT:
+                rectangles = ev[1][1]
+                kept = [r for r in rectangles
+                        if not (left <= r[0] and top <= r[1] and
+                                r[0] + r[2] <= right and r[1] + r[3] <= bottom)]
+                if len(kept) < len(rectangles):
+                    self.dropped += len(rectangles) - len(kept)
+                    rectangles[:] = kept
+                    if not kept:
+                        events[i] = None
+
+    def _merge(self, rectangles, more):
+        """append more to rectangles, joining touching neighbours"""
+        for r in more:
+            if rectangles:
+                x, y, width, height = rectangles[-1]
+                if r[0] == x and r[2] == width and r[1] == y + height:
+                    rectangles[-1] = (x, y, width, height + r[3])
+                    self.merged += 1
+                    continue
+                if r[1] == y and r[3] == height and r[0] == x + width:
+                    rectangles[-1] = (x, y, width + r[2], height)
+                    self.merged += 1
+                    continue
+            rectangles.append(r)
+
+    def _overflow(self):
+        self.events = [ev if ev is not None and ev[0] == EV_RESIZE else None
+                       for ev in self.events]
+        self.barrier = len(self.events)
+        self.bytes = 0
+        self.refreshes += 1
+
+    def commit(self):
+        """the frame being received is complete. returns False when it
+           has no events"""
+        start = self.ends[-1] if self.ends else 0
+        if len(self.events) == start:
+            return False
+        self.ends.append(len(self.events))
+        if len(self.ends) > 1:
+            self._copyViews()
+        return True
+
+    def _copyViews(self):
+        """frames queue up: the update data of the committed frames is
+           copied. a memoryview slice keeps the whole receive buffer it
+           was taken from alive, more than self.bytes counts"""
+        events = self.events
+        for i in range(self.copied, len(events)):
+            ev = events[i]
+            if ev is not None and ev[0] == EV_UPDATE_RECT:
+                port, data, pitch = ev[1]
+                if isinstance(data, memoryview):
+                    events[i] = (EV_UPDATE_RECT, (port, bytes(data), pitch))
+        self.copied = len(events)
+
+    def take(self, limit=None):
+        """committed frames, oldest first, at most limit"""
+        count = len(self.ends) if limit is None else min(limit, len(self.ends))
+        if not count:
+            return []
+        frames = []
+        start = 0
+        for end in self.ends[:count]:
+            frame = [ev for ev in self.events[start:end] if ev is not None]
+            for ev in frame:
+                if ev[0] == EV_UPDATE_RECT:
+                    self.bytes -= len(ev[1][1])
+            frames.append(frame)
+            start = end
+        del self.events[:start]
+        self.ends = [end - start for end in self.ends[count:]]
+        self.barrier = max(0, self.barrier - start)
+        self.copied = max(0, self.copied - start)
+        if self.acrossFrames and count > 1:
+            self._coverFrames(frames)
+        return frames
+
+    def _coverFrames(self, frames):
+        """drop events of older frames covered by a newer frame. the
+           frames are complete and applied together, each keeps its
+           list, even when empty"""
+        covers = []
+        for frame in reversed(frames):
+            for i in range(len(frame) - 1, -1, -1):
+                ev = frame[i]
+                kind = ev[0]
+                if kind == EV_UPDATE_RECT:
+                    port = ev[1][0]
+                    if _covered(covers, port.x, port.y, port.w, port.h):
+                        frame[i] = None
+                        self.dropped += 1
+                    elif port.w * port.h >= self.min_cover:
+                        covers.append((port.x, port.y, port.x + port.w, port.y + port.h))
+                elif kind == EV_FILL_RECT:
+                    color, rectangles = ev[1]
+                    kept = [r for r in rectangles if not _covered(covers, *r)]
+                    if len(kept) < len(rectangles):
+                        self.dropped += len(rectangles) - len(kept)
+                        frame[i] = (EV_FILL_RECT, (color, kept)) if kept else None
+                    for (x, y, width, height) in kept:
+                        if width * height >= self.min_cover:
+                            covers.append((x, y, x + width, y + height))
+                elif kind == EV_CURSOR:
+                    continue
+                else:
+                    # copies and resizes read the framebuffer, the
+                    # events before them are kept
+                    frame[:] = [ev for ev in frame if ev is not None]
+                    return
+            frame[:] = [ev for ev in frame if ev is not None]
 
 
 class VNCClient(rfb.RFBClient):
-    def __init__(self, loop, renderer, option):
+    def __init__(self, loop, renderer, option, frameReady=None):
         rfb.RFBClient.__init__(self, loop)
         self.loop = loop
         self.option = option
         self.renderer = renderer
-        self._events = []
-        self._frames = []
+        # events of the frames waiting for the renderer and of the
+        # framebuffer update being received
+        self.pending = EventQueue(option.max_queue_bytes, option.skip_frames)
+        # set when a frame is complete, can be shared by several clients
+        self.frameReady = frameReady or asyncio.Event()
+        # commit time of the oldest waiting frame and send time of the
+        # request it answers, the same for every waiting frame
+        self.firstCommitTime = None
+        self.firstRequestTime = None
+        self.commits = collections.deque()
+        self.pacer = UpdatePacer(self, option.update_frequency, option.max_requests)
+        self.latency = latency.Latency()
+        # arrival of the data being decoded and of the current update
+        self.received = None
+        self.updateStart = None
+        if option.capture:
+            self.capture = capture.Capture(option.capture.format(section=option.section))
+        if option.profile:
+            self.enableProfiling()
 
     def vncConnectionMade(self):
         print("Screen format: depth=%d bytes_per_pixel=%r width=%d height=%d" %
               (self.depth, self.bpp, self.width, self.height))
         print("Desktop name: %r" % self.name)
 
-        self.setEncodings(self.option.encoding)
-        self.framebufferUpdateRequest()
-        self._events.append((EV_RESIZE, (self.width, self.height)))
+        pixformat, sdlformat = PIXEL_FORMATS[self.option.pixel_format]
+        self.setPixelFormat(**pixformat)
+        self.setEncodings(self.option.encodings())
+        self.pacer.start()
+        self._addEvent((EV_RESIZE, (self.width, self.height)))
+        self._commitFrame()
+
+    def pressButton(self, button, down=True):
+        """press or release a soft button, the message is pre-packed"""
+        if down:
+            self.latency.pressed(time.perf_counter())
+        self.sendPointerEvent(button.down if down else button.up)
+
+    def data_received(self, data):
+        self.received = time.perf_counter()
+        rfb.RFBClient.data_received(self, data)
+
+    def beginUpdate(self):
+        self.updateStart = self.received
 
     def updateRectangle(self, x, y, width, height, data):
         """new bitmap data. data is a string in the pixel format set
@@ -159,22 +634,32 @@ class VNCClient(rfb.RFBClient):
         port.w = width
         port.h = height
         pitch = int(port.w * self.bpp / 8)
-        self._events.append((EV_UPDATE_RECT, (port, data, pitch)))
+        self._addEvent((EV_UPDATE_RECT, (port, data, pitch)))
 
     def copyRectangle(self, srcx, srcy, x, y, width, height):
         """used for copyrect encoding. copy the given rectangle
            (src, srxy, width, height) to the target coords (x,y)"""
         #print("copyRectangle", srcx, srcy, x, y, width, height)
-        self._events.append((EV_COPY_RECT, (srcx, srcy, x, y, width, height)))
+        self._addEvent((EV_COPY_RECT, (srcx, srcy, x, y, width, height)))
 
     def fillRectangle(self, x, y, width, height, color):
         """fill rectangle with one color"""
         #~ remoteframebuffer.CopyRect(srcx, srcy, x, y, width, height)
         #print('==========fillRectangle', x, y, width, height, color)
 
-        port = (x, y, width, height)
-        r, g, b, a = struct.unpack("!BBBB", color)
-        self._events.append((EV_FILL_RECT, (port, sdl2.ext.Color(r, g, b, a))))
+        self._addEvent((EV_FILL_RECT, (bytes(color), [(x, y, width, height)])))
+
+    def fillRectangles(self, color, rectangles):
+        """fill a list of rectangles with one color, the color is
+           kept packed, the renderer maps it"""
+        self._addEvent((EV_FILL_RECT, (bytes(color), rectangles)))
+
+    def desktopResized(self, width, height):
+        """the framebuffer (and window) get the new size"""
+        self._addEvent((EV_RESIZE, (width, height)))
+
+    def updateCursor(self, hotx, hoty, width, height, image, mask):
+        self._addEvent((EV_CURSOR, (hotx, hoty, width, height, bytes(image), bytes(mask))))
 
     def commitUpdate(self, rectangles=None):
         """called after a series of updateRectangle(), copyRectangle()
@@ -183,175 +668,1342 @@ class VNCClient(rfb.RFBClient):
            update with FramebufferUpdateRequest(incremental=1).
            argument is a list of tuples (x,y,w,h) with the updated
            rectangles."""
-        self.framebufferUpdateRequest(incremental=1)
+        self._commitFrame()
+        self.pacer.updateReceived(len(self.pending))
 
-    def nextEvents(self):
-        if len(self._events) <= 0:
-            return []
+    def _addEvent(self, ev):
+        if self.pending.add(ev):
+            # the waiting updates were dropped, start over
+            print("event queue full, requesting the whole screen")
+            self.pacer.start()
+
+    def _commitFrame(self):
+        if not self.pending.commit():
+            return
+        now = time.perf_counter()
+        requested = self.pacer.requestTime()
+        self.latency.committed(requested, self.updateStart, now)
+        self.commits.append((now, requested))
+        if len(self.commits) == 1:
+            self.firstCommitTime = now
+            self.firstRequestTime = requested
+        self.frameReady.set()
+
+    def nextFrames(self, limit=None):
+        """take complete frames, oldest first. a frame is the list of
+           events of one framebuffer update. at most limit frames are
+           returned, the others stay queued."""
+        frames = self.pending.take(limit)
+        for frame in frames:
+            self.commits.popleft()
+        if self.commits:
+            self.firstCommitTime, self.firstRequestTime = self.commits[0]
+        return frames
+
+    def hasFrames(self):
+        return len(self.pending) > 0
+
+
+class UpdatePacer:
+    """Sends the incremental framebuffer update requests at a target
+       rate, with at most max_requests in flight. When frames queue up
+       in front of the renderer the rate backs off."""
+
+    # requests without answer for this long were merged by the server
+    # (or nothing changed on the screen), they do not count any more
+    request_timeout = 1.0
+    max_backoff = 8.0
+    # interval stretched by the backoff without a target rate
+    # (frequency 0), up to max_backoff times
+    backoff_interval = 0.01
+
+    def __init__(self, client, frequency, max_requests=1):
+        self.client = client
+        self.interval = 1.0 / frequency if frequency else 0.0
+        self.maxRequests = max(1, max_requests)
+        self.backoff = 1.0
+        self.sent = collections.deque()     # send times of open requests
+        self.lastSent = 0.0
+        self.handle = None
+        self.updates = 0
+        self.rttSum = 0.0
+
+    def start(self):
+        """request the whole screen"""
+        self.client.framebufferUpdateRequest()
+        self.lastSent = time.perf_counter()
+        self.sent.append(self.lastSent)
+
+    def updateReceived(self, backlog):
+        """a framebuffer update is complete, backlog frames are waiting
+           for the renderer"""
+        now = time.perf_counter()
+        if self.sent:
+            self.rttSum += now - self.sent.popleft()
+            self.updates += 1
+        if backlog > 1:
+            self.backoff = min(self.backoff * 1.5, self.max_backoff)
+        else:
+            self.backoff = max(1.0, self.backoff * 0.9)
+        self._schedule()
+
+    def _schedule(self):
+        if self.handle is not None:
+            return
+        now = time.perf_counter()
+        while self.sent and now - self.sent[0] > self.request_timeout:
+            self.sent.popleft()
+        if len(self.sent) >= self.maxRequests:
+            # check again when the oldest request times out
+            delay = self.sent[0] + self.request_timeout - now
+        elif self.backoff > 1.0:
+            delay = self.lastSent + max(self.interval, self.backoff_interval) * self.backoff - now
+        else:
+            delay = self.lastSent + self.interval - now
+        if delay <= 0:
+            self._send()
+        else:
+            self.handle = self.client.loop.call_later(delay, self._send)
+
+    def _send(self):
+        self.handle = None
+        now = time.perf_counter()
+        while self.sent and now - self.sent[0] > self.request_timeout:
+            self.sent.popleft()
+        if len(self.sent) < self.maxRequests:
+            self.client.framebufferUpdateRequest(incremental=1)
+            self.lastSent = now
+            self.sent.append(now)
+            if len(self.sent) >= self.maxRequests:
+                return
+        self._schedule()
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def requestTime(self):
+        """send time of the oldest open request, the one the update
+           being received answers. None without open requests"""
+        now = time.perf_counter()
+        while self.sent and now - self.sent[0] > self.request_timeout:
+            self.sent.popleft()
+        return self.sent[0] if self.sent else None
+
+    def takeStats(self, elapsed):
+        """(updates per second, mean request to update time) since the
+           last call"""
+        fps = self.updates / elapsed if elapsed else 0.0
+        rtt = self.rttSum / self.updates if self.updates else 0.0
+        self.updates = 0
+        self.rttSum = 0.0
+        return fps, rtt
+
+
+class ThreadedVNCClient(VNCClient):
+    """VNCClient decoding in a thread. Received data is queued for the
+       decoder thread, complete frames come back to the loop, so input
+       handling does not wait for large updates. Backpressure goes to
+       the socket with pause_reading() / resume_reading()."""
+
+    def __init__(self, loop, renderer, option, frameReady=None):
+        VNCClient.__init__(self, loop, renderer, option, frameReady)
+        # events of the update being decoded, arrival of its data
+        self._events = []
+        self._received = None
+        self._updateStart = None
+        # (data, arrival time)
+        self._chunks = queue.SimpleQueue()
+        # received bytes not decoded yet
+        self._pending = 0
+        self._paused = False
+        self._thread = threading.Thread(target=self._decode, name='decoder', daemon=True)
+
+    def connection_made(self, transport):
+        VNCClient.connection_made(self, transport)
+        self._thread.start()
+
+    def data_received(self, data):
+        # recorded as it arrives, decoded in the thread
+        if self.capture is not None:
+            self.capture.write(data)
+        self._pending += len(data)
+        self._chunks.put((data, time.perf_counter()))
+        self._updateReading()
+
+    def connection_lost(self, exc):
+        VNCClient.connection_lost(self, exc)
+        self.pacer.stop()
+        self._chunks.put(None)
+
+    def _decode(self):
+        """decoder thread"""
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+            data, self._received = chunk
+            try:
+                self._receive(data)
+            except Exception:
+                self.loop.call_soon_threadsafe(self.transport.close)
+                raise
+            try:
+                self.loop.call_soon_threadsafe(self._decoded, len(data))
+            except RuntimeError:
+                # the loop is closed
+                return
+
+    def _decoded(self, size):
+        self._pending -= size
+        self._updateReading()
+
+    def _updateReading(self):
+        full = (self._pending > self.option.decoder_buffer or
+                len(self.pending) >= self.option.max_frames)
+        if full == self._paused or self.transport is None or self.transport.is_closing():
+            return
+        self._paused = full
+        if full:
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+
+    def _queue(self, message):
+        # client messages are sent from the loop
+        if threading.current_thread() is self._thread:
+            self.loop.call_soon_threadsafe(VNCClient._queue, self, message)
+        else:
+            VNCClient._queue(self, message)
+
+    def vncConnectionMade(self):
+        self.loop.call_soon_threadsafe(VNCClient.vncConnectionMade, self)
+
+    def _addEvent(self, ev):
+        if threading.current_thread() is self._thread:
+            self._events.append(ev)
+        else:
+            VNCClient._addEvent(self, ev)
+
+    def beginUpdate(self):
+        # decoder thread
+        self._updateStart = self._received
+
+    def commitUpdate(self, rectangles=None):
+        """decoder thread: hand the frame to the loop"""
+        events = self._events
+        self._events = []
+        self.loop.call_soon_threadsafe(self._committed, events, self._updateStart)
+
+    def _committed(self, events, started):
+        for ev in events:
+            VNCClient._addEvent(self, ev)
+        self.updateStart = started
+        self._commitFrame()
+        self.pacer.updateReceived(len(self.pending))
+        self._updateReading()
+
+    def nextFrames(self, limit=None):
+        frames = VNCClient.nextFrames(self, limit)
+        self._updateReading()
+        return frames
+
+
+class WorkerClient(VNCClient):
+    """VNCClient of a decoder process. Frames are written into a
+       SharedFramebuffer, the display process learns about them through
+       the pipe and sends the input messages back the same way."""
+
+    def __init__(self, loop, option, pipe):
+        VNCClient.__init__(self, loop, None, option)
+        # events of the update being received
+        self._events = []
+        self.pipe = pipe
+        self.shared = None
+        self.closed = loop.create_future()
+        loop.add_reader(pipe.fileno(), self._pipeReadable)
+
+    def _addEvent(self, ev):
+        self._events.append(ev)
+
+    def _commitFrame(self):
         evs = self._events
         self._events = []
-        return evs
+        if not evs:
+            return
+        shared = self.shared
+        for ev in evs:
+            if ev[0] == EV_UPDATE_RECT:
+                port, buf, pitch = ev[1]
+                shared.update(port.x, port.y, port.w, port.h, buf)
+            elif ev[0] == EV_FILL_RECT:
+                shared.fill(*ev[1])
+            elif ev[0] == EV_COPY_RECT:
+                shared.copy(*ev[1])
+            elif ev[0] == EV_CURSOR:
+                self.pipe.send(('cursor',) + ev[1])
+            elif ev[0] == EV_RESIZE:
+                width, height = ev[1]
+                bypp = self.bpp // 8
+                shared = shadowfb.SharedFramebuffer(width, height, bypp)
+                self.pipe.send(('resize', shared.name, width, height, bypp))
+                if self.shared is not None:
+                    # the display process keeps it mapped until it switches
+                    self.shared.close()
+                self.shared = shared
+        shared.publish()
+        # perf_counter() is the same clock in every process
+        self.pipe.send(('frame', time.perf_counter(), self.pacer.requestTime(), self.updateStart))
+
+    def _pipeReadable(self):
+        try:
+            while self.pipe.poll():
+                message = self.pipe.recv_bytes()
+                if self.transport is not None:
+                    # pointer events, coalesced like local ones
+                    self.sendPointerEvent(message)
+        except (EOFError, OSError):
+            # the display process is gone
+            self.loop.remove_reader(self.pipe.fileno())
+            if self.transport is not None:
+                self.transport.close()
+            elif not self.closed.done():
+                self.closed.set_result(None)
+
+    def connection_lost(self, exc):
+        VNCClient.connection_lost(self, exc)
+        self.pacer.stop()
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+
+def connect(loop, client, option):
+    """connects client to the server, or plays option.replay into it"""
+    if option.replay:
+        return capture.replay(client, option.replay.format(section=option.section),
+                              option.replay_speed, option.replay_start)
+    return loop.create_connection(lambda: client, option.host, option.port)
+
+
+def run_worker(option, pipe):
+    """decoder process for one MFD"""
+    asyncio.run(_worker(option, pipe))
+
+
+async def _worker(option, pipe):
+    loop = asyncio.get_running_loop()
+    client = WorkerClient(loop, option, pipe)
+    try:
+        await connect(loop, client, option)
+    except OSError as e:
+        pipe.send(('error', str(e)))
+        return
+    await client.closed
+    if client.shared is not None:
+        client.shared.close()
+    if client.profile is not None:
+        print("MFD %s profile:\n%s" % (option.section, client.profile.report()))
 
 
-def load_gui(option):
+class ProcessClient:
+    """Display side of an MFD decoded by a worker process, used like
+       VNCClient by the render loop. Frames carry no events, the dirty
+       rectangles come with the shared framebuffer."""
+
+    def __init__(self, loop, option, frameReady=None):
+        self.loop = loop
+        self.option = option
+        self._frames = []
+        self.frameReady = frameReady or asyncio.Event()
+        self.firstCommitTime = None
+        self.firstRequestTime = None
+        # (commit time, request send time) of every waiting frame
+        self._commits = []
+        # the worker paces its requests, the times come with the frames
+        self.pacer = None
+        self.latency = latency.Latency()
+        # done when the worker is connected or failed to
+        self.connected = loop.create_future()
+        # spawned, not forked from the running loop. the worker imports
+        # this script without running main(), SDL is not initialized
+        # there, and inherits no pipe ends of the other workers
+        context = multiprocessing.get_context('spawn')
+        self.pipe, pipe = context.Pipe()
+        self.process = context.Process(target=run_worker, args=(option, pipe), daemon=True)
+        self.process.start()
+        pipe.close()
+        loop.add_reader(self.pipe.fileno(), self._pipeReadable)
+
+    def _pipeReadable(self):
+        try:
+            while self.pipe.poll():
+                self._received(self.pipe.recv())
+        except (EOFError, OSError):
+            self.loop.remove_reader(self.pipe.fileno())
+            if not self.connected.done():
+                self.connected.set_exception(ConnectionError("decoder process exited"))
+
+    def _received(self, message):
+        if message[0] == 'frame':
+            self._queueFrame([], *message[1:])
+        elif message[0] == 'resize':
+            name, width, height, bypp = message[1:]
+            try:
+                shared = shadowfb.SharedFramebuffer(width, height, bypp, name)
+            except FileNotFoundError:
+                # already replaced, the next resize follows
+                return
+            self._queueFrame([(EV_RESIZE, (width, height, shared))], time.perf_counter())
+            if not self.connected.done():
+                self.connected.set_result(True)
+        elif message[0] == 'cursor':
+            self._queueFrame([(EV_CURSOR, message[1:])], time.perf_counter())
+        elif message[0] == 'error':
+            if not self.connected.done():
+                self.connected.set_exception(ConnectionError(message[1]))
+
+    def _queueFrame(self, evs, committed, requested=None, started=None):
+        self.latency.committed(requested, started, committed)
+        if not self._frames:
+            self.firstCommitTime = committed
+            self.firstRequestTime = requested
+        self._frames.append(evs)
+        self._commits.append((committed, requested))
+        self.frameReady.set()
+
+    def nextFrames(self, limit=None):
+        """take complete frames, oldest first, at most limit"""
+        if limit is None or len(self._frames) <= limit:
+            frames = self._frames
+            self._frames = []
+            self._commits = []
+        else:
+            frames = self._frames[:limit]
+            del self._frames[:limit]
+            del self._commits[:limit]
+            self.firstCommitTime, self.firstRequestTime = self._commits[0]
+        return frames
+
+    def hasFrames(self):
+        return len(self._frames) > 0
+
+    def pointerEvent(self, x, y, buttonmask=0):
+        self._send(pack_pointer_event(x, y, buttonmask))
+
+    def pressButton(self, button, down=True):
+        if down:
+            self.latency.pressed(time.perf_counter())
+        self._send(button.down if down else button.up)
+
+    def _send(self, message):
+        try:
+            self.pipe.send_bytes(message)
+        except OSError:
+            # the worker is gone (server disconnected, replay ended)
+            pass
+
+    def close(self):
+        """stop the worker, it disconnects when the pipe is closed"""
+        if not self.pipe.closed:
+            self.loop.remove_reader(self.pipe.fileno())
+            self.pipe.close()
+        self.process.join(1.0)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class TileAtlas:
+    """One texture of square slots of size pixels, the least recently
+       used slot is reused"""
+
+    def __init__(self, renderer, pformat, size, count):
+        self.size = size
+        self.columns = int(count ** 0.5 + 0.999)
+        rows = (count + self.columns - 1) // self.columns
+        self.texture = render.SDL_CreateTexture(renderer.sdlrenderer, pformat,
+                                                render.SDL_TEXTUREACCESS_STATIC,
+                                                self.columns * size, rows * size)
+        if not self.texture:
+            raise sdl2.ext.SDLError()
+        render.SDL_SetTextureBlendMode(self.texture, sdl2.SDL_BLENDMODE_NONE)
+        # (width, height, crc32) -> slot, least recently used first
+        self.slots = collections.OrderedDict()
+        # pixels of every slot, to tell crc32 collisions apart
+        self.data = [None] * count
+        self.free = list(range(count - 1, -1, -1))
+
+    def rect(self, slot, width, height):
+        return rect.SDL_Rect(slot % self.columns * self.size, slot // self.columns * self.size,
+                             width, height)
+
+    def destroy(self):
+        render.SDL_DestroyTexture(self.texture)
+
+
+class TileCache:
+    """Pixels of small rectangles uploaded before, kept in atlas
+       textures. A rectangle with the same size and bytes is copied from
+       the atlas instead of being uploaded again. One atlas per slot
+       size, each gets an equal share of max_bytes (texture and the
+       copy of the bytes)."""
+
+    SLOT_SIZES = (16, 32, 64)
+
+    def __init__(self, renderer, pformat, max_bytes):
+        self.renderer = renderer
+        self.pformat = pformat
+        self.maxBytes = max_bytes
+        self.atlases = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # upload bytes saved by hits
+        self.saved = 0
+
+    def _createAtlases(self):
+        bypp = sdl2.pixels.SDL_BYTESPERPIXEL(self.pformat)
+        share = self.maxBytes // len(self.SLOT_SIZES)
+        info = render.SDL_RendererInfo()
+        if render.SDL_GetRendererInfo(self.renderer.sdlrenderer, ctypes.byref(info)) != 0:
+            raise sdl2.ext.SDLError()
+        # 0: no limit (software renderer)
+        limit = min(info.max_texture_width or 16384, info.max_texture_height or 16384)
+        self.atlases = []
+        for size in self.SLOT_SIZES:
+            count = min(share // (2 * size * size * bypp), (limit // size) ** 2)
+            if count:
+                self.atlases.append(TileAtlas(self.renderer, self.pformat, size, count))
+
+    def draw(self, port, buf, pitch):
+        """copy the pixels buf of port to the render target through the
+           atlas. False when port is too large to be cached"""
+        if self.atlases is None:
+            self._createAtlases()
+        width, height = port.w, port.h
+        longest = width if width > height else height
+        for atlas in self.atlases:
+            if longest <= atlas.size:
+                break
+        else:
+            return False
+        key = (width, height, zlib.crc32(buf))
+        slot = atlas.slots.get(key)
+        if slot is not None and atlas.data[slot] == buf:
+            atlas.slots.move_to_end(key)
+            self.hits += 1
+            self.saved += len(buf)
+        else:
+            self.misses += 1
+            if slot is None:
+                if atlas.free:
+                    slot = atlas.free.pop()
+                else:
+                    evicted, slot = atlas.slots.popitem(last=False)
+                    self.evictions += 1
+                atlas.slots[key] = slot
+            # else a crc32 collision, the slot gets the new pixels
+            atlas.data[slot] = bytes(buf)
+            render.SDL_UpdateTexture(atlas.texture, atlas.rect(slot, width, height),
+                                     pixel_pointer(buf), pitch)
+        render.SDL_RenderCopy(self.renderer.sdlrenderer, atlas.texture,
+                              atlas.rect(slot, width, height), port)
+        return True
+
+    def clear(self):
+        """free the atlases, they are made again on the next draw"""
+        if self.atlases is not None:
+            for atlas in self.atlases:
+                atlas.destroy()
+            self.atlases = None
+
+    def takeStats(self):
+        """(hits, misses, evictions, saved bytes) since the last call"""
+        stats = self.hits, self.misses, self.evictions, self.saved
+        self.hits = self.misses = self.evictions = self.saved = 0
+        return stats
+
+
+class Framebuffer:
+    """Remote screen kept in one persistent render target texture.
+       Rectangles are written into the texture as they arrive, a frame
+       is shown with a single copy.
+       With shadow, rectangles go to a ShadowFramebuffer in memory and
+       the dirty region is uploaded before drawing. Otherwise, with
+       tile_cache bytes, small rectangles go through a TileCache."""
+
+    def __init__(self, renderer, pformat=sdl2.pixels.SDL_PIXELFORMAT_BGR888, shadow=False,
+                 tile_cache=0):
+        self.renderer = renderer
+        self.pformat = pformat
+        self.width = 0
+        self.height = 0
+        self.texture = None
+        self.useShadow = shadow
+        self.shadow = None
+        # second texture for copyrect, SDL can not copy a texture onto itself
+        self.scratch = None
+        # packed color -> (r, g, b)
+        self.colors = {}
+        self.sdlformat = sdl2.pixels.SDL_AllocFormat(pformat)
+        # SDL cursor from the server
+        self.cursor = None
+        self.tiles = TileCache(renderer, pformat, tile_cache) if tile_cache and not shadow else None
+
+    def _createTexture(self):
+        texture = render.SDL_CreateTexture(self.renderer.sdlrenderer, self.pformat,
+                                           render.SDL_TEXTUREACCESS_TARGET,
+                                           self.width, self.height)
+        if not texture:
+            raise sdl2.ext.SDLError()
+        render.SDL_SetTextureBlendMode(texture, sdl2.SDL_BLENDMODE_NONE)
+        return texture
+
+    def resize(self, width, height, shadow=None):
+        """(re)allocate the texture, only needed when the remote
+           screen size changes. shadow: use this ShadowFramebuffer
+           (shared with a decoder process)"""
+        # the cursor does not depend on the screen size, it is kept
+        # until the server sends another one
+        self._destroyScreen()
+        self.width = width
+        self.height = height
+        self.texture = self._createTexture()
+        sdlrenderer = self.renderer.sdlrenderer
+        render.SDL_SetRenderTarget(sdlrenderer, self.texture)
+        render.SDL_SetRenderDrawColor(sdlrenderer, 0, 0, 0, 255)
+        render.SDL_RenderClear(sdlrenderer)
+        render.SDL_SetRenderTarget(sdlrenderer, None)
+        if shadow is not None:
+            self.shadow = shadow
+        elif self.useShadow:
+            self.shadow = shadowfb.ShadowFramebuffer(
+                width, height, sdl2.pixels.SDL_BYTESPERPIXEL(self.pformat))
+
+    def destroy(self):
+        self._destroyScreen()
+        if self.cursor:
+            mouse.SDL_FreeCursor(self.cursor)
+            self.cursor = None
+
+    def _destroyScreen(self):
+        """textures and memory of the remote screen"""
+        if self.texture:
+            render.SDL_DestroyTexture(self.texture)
+            self.texture = None
+        if self.scratch:
+            render.SDL_DestroyTexture(self.scratch)
+            self.scratch = None
+        if self.shadow is not None:
+            self.shadow.close()
+            self.shadow = None
+        if self.tiles is not None:
+            self.tiles.clear()
+
+    def apply(self, evs):
+        """write a list of client events into the texture"""
+        if self.useShadow:
+            self._applyShadow(evs)
+            return
+        sdlrenderer = self.renderer.sdlrenderer
+        render.SDL_SetRenderTarget(sdlrenderer, self.texture)
+        tiles = self.tiles
+        # fills and copies are batched by SDL, uploads are done at once:
+        # the batch is flushed before an upload to keep the event order
+        queued = False
+        for ev in evs:
+            if ev[0] == EV_UPDATE_RECT:
+                port, buf, pitch = ev[1]
+                if tiles is not None and tiles.draw(port, buf, pitch):
+                    # copied from the atlas, batched
+                    queued = True
+                    continue
+                if queued:
+                    render.SDL_RenderFlush(sdlrenderer)
+                    queued = False
+                render.SDL_UpdateTexture(self.texture, port, pixel_pointer(buf), pitch)
+            elif ev[0] == EV_FILL_RECT:
+                color, rectangles = ev[1]
+                self.fill(color, rectangles)
+                queued = True
+            elif ev[0] == EV_COPY_RECT:
+                srcx, srcy, x, y, width, height = ev[1]
+                self.copy(srcx, srcy, x, y, width, height)
+                queued = True
+            elif ev[0] == EV_RESIZE:
+                # the clear is batched too
+                self.resize(*ev[1])
+                render.SDL_SetRenderTarget(sdlrenderer, self.texture)
+                queued = True
+            elif ev[0] == EV_CURSOR:
+                self.setCursor(*ev[1])
+        render.SDL_SetRenderTarget(sdlrenderer, None)
+
+    def _applyShadow(self, evs):
+        for ev in evs:
+            if ev[0] == EV_UPDATE_RECT:
+                port, buf, pitch = ev[1]
+                self.shadow.update(port.x, port.y, port.w, port.h, buf)
+            elif ev[0] == EV_FILL_RECT:
+                color, rectangles = ev[1]
+                self.shadow.fill(color, rectangles)
+            elif ev[0] == EV_COPY_RECT:
+                self.shadow.copy(*ev[1])
+            elif ev[0] == EV_RESIZE:
+                self.resize(*ev[1])
+            elif ev[0] == EV_CURSOR:
+                self.setCursor(*ev[1])
+
+    def upload(self):
+        """upload the dirty region of the shadow framebuffer"""
+        bypp = self.shadow.bypp
+        pitch = self.width * bypp
+        base = self.shadow.pixels.ctypes.data
+        for (x, y, width, height) in self.shadow.takeDirty():
+            render.SDL_UpdateTexture(self.texture, rect.SDL_Rect(x, y, width, height),
+                                     ctypes.c_void_p(base + y * pitch + x * bypp), pitch)
+
+    def mapColor(self, color):
+        """packed pixel (texture format) -> (r, g, b), cached"""
+        rgb = self.colors.get(color)
+        if rgb is None:
+            r, g, b = sdl2.Uint8(), sdl2.Uint8(), sdl2.Uint8()
+            sdl2.pixels.SDL_GetRGB(int.from_bytes(color, sys.byteorder), self.sdlformat,
+                                   ctypes.byref(r), ctypes.byref(g), ctypes.byref(b))
+            rgb = self.colors[color] = (r.value, g.value, b.value)
+        return rgb
+
+    def fill(self, color, rectangles):
+        """fill a list of (x, y, width, height) with one SDL call"""
+        sdlrenderer = self.renderer.sdlrenderer
+        r, g, b = self.mapColor(color)
+        render.SDL_SetRenderDrawColor(sdlrenderer, r, g, b, 255)
+        count = len(rectangles)
+        ints = array.array('i', itertools.chain.from_iterable(rectangles))
+        render.SDL_RenderFillRects(sdlrenderer, (rect.SDL_Rect * count).from_buffer(ints), count)
+
+    def copy(self, srcx, srcy, x, y, width, height):
+        """copy a region of the texture, going through the scratch texture"""
+        sdlrenderer = self.renderer.sdlrenderer
+        if not self.scratch:
+            self.scratch = self._createTexture()
+        src = rect.SDL_Rect(srcx, srcy, width, height)
+        render.SDL_SetRenderTarget(sdlrenderer, self.scratch)
+        render.SDL_RenderCopy(sdlrenderer, self.texture, src, src)
+        render.SDL_SetRenderTarget(sdlrenderer, self.texture)
+        render.SDL_RenderCopy(sdlrenderer, self.scratch, src,
+                              rect.SDL_Rect(x, y, width, height))
+
+    def setCursor(self, hotx, hoty, width, height, image, mask):
+        """SDL color cursor from the server cursor, the mask becomes
+           the alpha channel"""
+        if self.cursor:
+            mouse.SDL_FreeCursor(self.cursor)
+            self.cursor = None
+        if not width or not height:
+            # no cursor, a transparent pixel
+            width, height = 1, 1
+            image = bytes(sdl2.pixels.SDL_BYTESPERPIXEL(self.pformat))
+            mask = b'\0'
+        bypp = sdl2.pixels.SDL_BYTESPERPIXEL(self.pformat)
+        pixels = ctypes.create_string_buffer(bytes(image), len(image))
+        source = surface.SDL_CreateRGBSurfaceWithFormatFrom(pixels, width, height, bypp * 8,
+                                                            width * bypp, self.pformat)
+        shape = surface.SDL_ConvertSurfaceFormat(source, sdl2.pixels.SDL_PIXELFORMAT_ARGB8888, 0)
+        surface.SDL_FreeSurface(source)
+        if not shape:
+            raise sdl2.ext.SDLError()
+        stride = (width + 7) // 8
+        pitch = shape.contents.pitch
+        argb = (ctypes.c_char * (pitch * height)).from_address(shape.contents.pixels)
+        # alpha is the high byte of the native endian pixel
+        alpha = 3 if sys.byteorder == 'little' else 0
+        for y in range(height):
+            row = b''.join([_MASK_ALPHA[byte] for byte in mask[y * stride:(y + 1) * stride]])
+            start = y * pitch + alpha
+            argb[start:start + width * 4:4] = row[:width]
+        self.cursor = mouse.SDL_CreateColorCursor(shape, hotx, hoty)
+        surface.SDL_FreeSurface(shape)
+
+    def draw(self, x=0, y=0):
+        """copy the whole framebuffer to the window at x, y"""
+        if self.shadow is not None:
+            self.upload()
+        if self.texture:
+            render.SDL_RenderCopy(self.renderer.sdlrenderer, self.texture,
+                                  rect.SDL_Rect(0, 0, self.width, self.height),
+                                  rect.SDL_Rect(x, y, self.width, self.height))
+
+
+class LoopStats:
+    """Idle CPU load and update to present latency of the render loop,
+       printed every interval seconds."""
+
+    def __init__(self, interval=5.0, clients=None, framebuffers=None):
+        self.interval = interval
+        # MFD name -> VNCClient or ProcessClient
+        self.clients = clients or {}
+        # MFD name -> Framebuffer
+        self.framebuffers = framebuffers or {}
+        self._reset(time.perf_counter())
+
+    def _reset(self, now):
+        self.start = now
+        self.idleWall = 0.0
+        self.idleCPU = 0.0
+        self.presents = 0
+        self.latencySum = 0.0
+        self.latencyMax = 0.0
+
+    def idle(self, wall, cpu):
+        """a loop pass without frames or input"""
+        self.idleWall += wall
+        self.idleCPU += cpu
+
+    def presented(self, latency):
+        self.presents += 1
+        self.latencySum += latency
+        self.latencyMax = max(self.latencyMax, latency)
+
+    def report(self, now):
+        if now - self.start < self.interval:
+            return
+        idle = 100.0 * self.idleCPU / self.idleWall if self.idleWall else 0.0
+        mean = self.latencySum / self.presents if self.presents else 0.0
+        print("stats: idle cpu %.1f%%, %d presents, update to present %.2f ms (max %.2f ms)" %
+              (idle, self.presents, mean * 1000, self.latencyMax * 1000))
+        for name, client in self.clients.items():
+            pacer = client.pacer
+            if pacer is not None:
+                fps, rtt = pacer.takeStats(now - self.start)
+                print("stats: %s %.1f updates/s, request to update %.2f ms, backoff %.1f" %
+                      (name, fps, rtt * 1000, pacer.backoff))
+            if isinstance(client, rfb.RFBClient):
+                print("stats: %s %d client events, %d messages sent in %d writes" %
+                      (name, client.eventsReceived, client.messagesSent, client.writes))
+                if client.profile is not None:
+                    profile = client.profile
+                    print("stats: %s %d chunks received, %d too short to decode" %
+                          (name, profile.chunks, profile.shortReads))
+        for name, framebuffer in self.framebuffers.items():
+            if framebuffer.tiles is not None:
+                hits, misses, evictions, saved = framebuffer.tiles.takeStats()
+                print("stats: %s tile cache %d hits, %d misses, %d evictions, %.1f kB not uploaded" %
+                      (name, hits, misses, evictions, saved / 1024))
+        self._reset(now)
+
+
+# 3x5 pixel font of the latency overlay, only the characters it uses
+FONT = {
+    '0': ('###', '#.#', '#.#', '#.#', '###'),
+    '1': ('.#.', '##.', '.#.', '.#.', '###'),
+    '2': ('###', '..#', '###', '#..', '###'),
+    '3': ('###', '..#', '###', '..#', '###'),
+    '4': ('#.#', '#.#', '###', '..#', '..#'),
+    '5': ('###', '#..', '###', '..#', '###'),
+    '6': ('###', '#..', '###', '#.#', '###'),
+    '7': ('###', '..#', '..#', '..#', '..#'),
+    '8': ('###', '#.#', '###', '#.#', '###'),
+    '9': ('###', '#.#', '###', '..#', '###'),
+    '.': ('...', '...', '...', '...', '.#.'),
+    '-': ('...', '...', '###', '...', '...'),
+    'A': ('.#.', '#.#', '###', '#.#', '#.#'),
+    'B': ('##.', '#.#', '##.', '#.#', '##.'),
+    'C': ('###', '#..', '#..', '#..', '###'),
+    'E': ('###', '#..', '##.', '#..', '###'),
+    'I': ('###', '.#.', '.#.', '.#.', '###'),
+    'L': ('#..', '#..', '#..', '#..', '###'),
+    'M': ('#.#', '###', '###', '#.#', '#.#'),
+    'N': ('##.', '#.#', '#.#', '#.#', '#.#'),
+    'O': ('###', '#.#', '#.#', '#.#', '###'),
+    'P': ('###', '#.#', '###', '#..', '#..'),
+    'R': ('##.', '#.#', '##.', '#.#', '#.#'),
+    'S': ('###', '#..', '###', '..#', '###'),
+    'T': ('###', '.#.', '.#.', '.#.', '.#.'),
+    'U': ('#.#', '#.#', '#.#', '#.#', '###'),
+    'X': ('#.#', '#.#', '.#.', '#.#', '#.#'),
+    'Y': ('#.#', '#.#', '.#.', '.#.', '.#.'),
+}
+
+
+class LatencyOverlay:
+    """Latency percentiles of an MFD drawn over its screen, with
+       rectangles of the FONT glyphs. The text is rebuilt at most every
+       refresh seconds."""
+
+    LABELS = (('first_byte', "BYTE"), ('commit', "COMMIT"),
+              ('present', "PRESENT"), ('button', "BUTTON"))
+    refresh = 0.5
+
+    def __init__(self, scale=2):
+        self.scale = scale
+        # glyph -> (x, y, width, 1) runs in font pixels
+        self.glyphs = {}
+        for char, rows in FONT.items():
+            runs = []
+            for y, row in enumerate(rows):
+                for match in re.finditer('#+', row):
+                    runs.append((match.start(), y, match.end() - match.start(), 1))
+            self.glyphs[char] = runs
+        # Latency -> (time, text rectangles, background)
+        self.cache = {}
+
+    def lines(self, summary):
+        lines = ["LATENCY MS  P50    P99    MAX"]
+        for name, label in self.LABELS:
+            values = summary[name]
+            if values is None:
+                lines.append("%-8s%7s%7s%7s" % (label, '-', '-', '-'))
+            else:
+                lines.append("%-8s%7.1f%7.1f%7.1f" %
+                             (label, values['p50'], values['p99'], values['max']))
+        return lines
+
+    def _layout(self, lines, x, y):
+        """text rectangles and background at x, y"""
+        scale = self.scale
+        ints = array.array('i')
+        for row, line in enumerate(lines):
+            for column, char in enumerate(line):
+                for left, top, width, height in self.glyphs.get(char, ()):
+                    ints.extend((x + (1 + column * 4 + left) * scale,
+                                 y + (1 + row * 6 + top) * scale,
+                                 width * scale, height * scale))
+        width = (max(len(line) for line in lines) * 4 + 1) * scale
+        return ints, rect.SDL_Rect(x, y, width, (len(lines) * 6 + 1) * scale)
+
+    def draw(self, renderer, x, y, stats, now):
+        """stats: latency.Latency of the MFD drawn at x, y"""
+        cached = self.cache.get(stats)
+        if cached is None or now - cached[0] >= self.refresh or cached[1] != (x, y):
+            cached = self.cache[stats] = ((now, (x, y)) +
+                                          self._layout(self.lines(stats.summary(now)), x, y))
+        when, position, ints, background = cached
+        sdlrenderer = renderer.sdlrenderer
+        render.SDL_SetRenderDrawBlendMode(sdlrenderer, sdl2.SDL_BLENDMODE_BLEND)
+        render.SDL_SetRenderDrawColor(sdlrenderer, 0, 0, 0, 160)
+        render.SDL_RenderFillRect(sdlrenderer, background)
+        render.SDL_SetRenderDrawBlendMode(sdlrenderer, sdl2.SDL_BLENDMODE_NONE)
+        count = len(ints) // 4
+        render.SDL_SetRenderDrawColor(sdlrenderer, 255, 255, 0, 255)
+        render.SDL_RenderFillRects(sdlrenderer, (rect.SDL_Rect * count).from_buffer(ints), count)
+
+
+def latency_report(sessions, now):
+    """one JSON log line: the latency percentiles of every MFD with
+       the settings they depend on"""
+    report = {'time': round(time.time(), 3), 'mfd': {}}
+    for session in sessions:
+        option = session.option
+        report['mfd'][option.section] = {
+            'encoding': list(option.encoding),
+            'pixel_format': option.pixel_format,
+            'update_frequency': option.update_frequency,
+            'max_requests': option.max_requests,
+            'decoder': ('process' if option.processes else
+                        'thread' if option.decoder_thread else 'loop'),
+            'latency': session.client.latency.summary(now),
+        }
+    return json.dumps(report, sort_keys=True)
+
+
+class Session:
+    """One MFD: its connection, framebuffer and place on the screen."""
+
+    def __init__(self, option, window, renderer, x=0, y=0):
+        self.option = option
+        self.window = window
+        self.renderer = renderer
+        self.x = x
+        self.y = y
+        self.client = None
+        if option.shadow and shadowfb is None:
+            print("numpy is not installed, no shadow framebuffer")
+        # the pixels of a decoder process are always in a shadow
+        self.framebuffer = Framebuffer(renderer, PIXEL_FORMATS[option.pixel_format][1],
+                                       shadow=(option.shadow or option.processes) and
+                                       shadowfb is not None,
+                                       tile_cache=option.tile_cache)
+
+    def contains(self, window, x, y):
+        """window: SDL window id"""
+        return (window == sdl2.SDL_GetWindowID(self.window.window) and
+                self.x <= x < self.x + self.option.width and
+                self.y <= y < self.y + self.option.height)
+
+
+def load_gui(options):
+    """windows and renderers for the MFDs, returns the sessions"""
     sdl2.ext.init()
-    # fl was here
-    window = sdl2.ext.Window("VNC Viewer [%s]" % (option.remote_url()), size=(
-        option.width, option.height), position=(0, 0), flags=fl)
-    window.show()
+    flags = sdl2.render.SDL_RENDERER_SOFTWARE
+    title = "VNC Viewer [%s]" % ", ".join(option.remote_url() for option in options)
+    sessions = []
+    if options[0].layout == 'windows':
+        # one window per MFD, on its own display if there are enough
+        displays = sdl2.SDL_GetNumVideoDisplays()
+        for i, option in enumerate(options):
+            bounds = rect.SDL_Rect()
+            if i < displays and sdl2.SDL_GetDisplayBounds(i, bounds) == 0:
+                position = (bounds.x, bounds.y)
+            else:
+                position = (i * option.width, 0)
+            window = sdl2.ext.Window(title, size=(option.width, option.height),
+                                     position=position, flags=fl)
+            window.show()
+            sessions.append(Session(option, window, sdl2.ext.Renderer(window, flags=flags)))
+    else:
+        # side by side in one window, sharing renderer and present
+        width = sum(option.width for option in options)
+        height = max(option.height for option in options)
+        window = sdl2.ext.Window(title, size=(width, height), position=(0, 0), flags=fl)
+        window.show()
+        renderer = sdl2.ext.Renderer(window, flags=flags)
+        x = 0
+        for option in options:
+            sessions.append(Session(option, window, renderer, x, 0))
+            x += option.width
     #print("windows size")
     #print(window.size)
-    return window
+    return sessions
+
+
+def resize_sessions(sessions):
+    """an MFD screen changed size: window sizes and positions follow
+       the framebuffers"""
+    for session in sessions:
+        session.option.width = session.framebuffer.width
+        session.option.height = session.framebuffer.height
+    if sessions[0].option.layout == 'windows':
+        for session in sessions:
+            sdl2.SDL_SetWindowSize(session.window.window,
+                                   session.option.width, session.option.height)
+    else:
+        x = 0
+        for session in sessions:
+            session.x = x
+            x += session.option.width
+        sdl2.SDL_SetWindowSize(sessions[0].window.window, x,
+                               max(session.option.height for session in sessions))
 
 
-async def run_gui(window, renderer, client):
+def load_keypad(option):
+    """keypad backend for option.keypad, None without keypad"""
+    if option.keypad == 'matrix':
+        return keypad.MatrixBackend(KEYPAD_ROWS, KEYPAD_COLS, KEYPAD_KEYS)
+    if option.keypad == 'simulated':
+        return keypad.SimulatedBackend()
+    return None
+
+
+async def run_gui(sessions, wake, backend=None):
+    """sessions: connected MFDs, wake: the clients frameReady event,
+       backend: keypad. loop settings are taken from the first MFD"""
+    option = sessions[0].option
     running = True
     in_present = False
     buttons = 0
+    # session receiving the pointer events while a mouse button is held
+    target = None
+    # soft button held with the mouse / touch screen
+    pressed = None
+    # session under the pointer and the cursor shown for it
+    hovered = None
+    cursor = None
+    # draw every MFD on the next pass (the overlay was toggled)
+    redraw = False
 
-    waspressed = ['a', 'b']
-    waspressed.clear()
-    
-    renderer.clear()
+    renderers = []
+    for session in sessions:
+        if session.renderer not in renderers:
+            renderers.append(session.renderer)
+    for renderer in renderers:
+        renderer.clear()
     if rpi:
         sdl2.SDL_ShowCursor(0)
     else :
         sdl2.SDL_ShowCursor(1)
 
-    factory = sdl2.ext.SpriteFactory(sdl2.ext.TEXTURE, renderer=renderer)
-    #pformat = sdl2.pixels.SDL_AllocFormat(sdl2.pixels.SDL_PIXELFORMAT_RGB888)
-    pformat = sdl2.pixels.SDL_AllocFormat(sdl2.pixels.SDL_PIXELFORMAT_BGR888)
+    clients = {session.option.section: session.client for session in sessions}
+    framebuffers = {session.option.section: session.framebuffer for session in sessions}
+    stats = LoopStats(clients=clients, framebuffers=framebuffers) if option.stats else None
+    overlay = LatencyOverlay() if option.overlay else None
+    logged = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    idle = False
+    interval = option.input_interval
 
-    while running:
-        evs = client.nextEvents()
-        need_update = len(evs) > 0
-        for ev in evs:
-            if ev[0] == EV_RESIZE:
-                pass
-            elif ev[0] == EV_UPDATE_RECT:
-                port, buf, pitch = ev[1]
-                #texture = factory.create_texture_sprite(renderer, (port.w, port.h), pformat=sdl2.pixels.SDL_PIXELFORMAT_RGB888, access=render.SDL_TEXTUREACCESS_STREAMING)
-                texture = factory.create_texture_sprite(renderer, (port.w, port.h), pformat=sdl2.pixels.SDL_PIXELFORMAT_BGR888, access=render.SDL_TEXTUREACCESS_STREAMING)
-                tport = sdl2.SDL_Rect()
-                tport.x = 0
-                tport.y = 0
-                tport.w = port.w
-                tport.h = port.h
-                render.SDL_UpdateTexture(texture.texture, tport, buf, pitch)
-                renderer.copy(texture, (0, 0, port.w, port.h), (port.x, port.y, port.w, port.h))
-                #renderer.copy(texture, (0, 0, port.w * 2, port.h * 2), (port.x *2 , port.y *2 , port.w * 2, port.h *2))
-            elif ev[0] == EV_COPY_RECT:
-                srcx, srcy, x, y, width, height = ev[1]
-                texture = factory.from_surface(window.get_surface())
-                renderer.copy(texture, (srcx, srcy, width, height), (x, y, width, height))
-                renderer.copy(texture, (srcx, srcy, width, height), (x, y, width * 2, height * 2))
-            elif ev[0] == EV_FILL_RECT:
-                port, color = ev[1]
-                pcolor = sdl2.pixels.SDL_MapRGBA(pformat, color.r, color.g, color.b, color.a)
-                renderer.fill(port, pcolor)
-
-        if need_update:
-            in_present = True
-            renderer.present()
-
-        events = sdl2.ext.get_events()
-        for event in events:
-            if event.type == sdl2.SDL_QUIT:
-                running = False
-                break
+    def buttonSession(key):
+        for session in sessions:
+            button = session.option.buttons.button(key)
+            if button is not None:
+                return session, button
+        return None, None
 
-            if in_present is False:
-                continue
+    chords = list(itertools.chain.from_iterable(
+        session.option.buttons.chords() for session in sessions))
+    keyboard = keypad.Chords(chords)
 
-            if event.type == sdl2.SDL_MOUSEMOTION:
-                x = event.motion.x
-                y = event.motion.y
-                client.pointerEvent( x, y, buttons)
-                #client.pointerEvent( int(x / 2), int(y / 2), buttons)
-            if event.type == sdl2.SDL_MOUSEBUTTONDOWN:
-                e = event.button
-
-                if e.button == 1:
-                    buttons |= 1
-                elif e.button == 2:
-                    buttons |= 2
-                elif e.button == 3:
-                    buttons |= 4
-                elif e.button == 4:
-                    buttons |= 8
-                elif e.button == 5:
-                    buttons |= 16
-
-                client.pointerEvent( e.x, e.y, buttons)
-                #client.pointerEvent( int(e.x / 2), int(e.y / 2), buttons)
-            if event.type == sdl2.SDL_MOUSEBUTTONUP:
-                e = event.button
-
-                if e.button == 1:
-                    buttons &= ~1
-                elif e.button == 2:
-                    buttons &= ~2
-                elif e.button == 3:
-                    buttons &= ~4
-                elif e.button == 4:
-                    buttons &= ~8
-                elif e.button == 5:
-                    buttons &= ~16
-
-                client.pointerEvent( e.x, e.y, buttons)
-                #client.pointerEvent( int(e.x / 2), int(e.y / 2) , buttons)
-                #print("MouseX = ", x, "\tMouseX = ", y)
-
-            if event.type == sdl2.SDL_KEYDOWN or event.type == sdl2.SDL_KEYUP: 
-                x,y = key2xy(event.key.keysym.sym)
-                print("keyX = ", x, "\tkeyY = ", y)
-                if event.type == sdl2.SDL_KEYDOWN:
-                    client.pointerEvent(x, y, 1)
-                else:
-                    client.pointerEvent(x, y, 0)
-
-        # here is loop
-        #print(time.time())
-        if rpi:
-            pressedkeys = keypad.pressed_keys
-            if pressedkeys:
-                string = "".join(pressedkeys)
-                kx,ky = key2xy(ord(string))
-                waspressed.append( [kx, ky] )
-                client.pointerEvent(kx, ky, 1)
-                #print("waspresed: ", waspressed)
-                #print("down, key: ", pressedkeys)
-                print("matrix down x, y: ", kx, ky)
+    def keypadEdge(key, down):
+        """called in the loop by the keypad thread"""
+        nonlocal interval
+        interval = option.input_interval
+        for action, state in matrix.edge(keysym(key), down):
+            session, button = buttonSession(action)
+            if button is not None:
+                session.client.pressButton(button, state)
+                print("matrix %s: " % ("down" if state else " up"),
+                      session.option.section, button.number)
+
+    scanner = None
+    if backend is not None:
+        matrix = keypad.Chords(chords)
+        scanner = keypad.KeypadScanner(backend, asyncio.get_running_loop(), keypadEdge,
+                                       option.keypad_rate, option.keypad_debounce)
+        scanner.start()
+
+    try:
+        while running:
+            now = time.perf_counter()
+            if stats:
+                # the previous pass, including its wait
+                now_cpu = time.process_time()
+                if idle:
+                    stats.idle(now - wall, now_cpu - cpu)
+                wall, cpu = now, now_cpu
+                stats.report(now)
+            if option.latency_log and now - logged >= option.latency_log:
+                logged = now
+                print(latency_report(sessions, now), flush=True)
+            # only complete framebuffer updates are applied, at most one
+            # present per server frame. all MFDs are presented together
+            wake.clear()
+            committed = None
+            updated = []
+            # clients with frames applied, send time of their oldest request
+            requested = []
+            resized = False
+            for session in sessions:
+                client = session.client
+                if not client.hasFrames():
+                    continue
+                if committed is None or client.firstCommitTime < committed:
+                    committed = client.firstCommitTime
+                requested.append((client, client.firstRequestTime))
+                for evs in client.nextFrames(None if option.skip_frames else 1):
+                    session.framebuffer.apply(evs)
+                if client.hasFrames():
+                    wake.set()
+                updated.append(session.renderer)
+                framebuffer = session.framebuffer
+                if (framebuffer.width, framebuffer.height) != (session.option.width, session.option.height):
+                    resized = True
+            if resized or redraw:
+                if resized:
+                    resize_sessions(sessions)
+                for renderer in renderers:
+                    renderer.clear()
+                updated = renderers
+                redraw = False
+            if hovered is not None and hovered.framebuffer.cursor not in (None, cursor):
+                cursor = hovered.framebuffer.cursor
+                mouse.SDL_SetCursor(cursor)
+            need_update = len(updated) > 0
+            if need_update:
+                # the back buffer is undefined after a present, draw all
+                for session in sessions:
+                    if session.renderer in updated:
+                        session.framebuffer.draw(session.x, session.y)
+                        if overlay is not None:
+                            overlay.draw(session.renderer, session.x, session.y,
+                                         session.client.latency, now)
+                for renderer in renderers:
+                    if renderer in updated:
+                        renderer.present()
+                in_present = True
+                presented = time.perf_counter()
+                for client, sent in requested:
+                    client.latency.presented(sent, presented)
+                if stats and committed is not None:
+                    stats.presented(presented - committed)
+
+            events = sdl2.ext.get_events()
+            for event in events:
+                if event.type == sdl2.SDL_QUIT:
+                    running = False
+                    break
+
+                if in_present is False:
+                    continue
+
+                if event.type == sdl2.SDL_MOUSEMOTION:
+                    e = event.motion
+                    session = target
+                    if session is None:
+                        session = next((s for s in sessions if s.contains(e.windowID, e.x, e.y)), None)
+                    if session is not hovered:
+                        hovered = session
+                        if session is not None and session.framebuffer.cursor not in (None, cursor):
+                            cursor = session.framebuffer.cursor
+                            mouse.SDL_SetCursor(cursor)
+                    if pressed is None and session is not None:
+                        client = session.client
+                        client.pointerEvent( e.x - session.x, e.y - session.y, buttons)
+                    #client.pointerEvent( int(x / 2), int(y / 2), buttons)
+                if event.type == sdl2.SDL_MOUSEBUTTONDOWN:
+                    e = event.button
+                    session = target
+                    if session is None:
+                        session = next((s for s in sessions if s.contains(e.windowID, e.x, e.y)), None)
+                    if session is None:
+                        continue
+                    x = e.x - session.x
+                    y = e.y - session.y
+
+                    if e.button == 1 and buttons == 0:
+                        # a touch on a soft button presses its center
+                        button = session.option.buttons.buttonAt(x, y)
+                        if button is not None:
+                            pressed = (session, button)
+                            session.client.pressButton(button, True)
+                            continue
+
+                    if e.button == 1:
+                        buttons |= 1
+                    elif e.button == 2:
+                        buttons |= 2
+                    elif e.button == 3:
+                        buttons |= 4
+                    elif e.button == 4:
+                        buttons |= 8
+                    elif e.button == 5:
+                        buttons |= 16
+
+                    target = session
+                    session.client.pointerEvent( x, y, buttons)
+                    #client.pointerEvent( int(e.x / 2), int(e.y / 2), buttons)
+                if event.type == sdl2.SDL_MOUSEBUTTONUP:
+                    e = event.button
+
+                    if e.button == 1 and pressed is not None:
+                        session, button = pressed
+                        session.client.pressButton(button, False)
+                        pressed = None
+                        continue
+                    if target is None:
+                        continue
+                    session = target
+
+                    if e.button == 1:
+                        buttons &= ~1
+                    elif e.button == 2:
+                        buttons &= ~2
+                    elif e.button == 3:
+                        buttons &= ~4
+                    elif e.button == 4:
+                        buttons &= ~8
+                    elif e.button == 5:
+                        buttons &= ~16
+
+                    session.client.pointerEvent( e.x - session.x, e.y - session.y, buttons)
+                    if buttons == 0:
+                        target = None
+                    #client.pointerEvent( int(e.x / 2), int(e.y / 2) , buttons)
+                    #print("MouseX = ", x, "\tMouseX = ", y)
+
+                if event.type == sdl2.SDL_KEYDOWN or event.type == sdl2.SDL_KEYUP:
+                    if event.key.keysym.sym == KEY_QUIT:
+                        print("P key. Exitting!")
+                        running = False
+                        break
+                    if event.key.repeat:
+                        continue
+                    if event.key.keysym.sym == KEY_OVERLAY:
+                        if event.type == sdl2.SDL_KEYDOWN:
+                            overlay = None if overlay is not None else LatencyOverlay()
+                            redraw = True
+                        continue
+                    for action, down in keyboard.edge(event.key.keysym.sym,
+                                                      event.type == sdl2.SDL_KEYDOWN):
+                        session, button = buttonSession(action)
+                        if button is not None:
+                            session.client.pressButton(button, down)
+
+            idle = not need_update and not events
+            if idle:
+                interval = min(interval * 2, option.idle_interval)
             else:
-                while waspressed:
-                    kx, ky = waspressed.pop()
-                    client.pointerEvent(kx, ky, 0)
-                    #print("  up, key: ", pressedkeys)
-                    print("matrix  up x,y: ", kx, ky)
+                interval = option.input_interval
+            # sleep until the next frame is committed or input is due
+            if not wake.is_set():
+                poll = loop.call_later(interval, wake.set)
+                await wake.wait()
+                poll.cancel()
+    finally:
+        if scanner is not None:
+            scanner.stop()
 
-        await asyncio.sleep(0.01)
 
 async def main():
 
-    option = Option()
+    options = load_options()
+    if not options:
+        options = [Option()]
 
-    option.remote_url()
-    
-    window = load_gui(option)
+    for option in options:
+        print("MFD %s: %s" % (option.section, option.remote_url()))
 
     loop = asyncio.get_running_loop()
 
-    flags = sdl2.render.SDL_RENDERER_SOFTWARE
-    renderer = sdl2.ext.Renderer(window, flags=flags)
+    # one wake up event for all MFDs
+    wake = asyncio.Event()
 
-    client = VNCClient(loop, renderer, option)
-    transport, protocol = await loop.create_connection(
-        lambda: client,
-        option.host, option.port)
-        
-    await run_gui(window, renderer, client)
+    workers = []
+    if options[0].processes:
+        if shadowfb is None:
+            print("numpy is not installed, decoding in this process")
+            for option in options:
+                option.processes = False
+        else:
+            # started before SDL is initialized
+            workers = [ProcessClient(loop, option, wake) for option in options]
+
+    sessions = load_gui(options)
+
+    try:
+        if workers:
+            for session, client in zip(sessions, workers):
+                session.client = client
+            connecting = [client.connected for client in workers]
+        else:
+            for session in sessions:
+                factory = ThreadedVNCClient if session.option.decoder_thread else VNCClient
+                session.client = factory(loop, session.renderer, session.option, wake)
+            connecting = [connect(loop, session.client, session.option) for session in sessions]
+        results = await asyncio.gather(*connecting, return_exceptions=True)
+        connected = []
+        for session, result in zip(sessions, results):
+            if isinstance(result, Exception):
+                print("MFD %s: %s" % (session.option.section, result))
+            else:
+                connected.append(session)
+        if not connected:
+            return
+
+        await run_gui(connected, wake, load_keypad(options[0]))
+    finally:
+        for session in sessions:
+            session.framebuffer.destroy()
+            # writes the index of a recording
+            if getattr(session.client, 'capture', None) is not None:
+                session.client.capture.close()
+            if getattr(session.client, 'profile', None) is not None:
+                print("MFD %s profile:\n%s" % (session.option.section,
+                                                session.client.profile.report()))
+        for client in workers:
+            client.close()
 
 
 if __name__ == '__main__':
     asyncio.run(main())
-
@@ -13,10 +13,19 @@ MIT License
 """
 
 import sys
-from struct import pack, unpack
+from struct import pack, unpack, iter_unpack
 #import pyDes
 import logging
 import asyncio
+import zlib
+import io
+import time
+
+try:
+    # optional, only needed for JPEG compressed tight rectangles
+    from PIL import Image
+except ImportError:
+    Image = None
 
 # encoding-type
 # for SetEncodings()
@@ -30,6 +39,33 @@ TIGHT_ENCODING = 7
 ZLIBHEX_ENCODING = 8
 ZRLE_ENCODING = 16
 # 0xffffff00 to 0xffffffff tight options
+# pseudo encodings, add the level (0..9)
+PSEUDO_COMPRESS_LEVEL_0 = -256
+PSEUDO_QUALITY_LEVEL_0 = -32
+# the server sends the cursor shape, the client draws it
+PSEUDO_CURSOR = -239
+# the number of rectangles in an update is not known up front
+PSEUDO_LAST_RECT = -224
+# the server screen size changes
+PSEUDO_DESKTOP_SIZE = -223
+
+# JPEG rectangles can only be decoded with PIL installed
+HAVE_JPEG = Image is not None
+
+# tight data shorter than this is sent uncompressed
+TIGHT_MIN_TO_COMPRESS = 12
+
+# initial size of the receive buffer, it grows on demand
+RECEIVE_BUFFER_SIZE = 65536
+
+# names of the encodings, for reports
+ENCODING_NAMES = {
+    RAW_ENCODING: 'raw', COPY_RECTANGLE_ENCODING: 'copyrect', RRE_ENCODING: 'rre',
+    CORRE_ENCODING: 'corre', HEXTILE_ENCODING: 'hextile', ZLIB_ENCODING: 'zlib',
+    TIGHT_ENCODING: 'tight', ZLIBHEX_ENCODING: 'zlibhex', ZRLE_ENCODING: 'zrle',
+    PSEUDO_CURSOR: 'cursor', PSEUDO_LAST_RECT: 'lastrect',
+    PSEUDO_DESKTOP_SIZE: 'desktopsize',
+}
 
 # keycodes
 # for KeyEvent()
@@ -99,14 +135,118 @@ KEY_KP_9 = 0xFFB9
 KEY_KP_Enter = 0xFF8D
 
 
+# ZRLE packed palette: byte -> tuple of palette indices, for 1, 2 and 4 bits
+_ZRLE_UNPACK = {
+    bits: [tuple((byte >> (8 - bits * (i + 1))) & ((1 << bits) - 1)
+                 for i in range(8 // bits))
+           for byte in range(256)]
+    for bits in (1, 2, 4)
+}
+
+
+class Profile:
+    """Counters of an RFBClient with profiling enabled. Every handler
+       call is counted under the handler name and under the encoding of
+       the rectangle being decoded: calls (rectangles for encodings),
+       bytes consumed and seconds. The seconds include the callbacks
+       except commitUpdate(), which is counted on its own."""
+
+    def __init__(self):
+        # name -> [calls, bytes, seconds]
+        self.handlers = {}
+        # encoding -> [rectangles, bytes, seconds]
+        self.encodings = {}
+        # encoding of the rectangle being decoded, None between them
+        self.encoding = None
+        # data_received calls, their bytes and the calls that were
+        # too short for the expected handler
+        self.chunks = 0
+        self.received = 0
+        self.shortReads = 0
+        # commitUpdate() seconds inside the running handler
+        self.nested = 0.0
+
+    def _count(self, name, size, seconds):
+        counts = self.handlers.get(name)
+        if counts is None:
+            counts = self.handlers[name] = [0, 0, 0.0]
+        counts[0] += 1
+        counts[1] += size
+        counts[2] += seconds
+
+    def committed(self, seconds):
+        """commitUpdate() took seconds, in the running handler"""
+        self._count('commitUpdate', 0, seconds)
+        self.nested += seconds
+
+    def handled(self, name, size, seconds):
+        if self.nested:
+            seconds -= self.nested
+            self.nested = 0.0
+        self._count(name, size, seconds)
+        if self.encoding is not None:
+            counts = self.encodings.get(self.encoding)
+            if counts is None:
+                counts = self.encodings[self.encoding] = [0, 0, 0.0]
+            if name == '_handleRectangle':
+                counts[0] += 1
+            counts[1] += size
+            counts[2] += seconds
+
+    def report(self):
+        """the counters as text, most time first"""
+        lines = ["%d chunks, %d bytes received, %d too short" %
+                 (self.chunks, self.received, self.shortReads)]
+        lines.append("%-32s %9s %11s %9s %8s" % ("handler", "calls", "bytes", "ms", "us/call"))
+        for name, (calls, size, seconds) in sorted(self.handlers.items(),
+                                                   key=lambda item: -item[1][2]):
+            lines.append("%-32s %9d %11d %9.1f %8.1f" %
+                         (name, calls, size, seconds * 1000, seconds * 1e6 / calls))
+        lines.append("%-32s %9s %11s %9s %8s" % ("encoding", "rects", "bytes", "ms", "MB/s"))
+        for encoding, (rects, size, seconds) in sorted(self.encodings.items(),
+                                                       key=lambda item: -item[1][2]):
+            lines.append("%-32s %9d %11d %9.1f %8.1f" %
+                         (ENCODING_NAMES.get(encoding, str(encoding)), rects, size,
+                          seconds * 1000, size / seconds / 1e6 if seconds else 0.0))
+        return "\n".join(lines)
+
+
 class RFBClient(asyncio.Protocol):
 
     def __init__(self, loop):
         self.loop = loop
         self.transport = None
-        self._packet = b''
+        # receive buffer: bytes between _rpos and _wpos are pending.
+        # the buffer is never resized in place, so memoryview slices
+        # handed to the handlers stay valid after they return.
+        self._buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._rpos = 0
+        self._wpos = 0
+        # stream offset of the first byte in the buffer
+        self._base = 0
+        # capture.Capture recording the received bytes, or None
+        self.capture = None
         self._handler = self._handleInitial
         self._already_expecting = False
+        self._expected_peek = False
+        # ZRLE uses one zlib stream for the whole connection
+        self._zrle_stream = zlib.decompressobj()
+        # tight uses four, the server tells when to reset them
+        self._tight_streams = [zlib.decompressobj() for i in range(4)]
+        # client messages waiting for the flush at the end of the loop tick
+        self._outgoing = []
+        self._flush_handle = None
+        # index in _outgoing of a pointer motion newer ones may replace
+        self._motion = None
+        # button mask of the last queued pointer event
+        self._buttonmask = 0
+        # client messages asked for, sent and transport writes
+        self.eventsReceived = 0
+        self.messagesSent = 0
+        self.writes = 0
+        # Profile while profiling is enabled
+        self.profile = None
     # ------------------------------------------------------
     # states used on connection startup
     # ------------------------------------------------------
@@ -114,18 +254,23 @@ class RFBClient(asyncio.Protocol):
     def connection_made(self, transport):
         self.transport = transport
 
+    def connection_lost(self, exc):
+        if self.capture is not None:
+            self.capture.close()
+
     def _handleInitial(self):
-        if b'\n' in self._packet:
-            if self._packet[:3] == 'RFB':
+        if self._buffer.find(b'\n', self._rpos, self._wpos) >= 0:
+            version = bytes(self._view[self._rpos:self._rpos + 12])
+            if version[:3] == b'RFB':
                 # ~ print "rfb"
-                maj, min = [int(x) for x in self._packet[3:-1].split('.')]
+                maj, min = [int(x) for x in version[3:-1].split(b'.')]
                 # ~ print maj, min
                 if (maj, min) not in [(3, 3), (3, 7), (3, 8)]:
                     logging.warning("wrong protocol version\n")
                     self.transport.close()
-            self.transport.write(b'RFB 003.003\n')
+            self._queue(b'RFB 003.003\n')
             logging.debug("connected \n")
-            self._packet = self._packet[12:]
+            self._rpos += 12
             self._handler = self._handleExpected
             self.expect(self._handleAuth, 4)
 
@@ -140,7 +285,7 @@ class RFBClient(asyncio.Protocol):
         else:
             logging.warning("unknown auth response (%d)\n" % auth)
     
-    def _handleConnFailed(self):
+    def _handleConnFailed(self, block):
         (waitfor,) = unpack("!I", block)
         self.expect(self._handleConnMessage, waitfor)
 
@@ -148,7 +293,7 @@ class RFBClient(asyncio.Protocol):
         logging.info("Connection refused: %r\n" % block)
 
     def _doClientInitialization(self):
-        self.transport.write(pack("!B", self.isShared()))
+        self._queue(pack("!B", self.isShared()))
         self.expect(self._handleServerInit, 24)
 
     def _handleServerInit(self, block):
@@ -161,7 +306,7 @@ class RFBClient(asyncio.Protocol):
         self.expect(self._handleServerName, namelen)
 
     def _handleServerName(self, block):
-        self.name = block
+        self.name = bytes(block)
         # callback:
         self.vncConnectionMade()
         self.expect(self._handleConnection, 1)
@@ -183,6 +328,9 @@ class RFBClient(asyncio.Protocol):
             self.expect(self._handleConnection, 1)
 
     def _handleFramebufferUpdate(self, block):
+        if self.capture is not None:
+            # message id and header are consumed
+            self.capture.update(self._base + self._rpos - 4)
         (self.rectangles,) = unpack("!xH", block)
         self.rectanglePos = []
         self.beginUpdate()
@@ -196,9 +344,12 @@ class RFBClient(asyncio.Protocol):
             self.expect(self._handleConnection, 1)
 
     def _handleRectangle(self, block):
-        (x, y, width, height, encoding) = unpack("!HHHHI", block)
+        (x, y, width, height, encoding) = unpack("!HHHHi", block)
         if self.rectangles:
             self.rectangles -= 1
+            if encoding < 0:
+                self._handlePseudoRectangle(x, y, width, height, encoding)
+                return
             self.rectanglePos.append((x, y, width, height))
             if encoding == COPY_RECTANGLE_ENCODING:
                 self.expect(self._handleDecodeCopyrect, 4, x, y, width, height)
@@ -206,15 +357,17 @@ class RFBClient(asyncio.Protocol):
                 self.expect(self._handleDecodeRAW, width *
                             height*self.bypp, x, y, width, height)
             elif encoding == HEXTILE_ENCODING:
-                self._doNextHextileSubrect(None, None, x, y, width, height, None, None)
+                self._doHextile(x, y, width, height, x, y, None, None, {}, [], [])
             elif encoding == CORRE_ENCODING:
                 self.expect(self._handleDecodeCORRE, 4 +
                             self.bypp, x, y, width, height)
             elif encoding == RRE_ENCODING:
                 self.expect(self._handleDecodeRRE, 4 +
                             self.bypp, x, y, width, height)
-            # ~ elif encoding == ZRLE_ENCODING:
-                #~ self.expect(self._handleDecodeZRLE, )
+            elif encoding == ZRLE_ENCODING:
+                self.expect(self._handleDecodeZRLE, 4, x, y, width, height)
+            elif encoding == TIGHT_ENCODING:
+                self.expect(self._handleDecodeTight, 1, x, y, width, height)
             else:
                 logging.warning(
                     "unknown encoding received (encoding %d)\n" % encoding)
@@ -222,6 +375,31 @@ class RFBClient(asyncio.Protocol):
         else:
             self._doConnection()
 
+    def _handlePseudoRectangle(self, x, y, width, height, encoding):
+        if encoding == PSEUDO_LAST_RECT:
+            # the update ends here
+            self.rectangles = 0
+            self._doConnection()
+        elif encoding == PSEUDO_DESKTOP_SIZE:
+            self.width = width
+            self.height = height
+            self.desktopResized(width, height)
+            self._doConnection()
+        elif encoding == PSEUDO_CURSOR:
+            # pixels, then a bitmask with rows padded to bytes
+            self.expect(self._handleDecodeCursor,
+                        width * height * self.bypp + (width + 7) // 8 * height,
+                        x, y, width, height)
+        else:
+            logging.warning(
+                "unknown pseudo encoding received (encoding %d)\n" % encoding)
+            self._doConnection()
+
+    def _handleDecodeCursor(self, block, hotx, hoty, width, height):
+        size = width * height * self.bypp
+        self.updateCursor(hotx, hoty, width, height, block[:size], block[size:])
+        self._doConnection()
+
     # ---  RAW Encoding
 
     def _handleDecodeRAW(self, block, x, y, width, height):
@@ -250,14 +428,9 @@ class RFBClient(asyncio.Protocol):
 
     def _handleRRESubRectangles(self, block, topx, topy):
         # ~ print "_handleRRESubRectangle"
-        pos = 0
-        end = len(block)
-        sz = self.bypp + 8
         format = "!%dsHHHH" % self.bypp
-        while pos < end:
-            (color, x, y, width, height) = unpack(format, block[pos:pos+sz])
-            self.fillRectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+        self._fillRuns((color, (topx + x, topy + y, width, height))
+                       for (color, x, y, width, height) in iter_unpack(format, block))
         self._doConnection()
 
     # ---  CoRRE Encoding
@@ -274,128 +447,447 @@ class RFBClient(asyncio.Protocol):
 
     def _handleDecodeCORRERectangles(self, block, topx, topy):
         # ~ print "_handleDecodeCORRERectangle"
-        pos = 0
-        end = len(block)
-        sz = self.bypp + 4
         format = "!%dsBBBB" % self.bypp
-        while pos < sz:
-            (color, x, y, width, height) = unpack(format, block[pos:pos+sz])
-            self.fillRectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+        self._fillRuns((color, (topx + x, topy + y, width, height))
+                       for (color, x, y, width, height) in iter_unpack(format, block))
         self._doConnection()
 
+    def _fillRuns(self, subrects):
+        """pass (color, rectangle) subrects on, consecutive subrects of
+           the same color in one fillRectangles. subrects may overlap,
+           so the painting order is kept"""
+        last = None
+        rectangles = []
+        for color, rectangle in subrects:
+            if color != last:
+                if rectangles:
+                    self.fillRectangles(last, rectangles)
+                last = color
+                rectangles = []
+            rectangles.append(rectangle)
+        if rectangles:
+            self.fillRectangles(last, rectangles)
+
     # ---  Hexile Encoding
-    
-    def _doNextHextileSubrect(self, bg, color, x, y, width, height, tx, ty):
-        #~ print "_doNextHextileSubrect %r" % ((color, x, y, width, height, tx, ty), )
-        #coords of next tile
-        #its line after line of tiles
-        #finished when the last line is completly received
-        
-        #dont inc the first time
-        if tx is not None:
-            #calc next subrect pos
+
+    def _doHextile(self, x, y, width, height, tx, ty, bg, fg, backgrounds, fills, blits):
+        """decode all complete tiles in the receive buffer in one pass.
+           tile backgrounds (color -> list of rectangles), subrects (runs
+           of (color, list of rectangles) in stream order) and raw tiles
+           are collected for the whole rectangle, on a
+           short read the state is kept and decoding resumes when enough
+           data for the next tile is available."""
+        view = self._view
+        pos = self._rpos
+        end = self._wpos
+        bypp = self.bypp
+        right = x + width
+        bottom = y + height
+        need = 0
+        while ty < bottom:
+            tw = 16 if right - tx > 16 else right - tx
+            th = 16 if bottom - ty > 16 else bottom - ty
+            if pos >= end:
+                need = 1
+                break
+            subencoding = view[pos]
+            if subencoding & 1:     # RAW
+                size = 1 + tw * th * bypp
+                if end - pos < size:
+                    need = size
+                    break
+                blits.append((tx, ty, tw, th, view[pos + 1:pos + size]))
+            else:
+                size = 1
+                if subencoding & 2:     # BackgroundSpecified
+                    size += bypp
+                if subencoding & 4:     # ForegroundSpecified
+                    size += bypp
+                if subencoding & 8:     # AnySubrects
+                    size += 1
+                if end - pos < size:
+                    need = size
+                    break
+                p = pos + 1
+                tile_bg = bg
+                tile_fg = fg
+                subrects = 0
+                if subencoding & 2:
+                    tile_bg = bytes(view[p:p + bypp])
+                    p += bypp
+                if subencoding & 4:
+                    tile_fg = bytes(view[p:p + bypp])
+                    p += bypp
+                if subencoding & 8:
+                    subrects = view[p]
+                    p += 1
+                coloured = subencoding & 16     # SubrectsColoured
+                if subrects:
+                    size += subrects * (bypp + 2 if coloured else 2)
+                    if end - pos < size:
+                        need = size
+                        break
+                group = backgrounds.get(tile_bg)
+                if group is None:
+                    group = backgrounds[tile_bg] = []
+                group.append((tx, ty, tw, th))
+                if subrects and not coloured:
+                    if fills and fills[-1][0] == tile_fg:
+                        group = fills[-1][1]
+                    else:
+                        group = []
+                        fills.append((tile_fg, group))
+                for i in range(subrects):
+                    if coloured:
+                        color = bytes(view[p:p + bypp])
+                        p += bypp
+                        # only consecutive subrects are merged, they
+                        # may overlap
+                        if fills and fills[-1][0] == color:
+                            group = fills[-1][1]
+                        else:
+                            group = []
+                            fills.append((color, group))
+                    xy = view[p]
+                    wh = view[p + 1]
+                    p += 2
+                    group.append((tx + (xy >> 4), ty + (xy & 0xf),
+                                  (wh >> 4) + 1, (wh & 0xf) + 1))
+                bg = tile_bg
+                fg = tile_fg
+            pos += size
+            # tiles are sent line after line
             tx += 16
-            if tx >= x + width:
+            if tx >= right:
                 tx = x
                 ty += 16
+        self._rpos = pos
+        if need:
+            self._expectAvailable(self._doHextile, need, x, y, width, height,
+                                  tx, ty, bg, fg, backgrounds, fills, blits)
         else:
-            tx = x
-            ty = y
-        #more tiles?
-        if ty >= y + height:
+            self._emitHextile(backgrounds, fills, blits)
             self._doConnection()
+
+    def _emitHextile(self, backgrounds, fills, blits):
+        """pass the decoded rectangle on. tiles do not overlap, so all
+           backgrounds go first, then the runs of subrects in stream
+           order, then raw tiles"""
+        for color, rectangles in backgrounds.items():
+            self.fillRectangles(color, rectangles)
+        for color, rectangles in fills:
+            self.fillRectangles(color, rectangles)
+        for (x, y, width, height, data) in blits:
+            self.updateRectangle(x, y, width, height, data)
+
+    # ---  ZRLE Encoding
+
+    def _handleDecodeZRLE(self, block, x, y, width, height):
+        (length,) = unpack("!I", block)
+        self.expect(self._handleDecodeZRLEData, length, x, y, width, height)
+
+    def _handleDecodeZRLEData(self, block, x, y, width, height):
+        data = memoryview(self._zrle_stream.decompress(block))
+        self._cpixel = cpp, pad_before, pad_after = self._cpixelFormat()
+        solid = {}
+        pos = 0
+        for ty in range(y, y + height, 64):
+            th = min(64, y + height - ty)
+            for tx in range(x, x + width, 64):
+                tw = min(64, x + width - tx)
+                subencoding = data[pos]
+                pos += 1
+                if subencoding == 0:        # raw
+                    end = pos + tw * th * cpp
+                    self.updateRectangle(tx, ty, tw, th,
+                                         self._expandCPixels(data[pos:end], tw * th))
+                    pos = end
+                elif subencoding == 1:      # solid
+                    color = pad_before + data[pos:pos + cpp] + pad_after
+                    solid.setdefault(color, []).append((tx, ty, tw, th))
+                    pos += cpp
+                elif subencoding <= 16:     # packed palette
+                    palette, pos = self._readZRLEPalette(data, pos, subencoding)
+                    bits = 1 if subencoding == 2 else 2 if subencoding <= 4 else 4
+                    table = _ZRLE_UNPACK[bits]
+                    rowbytes = (tw * bits + 7) // 8
+                    rows = []
+                    for row in range(th):
+                        indices = []
+                        for byte in data[pos:pos + rowbytes]:
+                            indices.extend(table[byte])
+                        rows.extend([palette[i] for i in indices[:tw]])
+                        pos += rowbytes
+                    self.updateRectangle(tx, ty, tw, th, b''.join(rows))
+                elif subencoding == 128:    # plain RLE
+                    pixels = bytearray()
+                    remaining = tw * th
+                    while remaining > 0:
+                        pixel = pad_before + data[pos:pos + cpp] + pad_after
+                        pos += cpp
+                        run, pos = self._readZRLERunLength(data, pos)
+                        pixels += pixel * run
+                        remaining -= run
+                    self.updateRectangle(tx, ty, tw, th, pixels)
+                elif subencoding >= 130:    # palette RLE
+                    palette, pos = self._readZRLEPalette(data, pos, subencoding - 128)
+                    pixels = bytearray()
+                    remaining = tw * th
+                    while remaining > 0:
+                        index = data[pos]
+                        pos += 1
+                        if index & 128:
+                            run, pos = self._readZRLERunLength(data, pos)
+                            pixels += palette[index & 127] * run
+                        else:
+                            run = 1
+                            pixels += palette[index]
+                        remaining -= run
+                    self.updateRectangle(tx, ty, tw, th, pixels)
+                else:
+                    logging.warning(
+                        "unknown ZRLE subencoding received (%d)\n" % subencoding)
+                    self._doConnection()
+                    return
+        # tiles do not overlap, solid ones can go in one batch per color
+        for color, rectangles in solid.items():
+            self.fillRectangles(color, rectangles)
+        self._doConnection()
+
+    def _cpixelFormat(self):
+        """ZRLE compressed pixel: size in bytes and the padding needed
+           to get a full pixel back. 32 bit true color pixels where all
+           colors fit in three bytes are sent without the unused byte."""
+        if self.truecolor and self.bpp == 32 and self.depth <= 24:
+            mask = ((self.redmax << self.redshift) |
+                    (self.greenmax << self.greenshift) |
+                    (self.bluemax << self.blueshift))
+            if mask & 0xff000000 == 0:      # least significant bytes
+                if self.bigendian:
+                    return 3, b'\0', b''
+                return 3, b'', b'\0'
+            if mask & 0x000000ff == 0:      # most significant bytes
+                if self.bigendian:
+                    return 3, b'', b'\0'
+                return 3, b'\0', b''
+        return self.bypp, b'', b''
+
+    def _expandCPixels(self, data, count):
+        """convert count compressed pixels to full pixels"""
+        cpp, pad_before, pad_after = self._cpixel
+        if cpp == self.bypp:
+            return data
+        pixels = bytearray(count * 4)
+        offset = len(pad_before)
+        pixels[offset::4] = data[0::3]
+        pixels[offset + 1::4] = data[1::3]
+        pixels[offset + 2::4] = data[2::3]
+        return pixels
+
+    def _readZRLEPalette(self, data, pos, size):
+        cpp, pad_before, pad_after = self._cpixel
+        palette = []
+        for i in range(size):
+            palette.append(pad_before + data[pos:pos + cpp] + pad_after)
+            pos += cpp
+        return palette, pos
+
+    def _readZRLERunLength(self, data, pos):
+        run = 1
+        while data[pos] == 255:
+            run += 255
+            pos += 1
+        run += data[pos]
+        return run, pos + 1
+
+    # ---  Tight Encoding
+
+    def _tpixelSize(self):
+        """24 bit true color pixels are sent as 3 bytes R, G, B"""
+        if (self.truecolor and self.bpp == 32 and self.depth == 24 and
+                self.redmax == self.greenmax == self.bluemax == 255):
+            return 3
+        return self.bypp
+
+    def _handleDecodeTight(self, block, x, y, width, height):
+        control = block[0]
+        for stream in range(4):
+            if control & (1 << stream):
+                self._tight_streams[stream] = zlib.decompressobj()
+        compression = control >> 4
+        tpp = self._tpixelSize()
+        if compression == 8:        # fill
+            self.expect(self._handleDecodeTightFill, tpp, x, y, width, height)
+        elif compression == 9:      # jpeg
+            self._expectTightLength(self._handleDecodeTightJPEG, x, y, width, height)
+        elif compression & 8:
+            logging.warning(
+                "unknown tight compression received (%d)\n" % compression)
+            self._doConnection()
+        elif compression & 4:       # filter id follows
+            self.expect(self._handleDecodeTightFilter, 1, compression & 3, x, y, width, height)
         else:
-            self.expect(self._handleDecodeHextile, 1, bg, color, x, y, width, height, tx, ty)
-        
-    def _handleDecodeHextile(self, block, bg, color, x, y, width, height, tx, ty):
-        (subencoding,) = unpack("!B", block)
-        #calc tile size
-        tw = th = 16
-        if x + width - tx < 16:   tw = x + width - tx
-        if y + height - ty < 16:  th = y + height- ty
-        #decode tile
-        if subencoding & 1:     #RAW
-            self.expect(self._handleDecodeHextileRAW, tw*th*self.bypp, bg, color, x, y, width, height, tx, ty, tw, th)
+            self._expectTightData(width * height * tpp, self._handleDecodeTightCopy,
+                                  compression & 3, x, y, width, height)
+
+    def _expectTightLength(self, handler, *args):
+        """compact length: 1 to 3 bytes, 7 bits each, high bit = more"""
+        self.expect(self._handleTightLength, 1, handler, 0, 0, args)
+
+    def _handleTightLength(self, block, handler, length, shift, args):
+        byte = block[0]
+        if shift < 14:
+            length |= (byte & 0x7f) << shift
         else:
-            numbytes = 0
-            if subencoding & 2:     #BackgroundSpecified
-                numbytes += self.bypp
-            if subencoding & 4:     #ForegroundSpecified
-                numbytes += self.bypp
-            if subencoding & 8:     #AnySubrects
-                numbytes += 1
-            if numbytes:
-                self.expect(self._handleDecodeHextileSubrect, numbytes, subencoding, bg, color, x, y, width, height, tx, ty, tw, th)
-            else:
-                self.fillRectangle(tx, ty, tw, th, bg)
-                self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
-    
-    def _handleDecodeHextileSubrect(self, block, subencoding, bg, color, x, y, width, height, tx, ty, tw, th):
-        subrects = 0
-        pos = 0
-        if subencoding & 2:     #BackgroundSpecified
-            bg = block[:self.bypp]
-            pos += self.bypp
-        self.fillRectangle(tx, ty, tw, th, bg)
-        if subencoding & 4:     #ForegroundSpecified
-            color = block[pos:pos+self.bypp]
-            pos += self.bypp
-        if subencoding & 8:     #AnySubrects
-            #~ (subrects, ) = unpack("!B", block)
-            subrects = block[pos]
-        #~ print subrects
-        if subrects:
-            if subencoding & 16:    #SubrectsColoured
-                self.expect(self._handleDecodeHextileSubrectsColoured, (self.bypp + 2)*subrects, bg, color, subrects, x, y, width, height, tx, ty, tw, th)
-            else:
-                self.expect(self._handleDecodeHextileSubrectsFG, 2*subrects, bg, color, subrects, x, y, width, height, tx, ty, tw, th)
+            length |= byte << shift
+        if byte & 0x80 and shift < 14:
+            self.expect(self._handleTightLength, 1, handler, length, shift + 7, args)
         else:
-            self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
-    
-    
-    def _handleDecodeHextileRAW(self, block, bg, color, x, y, width, height, tx, ty, tw, th):
-        """the tile is in raw encoding"""
-        self.updateRectangle(tx, ty, tw, th, block)
-        self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
-    
-    def _handleDecodeHextileSubrectsColoured(self, block, bg, color, subrects, x, y, width, height, tx, ty, tw, th):
-        """subrects with their own color"""
-        sz = self.bypp + 2
-        pos = 0
-        end = len(block)
-        while pos < end:
-            pos2 = pos + self.bypp
-            color = block[pos:pos2]
-            xy = block[pos2]
-            wh = block[pos2+1]
-            sx = xy >> 4
-            sy = xy & 0xf
-            sw = (wh >> 4) + 1
-            sh = (wh & 0xf) + 1
-            self.fillRectangle(tx + sx, ty + sy, sw, sh, color)
-            pos += sz
-        self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
-    
-    def _handleDecodeHextileSubrectsFG(self, block, bg, color, subrects, x, y, width, height, tx, ty, tw, th):
-        """all subrect with same color"""
-        pos = 0
-        end = len(block)
-        while pos < end:
-            xy = block[pos]
-            wh = block[pos+1]
-            sx = xy >> 4
-            sy = xy & 0xf
-            sw = (wh >> 4) + 1
-            sh = (wh & 0xf) + 1
-            self.fillRectangle(tx + sx, ty + sy, sw, sh, color)
-            pos += 2
-        self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
+            self.expect(handler, length, *args)
 
-    # ---  ZRLE Encoding
+    def _expectTightData(self, size, handler, stream, *args):
+        """short data is sent as is, longer data compressed"""
+        if size < TIGHT_MIN_TO_COMPRESS:
+            self.expect(handler, size, *args)
+        else:
+            self._expectTightLength(self._handleTightCompressed, size, handler, stream, args)
 
-    def _handleDecodeZRLE(self, block):
-        raise NotImplementedError
+    def _handleTightCompressed(self, block, size, handler, stream, args):
+        data = self._tight_streams[stream].decompress(block)
+        if len(data) != size:
+            logging.warning("tight data size mismatch (%d != %d)\n" % (len(data), size))
+            self._doConnection()
+            return
+        handler(memoryview(data), *args)
+
+    def _handleDecodeTightFill(self, block, x, y, width, height):
+        self.fillRectangle(x, y, width, height, self._tpixelsToPixels(block, 1))
+        self._doConnection()
+
+    def _handleDecodeTightFilter(self, block, stream, x, y, width, height):
+        (filterid,) = unpack("!B", block)
+        if filterid == 0:       # copy
+            self._expectTightData(width * height * self._tpixelSize(),
+                                  self._handleDecodeTightCopy, stream, x, y, width, height)
+        elif filterid == 1:     # palette
+            self.expect(self._handleDecodeTightPaletteSize, 1, stream, x, y, width, height)
+        elif filterid == 2:     # gradient
+            self._expectTightData(width * height * self._tpixelSize(),
+                                  self._handleDecodeTightGradient, stream, x, y, width, height)
+        else:
+            logging.warning("unknown tight filter received (%d)\n" % filterid)
+            self._doConnection()
+
+    def _handleDecodeTightCopy(self, block, x, y, width, height):
+        self.updateRectangle(x, y, width, height,
+                             self._tpixelsToPixels(block, width * height))
+        self._doConnection()
+
+    def _handleDecodeTightPaletteSize(self, block, stream, x, y, width, height):
+        colors = block[0] + 1
+        self.expect(self._handleDecodeTightPalette, colors * self._tpixelSize(),
+                    colors, stream, x, y, width, height)
+
+    def _handleDecodeTightPalette(self, block, colors, stream, x, y, width, height):
+        pixels = self._tpixelsToPixels(block, colors)
+        bypp = self.bypp
+        palette = [bytes(pixels[i:i + bypp]) for i in range(0, colors * bypp, bypp)]
+        if colors == 2:
+            size = (width + 7) // 8 * height
+        else:
+            size = width * height
+        self._expectTightData(size, self._handleDecodeTightIndexed,
+                              stream, palette, x, y, width, height)
+
+    def _handleDecodeTightIndexed(self, block, palette, x, y, width, height):
+        if len(palette) == 2:
+            table = _ZRLE_UNPACK[1]
+            rowbytes = (width + 7) // 8
+            rows = []
+            for pos in range(0, rowbytes * height, rowbytes):
+                indices = []
+                for byte in block[pos:pos + rowbytes]:
+                    indices.extend(table[byte])
+                rows.extend([palette[i] for i in indices[:width]])
+        else:
+            rows = [palette[i] for i in block]
+        self.updateRectangle(x, y, width, height, b''.join(rows))
+        self._doConnection()
+
+    def _handleDecodeTightGradient(self, block, x, y, width, height):
+        """each color component is predicted from the left, upper and
+           upper left pixel, the data is the difference"""
+        tpp = self._tpixelSize()
+        if tpp == 3:
+            maxes = (255, 255, 255)
+            components = [tuple(block[i:i + 3]) for i in range(0, len(block), 3)]
+        else:
+            maxes = (self.redmax, self.greenmax, self.bluemax)
+            components = [self._pixelComponents(block[i:i + tpp])
+                          for i in range(0, len(block), tpp)]
+        previous = [(0, 0, 0)] * width
+        pixels = []
+        for row in range(height):
+            left = upperleft = (0, 0, 0)
+            current = []
+            for column in range(width):
+                upper = previous[column]
+                delta = components[row * width + column]
+                value = tuple(
+                    (min(max(left[c] + upper[c] - upperleft[c], 0), maxes[c]) + delta[c]) & maxes[c]
+                    for c in range(3))
+                current.append(value)
+                left = value
+                upperleft = upper
+            pixels.extend(current)
+            previous = current
+        if tpp == 3:
+            data = self._tpixelsToPixels(bytes(b for value in pixels for b in value),
+                                         width * height)
+        else:
+            data = b''.join(self._pixelFromComponents(*value) for value in pixels)
+        self.updateRectangle(x, y, width, height, data)
+        self._doConnection()
+
+    def _handleDecodeTightJPEG(self, block, x, y, width, height):
+        if Image is None:
+            logging.warning("JPEG rectangle received, PIL is not installed\n")
+        else:
+            image = Image.open(io.BytesIO(block)).convert('RGB')
+            self.updateRectangle(x, y, width, height,
+                                 self._rgbToPixels(image.tobytes(), width * height))
+        self._doConnection()
+
+    def _tpixelsToPixels(self, data, count):
+        if self._tpixelSize() == 3:
+            return self._rgbToPixels(data, count)
+        return data
+
+    def _rgbToPixels(self, rgb, count):
+        """convert count R, G, B byte triples to the pixel format"""
+        shifts = (self.redshift, self.greenshift, self.blueshift)
+        if (self.bpp == 32 and self.redmax == self.greenmax == self.bluemax == 255 and
+                not any(shift % 8 for shift in shifts)):
+            # each component is a byte of the pixel, just move them
+            pixels = bytearray(count * 4)
+            for component, shift in enumerate(shifts):
+                index = 3 - shift // 8 if self.bigendian else shift // 8
+                pixels[index::4] = rgb[component::3]
+            return pixels
+        return b''.join(self._pixelFromComponents(rgb[i] * self.redmax // 255,
+                                                  rgb[i + 1] * self.greenmax // 255,
+                                                  rgb[i + 2] * self.bluemax // 255)
+                        for i in range(0, count * 3, 3))
+
+    def _pixelFromComponents(self, red, green, blue):
+        value = (red << self.redshift) | (green << self.greenshift) | (blue << self.blueshift)
+        return value.to_bytes(self.bypp, 'big' if self.bigendian else 'little')
+
+    def _pixelComponents(self, pixel):
+        value = int.from_bytes(pixel, 'big' if self.bigendian else 'little')
+        return ((value >> self.redshift) & self.redmax,
+                (value >> self.greenshift) & self.greenmax,
+                (value >> self.blueshift) & self.bluemax)
 
     # ---  other server messages
 
@@ -404,7 +896,7 @@ class RFBClient(asyncio.Protocol):
         self.expect(self._handleServerCutTextValue, length)
 
     def _handleServerCutTextValue(self, block):
-        self.copy_text(block)
+        self.copy_text(bytes(block))
         self.expect(self._handleConnection, 1)
 
     # ------------------------------------------------------
@@ -412,30 +904,144 @@ class RFBClient(asyncio.Protocol):
     # ------------------------------------------------------
     def data_received(self, data):
         #~ sys.stdout.write(repr(data) + '\n')
-        self._packet += data
+        if self.capture is not None:
+            self.capture.write(data)
+        self._receive(data)
+
+    def _receive(self, data):
+        size = len(data)
+        if self._wpos + size > len(self._buffer):
+            self._compact(size)
+        self._buffer[self._wpos:self._wpos + size] = data
+        self._wpos += size
         self._handler()
 
-    def _handleExpected(self):        
-        while True:
-            if len(self._packet) < self._expected_len:
-                break
-
-            block = self._packet[:self._expected_len]
-            self._packet = self._packet[self._expected_len:]
+    def _compact(self, size):
+        """make room for size more bytes. the pending bytes are moved to
+           the start of a fresh buffer (doubled until they fit), the old
+           buffer stays alive as long as handlers hold views of it."""
+        pending = self._wpos - self._rpos
+        capacity = len(self._buffer)
+        while capacity < pending + size:
+            capacity *= 2
+        buffer = bytearray(capacity)
+        buffer[:pending] = self._view[self._rpos:self._wpos]
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._base += self._rpos
+        self._rpos = 0
+        self._wpos = pending
+
+    def _handleExpected(self):
+        while self._wpos - self._rpos >= self._expected_len:
+            if self._expected_peek:
+                # the handler reads the buffer itself
+                self._expected_peek = False
+                self._expected_len = 0
+                self._already_expecting = True
+                self._expected_handler(*self._expected_args, **self._expected_kwargs)
+                continue
+            start = self._rpos
+            self._rpos += self._expected_len
+            # zero copy, the handler gets a memoryview slice
+            block = self._view[start:self._rpos]
             self._expected_len = 0
             self._already_expecting = True
             self._expected_handler(block, *self._expected_args, **self._expected_kwargs)
 
         self._already_expecting = False
 
+    def _expectAvailable(self, handler, size, *args):
+        """like expect(), but nothing is consumed. the handler is called
+           without a block once size bytes are pending and reads them
+           from the buffer, advancing _rpos itself."""
+        self._expected_handler = handler
+        self._expected_len = int(size)
+        self._expected_args = args
+        self._expected_kwargs = {}
+        self._expected_peek = True
+        if self._already_expecting is False:
+            self._handleExpected()
+
     def expect(self, handler, size, *args, **kwargs):
         self._expected_handler = handler
         self._expected_len = int(size)
         self._expected_args = args
         self._expected_kwargs = kwargs
+        self._expected_peek = False
         if self._already_expecting is False:
             self._handleExpected()  # just in case that there is already enough data
 
+    # ------------------------------------------------------
+    # profiling
+    # ------------------------------------------------------
+    def enableProfiling(self):
+        """count calls, bytes and time per handler and encoding in
+           self.profile. the counting dispatch replaces _handleExpected
+           and _receive on this instance only, a client without
+           profiling runs the plain ones"""
+        if self.profile is None:
+            self.profile = Profile()
+        self._handleExpected = self._handleExpectedProfiled
+        self._receive = self._receiveProfiled
+        self.commitUpdate = self._commitUpdateProfiled
+        if self._handler != self._handleInitial:
+            self._handler = self._handleExpected
+        return self.profile
+
+    def disableProfiling(self):
+        """back to the plain dispatch, returns the Profile"""
+        profile = self.profile
+        self.__dict__.pop('_handleExpected', None)
+        self.__dict__.pop('_receive', None)
+        self.__dict__.pop('commitUpdate', None)
+        if self._handler != self._handleInitial:
+            self._handler = self._handleExpected
+        self.profile = None
+        return profile
+
+    def _receiveProfiled(self, data):
+        profile = self.profile
+        profile.chunks += 1
+        profile.received += len(data)
+        position = self._base + self._rpos
+        RFBClient._receive(self, data)
+        if self._base + self._rpos == position:
+            profile.shortReads += 1
+
+    def _commitUpdateProfiled(self, rectangles=None):
+        begin = time.perf_counter()
+        type(self).commitUpdate(self, rectangles)
+        self.profile.committed(time.perf_counter() - begin)
+
+    def _handleExpectedProfiled(self):
+        """_handleExpected, timing every handler call"""
+        profile = self.profile
+        clock = time.perf_counter
+        while self._wpos - self._rpos >= self._expected_len:
+            handler = self._expected_handler
+            name = handler.__name__
+            start = self._rpos
+            begin = clock()
+            if self._expected_peek:
+                self._expected_peek = False
+                self._expected_len = 0
+                self._already_expecting = True
+                handler(*self._expected_args, **self._expected_kwargs)
+            else:
+                self._rpos += self._expected_len
+                block = self._view[start:self._rpos]
+                self._expected_len = 0
+                self._already_expecting = True
+                if name == '_handleRectangle':
+                    (profile.encoding,) = unpack("!i", block[8:])
+                elif name == '_handleConnection':
+                    profile.encoding = None
+                handler(block, *self._expected_args, **self._expected_kwargs)
+            profile.handled(name, self._rpos - start, clock() - begin)
+
+        self._already_expecting = False
+
     # ------------------------------------------------------
     # client -> server messages
     # ------------------------------------------------------
@@ -444,7 +1050,9 @@ class RFBClient(asyncio.Protocol):
     def setPixelFormat(self, bpp=32, depth=24, bigendian=0, truecolor=1, redmax=255, greenmax=255, bluemax=255, redshift=0, greenshift=0, blueshift=0):
         pixformat = pack("!BBBBHHHBBBxxx", bpp, depth, bigendian, truecolor,
                          redmax, greenmax, bluemax, redshift, greenshift, blueshift)
-        self.transport.write(pack("!Bxxx16s", 0, pixformat))
+        self._queue(pack("!Bxxx16s", 0, pixformat))
+        if self.capture is not None:
+            self.capture.setPixelFormat(pixformat)
         # rember these settings
         self.bpp, self.depth, self.bigendian, self.truecolor = bpp, depth, bigendian, truecolor
         self.redmax, self.greenmax, self.bluemax = redmax, greenmax, bluemax
@@ -453,35 +1061,74 @@ class RFBClient(asyncio.Protocol):
         # ~ print self.bypp
 
     def setEncodings(self, list_of_encodings):
-        self.transport.write(pack("!BxH", 2, len(list_of_encodings)))
-        for encoding in list_of_encodings:
-            self.transport.write(pack("!I", encoding))
+        # pseudo encodings are negative
+        self._queue(pack("!BxH%dI" % len(list_of_encodings), 2, len(list_of_encodings),
+                         *[encoding & 0xffffffff for encoding in list_of_encodings]))
 
     def framebufferUpdateRequest(self, x=0, y=0, width=None, height=None, incremental=0):
         if width is None:
             width = self.width - x
         if height is None:
             height = self.height - y
-        self.transport.write(
-            pack("!BBHHHH", 3, incremental, x, y, width, height))
+        self._queue(pack("!BBHHHH", 3, incremental, x, y, width, height))
 
     def keyEvent(self, key, down=1):
         """For most ordinary keys, the "keysym" is the same as the corresponding ASCII value.
         Other common keys are shown in the KEY_ constants."""
-        self.transport.write(pack("!BBxxI", 4, down, key))
+        self._queue(pack("!BBxxI", 4, down, key))
 
     def pointerEvent(self, x, y, buttonmask=0):
         """Indicates either pointer movement or a pointer button press or release. The pointer is
            now at (x-position, y-position), and the current state of buttons 1 to 8 are represented
            by bits 0 to 7 of button-mask respectively, 0 meaning up, 1 meaning down (pressed).
+           Motion is coalesced: of several moves with the same buttons
+           in one loop tick only the last position is sent.
         """
-        self.transport.write(pack("!BBHH", 5, buttonmask, x, y))
+        self.sendPointerEvent(pack("!BBHH", 5, buttonmask, x, y))
+
+    def sendPointerEvent(self, message):
+        """pointerEvent() with an already packed message"""
+        buttonmask = message[1]
+        if buttonmask == self._buttonmask and self._motion is not None:
+            self.eventsReceived += 1
+            self._outgoing[self._motion] = message
+            return
+        # a press or release is always sent, at its own position
+        edge = buttonmask != self._buttonmask
+        self._buttonmask = buttonmask
+        self._queue(message)
+        if not edge:
+            self._motion = len(self._outgoing) - 1
 
     def clientCutText(self, message):
         """The client has new ASCII text in its cut buffer.
            (aka clipboard)
         """
-        self.transport.write(pack("!BxxxI", 6, len(message)) + message)
+        self._queue(pack("!BxxxI", 6, len(message)) + message)
+
+    def _queue(self, message):
+        """send a client message with the next flush, once per loop tick"""
+        self.eventsReceived += 1
+        self._outgoing.append(message)
+        self._motion = None
+        if self.loop is None:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """write the queued client messages at once"""
+        self._flush_handle = None
+        self._motion = None
+        outgoing = self._outgoing
+        if not outgoing:
+            return
+        self._outgoing = []
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.transport.writelines(outgoing)
+        self.messagesSent += len(outgoing)
+        self.writes += 1
 
     # ------------------------------------------------------
     # callbacks
@@ -509,7 +1156,8 @@ class RFBClient(asyncio.Protocol):
            rectangles."""
 
     def updateRectangle(self, x, y, width, height, data):
-        """new bitmap data. data is a string in the pixel format set
+        """new bitmap data. data is a bytes-like object (usually a
+           memoryview of the receive buffer) in the pixel format set
            up earlier."""
 
     def copyRectangle(self, srcx, srcy, x, y, width, height):
@@ -521,7 +1169,24 @@ class RFBClient(asyncio.Protocol):
            the pixel format set up earlier"""
         # fallback variant, use update recatngle
         # override with specialized function for better performance
-        self.updateRectangle(x, y, width, height, color*width*height)
+        self.updateRectangle(x, y, width, height, bytes(color)*width*height)
+
+    def fillRectangles(self, color, rectangles):
+        """fill a list of (x, y, width, height) tuples with one color.
+           decoders pass runs of subrects with the same color on here."""
+        # fallback variant, one fillRectangle() per rectangle
+        # override with specialized function for better performance
+        for (x, y, width, height) in rectangles:
+            self.fillRectangle(x, y, width, height, color)
+
+    def desktopResized(self, width, height):
+        """the server screen has a new size, the following updates
+           are for the new size"""
+
+    def updateCursor(self, hotx, hoty, width, height, image, mask):
+        """new cursor shape. image is in the pixel format set up
+           earlier, mask has one bit per pixel (1: opaque), rows are
+           padded to whole bytes. the hot spot is at hotx, hoty"""
 
     def bell(self):
         """bell"""
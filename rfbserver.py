@@ -0,0 +1,1070 @@
+#!/usr/bin/env python
+"""
+Synthetic RFB 3.3 server for tests and benchmarks.
+
+Serves generated MFD like pages (text that changes, a scrolling graph,
+page changes with a full redraw) in the encodings RFBClient decodes, so
+the client runs without Orbiter and without a VNC server. The update
+rate, a fixed latency and the bandwidth of the link can be set to mimic
+a Wi-Fi connection.
+
+The screen is kept with 32 bit pixels R, G, B, 0 and converted to the
+pixel format the client asks for when a rectangle is encoded. The
+encoders are used by the benchmarks as well.
+
+usage: python3 rfbserver.py [--port 5900] [--size 320x240] [--encoding zrle]
+       [--rate 20] [--latency ms] [--bandwidth kB/s] [--resize WxH]
+
+MIT License
+"""
+
+import argparse
+import asyncio
+import collections
+import logging
+import math
+import random
+import zlib
+from struct import pack, unpack
+
+import rfb
+
+# screen colours, pixels R, G, B, 0
+BACKGROUND = b'\x00\x10\x00\x00'
+TEXT = b'\x84\xab\x84\x00'
+TITLE = b'\xe0\xe0\x40\x00'
+GRAPH = b'\x00\xcc\x00\x00'
+GRID = b'\x00\x40\x00\x00'
+
+# updates with more rectangles are sent as their bounding box
+MAX_RECTANGLES = 64
+
+# the bandwidth limit lets a burst of this many bytes through
+BURST = 1448
+
+
+class PixelFormat:
+    """wire pixel format, the PIXEL_FORMAT of the protocol"""
+
+    def __init__(self, bpp=32, depth=24, bigendian=0, truecolor=1,
+                 redmax=255, greenmax=255, bluemax=255,
+                 redshift=0, greenshift=8, blueshift=16):
+        self.bpp, self.depth, self.bigendian, self.truecolor = bpp, depth, bigendian, truecolor
+        self.redmax, self.greenmax, self.bluemax = redmax, greenmax, bluemax
+        self.redshift, self.greenshift, self.blueshift = redshift, greenshift, blueshift
+        self.bypp = bpp // 8
+        # screen pixel -> wire pixel
+        self._pixels = {}
+        self._tpixels = {}
+
+    @classmethod
+    def unpack(cls, block):
+        return cls(*unpack("!BBBBHHHBBBxxx", block))
+
+    def pack(self):
+        return pack("!BBBBHHHBBBxxx", self.bpp, self.depth, self.bigendian, self.truecolor,
+                    self.redmax, self.greenmax, self.bluemax,
+                    self.redshift, self.greenshift, self.blueshift)
+
+    def isScreenFormat(self):
+        """pixels R, G, B, 0 on the wire as well"""
+        return (self.bpp == 32 and self.redmax == self.greenmax == self.bluemax == 255 and
+                (self.redshift, self.greenshift, self.blueshift) ==
+                ((24, 16, 8) if self.bigendian else (0, 8, 16)))
+
+    def pixel(self, color):
+        """screen pixel (R, G, B, 0) -> wire pixel"""
+        pixel = self._pixels.get(color)
+        if pixel is None:
+            value = (((color[0] * self.redmax + 127) // 255) << self.redshift |
+                     ((color[1] * self.greenmax + 127) // 255) << self.greenshift |
+                     ((color[2] * self.bluemax + 127) // 255) << self.blueshift)
+            pixel = self._pixels[color] = value.to_bytes(
+                self.bypp, 'big' if self.bigendian else 'little')
+        return pixel
+
+    def convert(self, data):
+        """screen pixels -> wire pixels"""
+        if self.isScreenFormat():
+            return bytes(data)
+        pixel = self.pixel
+        return b''.join([pixel(data[i:i + 4]) for i in range(0, len(data), 4)])
+
+    def cpixel(self):
+        """ZRLE compressed pixel: (size, offset of the bytes kept), see
+           RFBClient._cpixelFormat"""
+        if self.truecolor and self.bpp == 32 and self.depth <= 24:
+            mask = ((self.redmax << self.redshift) |
+                    (self.greenmax << self.greenshift) |
+                    (self.bluemax << self.blueshift))
+            if mask & 0xff000000 == 0:
+                return 3, 1 if self.bigendian else 0
+            if mask & 0x000000ff == 0:
+                return 3, 0 if self.bigendian else 1
+        return self.bypp, 0
+
+    def tpixel(self, pixel):
+        """tight pixel: 24 bit true color is sent as R, G, B"""
+        if not (self.truecolor and self.bpp == 32 and self.depth == 24 and
+                self.redmax == self.greenmax == self.bluemax == 255):
+            return pixel
+        tpixel = self._tpixels.get(pixel)
+        if tpixel is None:
+            value = int.from_bytes(pixel, 'big' if self.bigendian else 'little')
+            tpixel = self._tpixels[pixel] = bytes(
+                [value >> self.redshift & 255, value >> self.greenshift & 255,
+                 value >> self.blueshift & 255])
+        return tpixel
+
+
+PIXEL_FORMATS = {
+    'bgr888': PixelFormat(),
+    'rgb888': PixelFormat(redshift=16, greenshift=8, blueshift=0),
+    'rgb565': PixelFormat(16, 16, 0, 1, 31, 63, 31, 11, 5, 0),
+    'rgb332': PixelFormat(8, 8, 0, 1, 7, 7, 3, 5, 2, 0),
+}
+
+
+def server_init(width, height, pixformat=None, name=b'MFD'):
+    """everything the server sends before the first update, RFB 3.3
+       without authentication"""
+    return b'RFB 003.003\n' + pack("!I", 1) + server_init_message(width, height, pixformat, name)
+
+
+def server_init_message(width, height, pixformat=None, name=b'MFD'):
+    pixformat = pixformat or PixelFormat()
+    return pack("!HH16sI", width, height, pixformat.pack(), len(name)) + name
+
+
+def rectangle(x, y, width, height, encoding, data):
+    return pack("!HHHHi", x, y, width, height, encoding) + data
+
+
+def framebuffer_update(rectangles, last_rect=False):
+    """FramebufferUpdate message. last_rect: the number of rectangles
+       is left open and a LastRect pseudo rectangle ends the update"""
+    if last_rect:
+        return (pack("!BxH", 0, 0xffff) + b''.join(rectangles) +
+                rectangle(0, 0, 0, 0, rfb.PSEUDO_LAST_RECT, b''))
+    return pack("!BxH", 0, len(rectangles)) + b''.join(rectangles)
+
+
+def encode_frame(encoder, data, width, height):
+    """a whole screen of wire pixels as one update"""
+    return framebuffer_update([rectangle(0, 0, width, height, encoder.encoding,
+                                         encoder.encode(data, width, height))])
+
+
+def _pixels(data, bypp):
+    """wire pixels -> list of pixels"""
+    data = bytes(data)
+    return [data[i:i + bypp] for i in range(0, len(data), bypp)]
+
+
+def _background(pixels):
+    return collections.Counter(pixels).most_common(1)[0][0]
+
+
+def _subrectangles(pixels, width, height, background):
+    """pixels that are not background as (pixel, x, y, width, height).
+       horizontal runs are merged with equal runs of the rows below"""
+    subrectangles = []
+    open_runs = {}
+    for y in range(height):
+        row = pixels[y * width:(y + 1) * width]
+        runs = {}
+        x = 0
+        while x < width:
+            pixel = row[x]
+            if pixel == background:
+                x += 1
+                continue
+            start = x
+            while x < width and row[x] == pixel:
+                x += 1
+            run = open_runs.pop((start, x, pixel), None)
+            if run is None:
+                run = [y, 0]
+            run[1] += 1
+            runs[(start, x, pixel)] = run
+        for (start, end, pixel), (top, rows) in open_runs.items():
+            subrectangles.append((pixel, start, top, end - start, rows))
+        open_runs = runs
+    for (start, end, pixel), (top, rows) in open_runs.items():
+        subrectangles.append((pixel, start, top, end - start, rows))
+    return subrectangles
+
+
+class RawEncoder:
+    encoding = rfb.RAW_ENCODING
+    # larger rectangles are split
+    max_size = None
+
+    def __init__(self, pixformat=None):
+        self.pixformat = pixformat or PixelFormat()
+
+    def encode(self, data, width, height):
+        """wire pixels of a width x height rectangle -> rectangle data"""
+        return bytes(data)
+
+
+class RREEncoder(RawEncoder):
+    """background and one subrectangle per run of equal pixels"""
+    encoding = rfb.RRE_ENCODING
+    _subrectangle = "!HHHH"
+
+    def encode(self, data, width, height):
+        pixels = _pixels(data, self.pixformat.bypp)
+        background = _background(pixels)
+        subrectangles = _subrectangles(pixels, width, height, background)
+        return (pack("!I", len(subrectangles)) + background +
+                b''.join(pixel + pack(self._subrectangle, x, y, w, h)
+                         for (pixel, x, y, w, h) in subrectangles))
+
+
+class CoRREEncoder(RREEncoder):
+    encoding = rfb.CORRE_ENCODING
+    max_size = 255
+    _subrectangle = "!BBBB"
+
+
+class HextileEncoder(RawEncoder):
+    """16x16 tiles: background plus one subrect per horizontal run, raw
+       when smaller"""
+    encoding = rfb.HEXTILE_ENCODING
+
+    def tile(self, pixels, width, tx, ty, tw, th):
+        rows = [pixels[row * width + tx:row * width + tx + tw] for row in range(ty, ty + th)]
+        counts = {}
+        for row in rows:
+            for pixel in row:
+                counts[pixel] = counts.get(pixel, 0) + 1
+        bg = max(counts, key=counts.get)
+        if len(counts) == 1:
+            return bytes([2]) + bg
+        subrects = []
+        for sy, row in enumerate(rows):
+            sx = 0
+            while sx < tw:
+                if row[sx] == bg:
+                    sx += 1
+                    continue
+                run = 1
+                while sx + run < tw and row[sx + run] == row[sx]:
+                    run += 1
+                subrects.append((row[sx], sx, sy, run))
+                sx += run
+        raw = bytes([1]) + b''.join(b''.join(row) for row in rows)
+        if len(subrects) > 255:
+            return raw
+        if len(counts) == 2:
+            fg = subrects[0][0]
+            tile = bytes([2 | 4 | 8]) + bg + fg + bytes([len(subrects)])
+            tile += b''.join(bytes([sx << 4 | sy, (run - 1) << 4]) for (c, sx, sy, run) in subrects)
+        else:
+            tile = bytes([2 | 8 | 16]) + bg + bytes([len(subrects)])
+            tile += b''.join(c + bytes([sx << 4 | sy, (run - 1) << 4]) for (c, sx, sy, run) in subrects)
+        if len(tile) > len(raw):
+            return raw
+        return tile
+
+    def encode(self, data, width, height):
+        pixels = _pixels(data, self.pixformat.bypp)
+        return b''.join(self.tile(pixels, width, tx, ty, min(16, width - tx), min(16, height - ty))
+                        for ty in range(0, height, 16)
+                        for tx in range(0, width, 16))
+
+
+class ZRLEEncoder(RawEncoder):
+    """64x64 tiles: solid, packed palette, palette RLE, plain RLE or raw,
+       whichever is smallest. one zlib stream per connection"""
+    encoding = rfb.ZRLE_ENCODING
+
+    def __init__(self, pixformat=None):
+        RawEncoder.__init__(self, pixformat)
+        self.stream = zlib.compressobj()
+
+    @staticmethod
+    def _runs(pixels):
+        """(pixel, length) of the runs of equal pixels"""
+        runs = []
+        i = 0
+        count = len(pixels)
+        while i < count:
+            run = 1
+            while i + run < count and pixels[i + run] == pixels[i]:
+                run += 1
+            runs.append((pixels[i], run))
+            i += run
+        return runs
+
+    @staticmethod
+    def _runLength(length):
+        out = bytearray()
+        length -= 1
+        while length >= 255:
+            out.append(255)
+            length -= 255
+        out.append(length)
+        return out
+
+    def tile(self, pixels, tw, th):
+        """list of compressed pixels -> tile data"""
+        palette = list(dict.fromkeys(pixels))
+        if len(palette) == 1:
+            return b'\x01' + palette[0]
+        candidates = [b'\x00' + b''.join(pixels)]
+        runs = self._runs(pixels)
+        if len(palette) <= 127:
+            index = {pixel: i for i, pixel in enumerate(palette)}
+            out = bytearray([128 + len(palette)])
+            out += b''.join(palette)
+            for pixel, run in runs:
+                if run == 1:
+                    out.append(index[pixel])
+                else:
+                    out.append(index[pixel] | 128)
+                    out += self._runLength(run)
+            candidates.append(out)
+            if len(palette) <= 16:
+                bits = 1 if len(palette) == 2 else 2 if len(palette) <= 4 else 4
+                out = bytearray([len(palette)])
+                out += b''.join(palette)
+                for row in range(th):
+                    value = used = 0
+                    for pixel in pixels[row * tw:(row + 1) * tw]:
+                        value = value << bits | index[pixel]
+                        used += bits
+                        if used == 8:
+                            out.append(value)
+                            value = used = 0
+                    if used:
+                        out.append(value << (8 - used))
+                candidates.append(out)
+        else:
+            out = bytearray([128])
+            for pixel, run in runs:
+                out += pixel
+                out += self._runLength(run)
+            candidates.append(out)
+        return bytes(min(candidates, key=len))
+
+    def encode(self, data, width, height):
+        bypp = self.pixformat.bypp
+        cpp, offset = self.pixformat.cpixel()
+        data = bytes(data)
+        tiles = []
+        for ty in range(0, height, 64):
+            th = min(64, height - ty)
+            for tx in range(0, width, 64):
+                tw = min(64, width - tx)
+                pixels = []
+                for row in range(ty, ty + th):
+                    start = (row * width + tx) * bypp
+                    pixels.extend(data[i + offset:i + offset + cpp]
+                                  for i in range(start, start + tw * bypp, bypp))
+                tiles.append(self.tile(pixels, tw, th))
+        compressed = self.stream.compress(b''.join(tiles)) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+        return pack("!I", len(compressed)) + compressed
+
+
+class TightEncoder(RawEncoder):
+    """fill, palette (2 to 256 colors) and copy, zlib compressed with
+       stream 0 for pixels and 1 for palette indices"""
+    encoding = rfb.TIGHT_ENCODING
+
+    def __init__(self, pixformat=None):
+        RawEncoder.__init__(self, pixformat)
+        self.streams = [zlib.compressobj() for i in range(2)]
+
+    @staticmethod
+    def _length(length):
+        """compact length, 1 to 3 bytes"""
+        out = bytearray([length & 0x7f])
+        if length > 0x7f:
+            out[0] |= 0x80
+            out.append(length >> 7 & 0x7f)
+            if length > 0x3fff:
+                out[1] |= 0x80
+                out.append(length >> 14 & 0xff)
+        return bytes(out)
+
+    def _data(self, data, stream):
+        if len(data) < rfb.TIGHT_MIN_TO_COMPRESS:
+            return data
+        stream = self.streams[stream]
+        compressed = stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)
+        return self._length(len(compressed)) + compressed
+
+    def encode(self, data, width, height):
+        pixels = _pixels(data, self.pixformat.bypp)
+        tpixel = self.pixformat.tpixel
+        palette = list(dict.fromkeys(pixels))
+        if len(palette) == 1:
+            return b'\x80' + tpixel(palette[0])
+        if len(palette) > 256:
+            return b'\x00' + self._data(b''.join(map(tpixel, pixels)), 0)
+        index = {pixel: i for i, pixel in enumerate(palette)}
+        if len(palette) == 2:
+            indices = bytearray()
+            for row in range(height):
+                value = used = 0
+                for pixel in pixels[row * width:(row + 1) * width]:
+                    value = value << 1 | index[pixel]
+                    used += 1
+                    if used == 8:
+                        indices.append(value)
+                        value = used = 0
+                if used:
+                    indices.append(value << (8 - used))
+        else:
+            indices = bytes(index[pixel] for pixel in pixels)
+        # stream 1, a filter id follows: the palette filter
+        return (bytes([(4 | 1) << 4, 1, len(palette) - 1]) +
+                b''.join(map(tpixel, palette)) + self._data(bytes(indices), 1))
+
+
+ENCODERS = {
+    rfb.RAW_ENCODING: RawEncoder,
+    rfb.RRE_ENCODING: RREEncoder,
+    rfb.CORRE_ENCODING: CoRREEncoder,
+    rfb.HEXTILE_ENCODING: HextileEncoder,
+    rfb.ZRLE_ENCODING: ZRLEEncoder,
+    rfb.TIGHT_ENCODING: TightEncoder,
+}
+
+ENCODING_NAMES = {
+    'raw': rfb.RAW_ENCODING,
+    'rre': rfb.RRE_ENCODING,
+    'corre': rfb.CORRE_ENCODING,
+    'hextile': rfb.HEXTILE_ENCODING,
+    'zrle': rfb.ZRLE_ENCODING,
+    'tight': rfb.TIGHT_ENCODING,
+}
+
+
+def _glyph(char):
+    """5x7 bit rows, made up but always the same for a character"""
+    if char == ' ':
+        return [0] * 7
+    generator = random.Random(ord(char))
+    return [generator.getrandbits(5) for row in range(7)]
+
+
+class MFDScreen:
+    """generated MFD pages, 32 bit pixels R, G, B, 0.
+       step() moves to the next frame and returns what changed:
+       ('resize', width, height), ('copy', srcx, srcy, x, y, width,
+       height) and ('update', x, y, width, height), copies first"""
+
+    LABELS = ('ALT', 'VEL', 'HDG', 'APO', 'PER', 'ECC', 'INC', 'LAN', 'TTA', 'DST')
+    PAGES = ('ORBIT', 'SURFACE', 'HSI', 'DOCKING', 'MAP')
+
+    def __init__(self, width=320, height=240, page_frames=100, scroll=2, sizes=()):
+        """page_frames: frames per page, 0 stays on the first page.
+           sizes: screen sizes to switch between on page changes"""
+        self.page_frames = page_frames
+        self.scroll = scroll
+        self.sizes = list(sizes) or [(width, height)]
+        self.frame = 0
+        self.page = 0
+        self._setSize(*self.sizes[0])
+
+    def _setSize(self, width, height):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(BACKGROUND * (width * height))
+        scale = self.scale = max(1, min(width // 160, height // 120))
+        self.cell = (6 * scale, 9 * scale)
+        self.columns = max(1, width // self.cell[0] - 1)
+        self.lines = max(0, min(len(self.LABELS), (height * 2 // 3) // self.cell[1] - 3))
+        self.graph = (4 * scale, height * 2 // 3, width - 8 * scale, height // 3 - 4 * scale)
+        # text on the screen, line -> string
+        self.text = {}
+        # (char, color) -> pixel rows, at this scale
+        self._glyphs = {}
+
+    def rect(self, x, y, width, height):
+        """screen pixels of a rectangle"""
+        stride = self.width
+        pixels = self.pixels
+        return b''.join([pixels[(row * stride + x) * 4:(row * stride + x + width) * 4]
+                         for row in range(y, y + height)])
+
+    def fill(self, x, y, width, height, color):
+        stride = self.width
+        line = color * width
+        for row in range(y, y + height):
+            self.pixels[(row * stride + x) * 4:(row * stride + x + width) * 4] = line
+
+    def _glyphRows(self, char, color):
+        """rows of pixels of one character cell"""
+        rows = self._glyphs.get((char, color))
+        if rows is None:
+            scale = self.scale
+            rows = []
+            for bits in _glyph(char) + [0, 0]:
+                line = b''.join([(color if bits & (16 >> column) else BACKGROUND) * scale
+                                 for column in range(5)]) + BACKGROUND * scale
+                rows.extend([line] * scale)
+            rows = self._glyphs[(char, color)] = rows
+        return rows
+
+    def _drawText(self, line, y, string, color):
+        """draws the characters that changed, returns their rectangle"""
+        old = self.text.get(line, '')
+        string = string[:self.columns].ljust(len(old))
+        changed = [column for column, char in enumerate(string)
+                   if column >= len(old) or old[column] != char]
+        self.text[line] = string
+        if not changed:
+            return None
+        cw, ch = self.cell
+        stride = self.width
+        for column in changed:
+            x = cw // 2 + column * cw
+            for row, pixels in enumerate(self._glyphRows(string[column], color)):
+                start = ((y + row) * stride + x) * 4
+                self.pixels[start:start + cw * 4] = pixels
+        return ('update', cw // 2 + changed[0] * cw, y, (changed[-1] - changed[0] + 1) * cw, ch)
+
+    def _value(self, line):
+        """the value of a text line, some change every frame, some
+           every few frames"""
+        every = (1, 5, 25)[line % 3]
+        step = self.frame // every
+        return (line + 1) * 1234.5 + step * (line * 7.3 + 1.1) * (1 if line % 2 else -1)
+
+    def _sample(self, n):
+        """graph value, 0 to 1"""
+        return 0.5 + 0.35 * math.sin(n * 0.05 + self.page) + 0.1 * math.sin(n * 0.31)
+
+    def _drawColumn(self, column):
+        gx, gy, gw, gh = self.graph
+        x = gx + column
+        n = self.frame * self.scroll + column
+        top = gy + int((1 - self._sample(n)) * (gh - 1))
+        previous = gy + int((1 - self._sample(n - 1)) * (gh - 1))
+        low, high = min(top, previous), max(top, previous)
+        stride = self.width
+        pixels = self.pixels
+        for row in range(gy, gy + gh):
+            if low <= row <= high:
+                color = GRAPH
+            elif row == gy + gh // 2 or row == gy or row == gy + gh - 1:
+                color = GRID
+            else:
+                color = BACKGROUND
+            start = (row * stride + x) * 4
+            pixels[start:start + 4] = color
+
+    def _drawTexts(self):
+        cw, ch = self.cell
+        updates = [self._drawText('title', ch // 2, '%s %d' % (self.PAGES[self.page % len(self.PAGES)],
+                                                              self.page), TITLE)]
+        for line in range(self.lines):
+            updates.append(self._drawText(line, ch // 2 + (line + 2) * ch, '%s %12.1f' % (
+                self.LABELS[line], self._value(line)), TEXT))
+        return [update for update in updates if update is not None]
+
+    def redraw(self):
+        """draws the whole screen"""
+        self.pixels[:] = BACKGROUND * (self.width * self.height)
+        self.text = {}
+        self._drawTexts()
+        gw = self.graph[2]
+        for column in range(gw):
+            self._drawColumn(column)
+        return [('update', 0, 0, self.width, self.height)]
+
+    def nextPage(self):
+        """changes to the next page, with a full redraw (and a resize
+           with sizes)"""
+        self.page += 1
+        width, height = self.sizes[self.page % len(self.sizes)]
+        if (width, height) != (self.width, self.height):
+            self._setSize(width, height)
+            return [('resize', width, height)] + self.redraw()
+        return self.redraw()
+
+    def step(self):
+        self.frame += 1
+        if self.page_frames and self.frame % self.page_frames == 0:
+            return self.nextPage()
+        gx, gy, gw, gh = self.graph
+        scroll = min(self.scroll, gw)
+        changes = []
+        if scroll and gh > 0:
+            # the graph moves left, new samples come in on the right
+            stride = self.width
+            pixels = self.pixels
+            for row in range(gy, gy + gh):
+                start = (row * stride + gx) * 4
+                pixels[start:start + (gw - scroll) * 4] = pixels[start + scroll * 4:start + gw * 4]
+            for column in range(gw - scroll, gw):
+                self._drawColumn(column)
+            if gw > scroll:
+                changes.append(('copy', gx + scroll, gy, gx, gy, gw - scroll, gh))
+            changes.append(('update', gx + gw - scroll, gy, scroll, gh))
+        return changes + self._drawTexts()
+
+
+# the server cursor, an arrow
+CURSOR = (
+    "X.......",
+    "XX......",
+    "XOX.....",
+    "XOOX....",
+    "XOOOX...",
+    "XOOOOX..",
+    "XOOOOOX.",
+    "XOOOXXXX",
+    "XOXOX...",
+    "XX.XOX..",
+    "X..XOX..",
+    "....XX..",
+)
+
+
+class RFBServer:
+    """the screen and the frame clock, shared by all connections"""
+
+    def __init__(self, loop, width=320, height=240, pixformat=None, encoding=None,
+                 rate=20.0, latency=0.0, bandwidth=0, page_frames=100, sizes=(), name=b'MFD'):
+        """pixformat: PixelFormat of ServerInit, the client may change it.
+           encoding: used when the client supports it, otherwise the
+           client's first choice.
+           rate: frames per second, 0 makes a frame whenever a client
+           asks for one.
+           latency: seconds every message is held back.
+           bandwidth: bytes per second, 0 is unlimited.
+           sizes: screen sizes to switch between on page changes"""
+        self.loop = loop
+        self.pixformat = pixformat or PixelFormat()
+        self.encoding = encoding
+        self.rate = rate
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.name = name
+        self.screen = MFDScreen(width, height, page_frames, sizes=[(width, height)] + list(sizes))
+        self.screen.redraw()
+        self.connections = set()
+        self._tick_handle = None
+        self._step_handle = None
+
+    def protocol(self):
+        return RFBServerProtocol(self)
+
+    def connected(self, connection):
+        self.connections.add(connection)
+        if self.rate and self._tick_handle is None:
+            self._tick_handle = self.loop.call_later(1.0 / self.rate, self._tick)
+
+    def disconnected(self, connection):
+        self.connections.discard(connection)
+        if not self.connections and self._tick_handle is not None:
+            self._tick_handle.cancel()
+            self._tick_handle = None
+
+    def _tick(self):
+        self._tick_handle = self.loop.call_later(1.0 / self.rate, self._tick)
+        self.changed(self.screen.step())
+
+    def frameWanted(self):
+        """a client waits for a frame, made right away without a rate"""
+        if not self.rate and self._step_handle is None:
+            self._step_handle = self.loop.call_soon(self._step)
+
+    def _step(self):
+        self._step_handle = None
+        self.changed(self.screen.step())
+
+    def nextPage(self):
+        self.changed(self.screen.nextPage())
+
+    def changed(self, changes):
+        for connection in list(self.connections):
+            connection.screenChanged(changes)
+
+
+class RFBServerProtocol(asyncio.Protocol):
+    """one client connection"""
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = server.loop
+        self.transport = None
+        self.pixformat = server.pixformat
+        self.width = server.screen.width
+        self.height = server.screen.height
+        self._buffer = bytearray()
+        self._handler = None
+        self._size = 0
+        # client settings
+        self.encodings = [rfb.RAW_ENCODING]
+        self.encoder = None
+        self._encoders = {}
+        # the client asked for an update, changes it does not have yet
+        self.requested = False
+        self.changes = []
+        self.cursorPending = False
+        self._buttonmask = 0
+        # messages held back for the latency and bandwidth limit
+        self._delayed = collections.deque()
+        self._pump_handle = None
+        self._credit = BURST
+        self._credit_time = None
+        # statistics
+        self.updates = 0
+        self.rectangles = 0
+        self.bytesSent = 0
+        self.keyEvents = 0
+        self.pointerEvents = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._chooseEncoder()
+        self.send(b'RFB 003.003\n')
+        self.expect(self._handleVersion, 12)
+
+    def connection_lost(self, exc):
+        if self._pump_handle is not None:
+            self._pump_handle.cancel()
+        self.server.disconnected(self)
+        logging.info("client gone: %d updates, %d rectangles, %d bytes" %
+                     (self.updates, self.rectangles, self.bytesSent))
+
+    def expect(self, handler, size):
+        self._handler = handler
+        self._size = size
+
+    def data_received(self, data):
+        self._buffer += data
+        while self._handler is not None and len(self._buffer) >= self._size:
+            block = bytes(self._buffer[:self._size])
+            del self._buffer[:self._size]
+            self._handler(block)
+
+    # ------------------------------------------------------
+    # handshake
+    # ------------------------------------------------------
+
+    def _handleVersion(self, block):
+        if block[:4] != b'RFB ':
+            logging.warning("not an RFB client: %r" % block)
+            self._handler = None
+            self.transport.close()
+            return
+        # no authentication
+        self.send(pack("!I", 1))
+        self.expect(self._handleClientInit, 1)
+
+    def _handleClientInit(self, block):
+        self.send(server_init_message(self.width, self.height, self.pixformat, self.server.name))
+        self.server.connected(self)
+        self.expect(self._handleMessage, 1)
+
+    # ------------------------------------------------------
+    # client messages
+    # ------------------------------------------------------
+
+    def _handleMessage(self, block):
+        msgid = block[0]
+        if msgid == 0:
+            self.expect(self._handleSetPixelFormat, 19)
+        elif msgid == 2:
+            self.expect(self._handleSetEncodings, 3)
+        elif msgid == 3:
+            self.expect(self._handleUpdateRequest, 9)
+        elif msgid == 4:
+            self.expect(self._handleKeyEvent, 7)
+        elif msgid == 5:
+            self.expect(self._handlePointerEvent, 5)
+        elif msgid == 6:
+            self.expect(self._handleCutText, 7)
+        else:
+            logging.warning("unknown client message (id %d)" % msgid)
+            self._handler = None
+            self.transport.close()
+
+    def _handleSetPixelFormat(self, block):
+        self.pixformat = PixelFormat.unpack(block[3:])
+        for encoder in self._encoders.values():
+            encoder.pixformat = self.pixformat
+        self.expect(self._handleMessage, 1)
+
+    def _handleSetEncodings(self, block):
+        (count,) = unpack("!xH", block)
+        self.expect(self._handleEncodings, 4 * count)
+
+    def _handleEncodings(self, block):
+        self.encodings = list(unpack("!%di" % (len(block) // 4), block))
+        self._chooseEncoder()
+        self.cursorPending = rfb.PSEUDO_CURSOR in self.encodings
+        self.expect(self._handleMessage, 1)
+
+    def _chooseEncoder(self):
+        choices = [encoding for encoding in self.encodings if encoding in ENCODERS]
+        if self.server.encoding in choices:
+            encoding = self.server.encoding
+        elif choices:
+            encoding = choices[0]
+        else:
+            encoding = rfb.RAW_ENCODING
+        # zlib streams live as long as the connection
+        if encoding not in self._encoders:
+            self._encoders[encoding] = ENCODERS[encoding](self.pixformat)
+        self.encoder = self._encoders[encoding]
+
+    def _handleUpdateRequest(self, block):
+        (incremental, x, y, width, height) = unpack("!BHHHH", block)
+        self.requested = True
+        if not incremental:
+            self.changes = [change for change in self.changes if change[0] == 'resize']
+            self.changes.append(('update', 0, 0, self.server.screen.width, self.server.screen.height))
+        self.expect(self._handleMessage, 1)
+        if self.changes or self.cursorPending:
+            self.sendUpdate()
+        else:
+            self.server.frameWanted()
+
+    def _handleKeyEvent(self, block):
+        self.keyEvents += 1
+        self.expect(self._handleMessage, 1)
+
+    def _handlePointerEvent(self, block):
+        (buttonmask, x, y) = unpack("!BHH", block)
+        self.pointerEvents += 1
+        # a click changes the page, like a soft button
+        if buttonmask & 1 and not self._buttonmask & 1:
+            self.server.nextPage()
+        self._buttonmask = buttonmask
+        self.expect(self._handleMessage, 1)
+
+    def _handleCutText(self, block):
+        (length,) = unpack("!xxxI", block)
+        self.expect(self._handleCutTextData, length)
+
+    def _handleCutTextData(self, block):
+        self.expect(self._handleMessage, 1)
+
+    # ------------------------------------------------------
+    # updates
+    # ------------------------------------------------------
+
+    def screenChanged(self, changes):
+        if self.changes:
+            # copies of frames the client missed would move newer pixels,
+            # send their targets instead
+            self.changes = [('update',) + change[3:] if change[0] == 'copy' else change
+                            for change in self.changes + changes]
+        else:
+            self.changes = list(changes)
+        if self.requested:
+            self.sendUpdate()
+
+    def _pending(self):
+        """the changes to send, resizes first, merged to one rectangle
+           when there are too many"""
+        resizes = [change for change in self.changes if change[0] == 'resize']
+        if resizes:
+            screen = self.server.screen
+            return [resizes[-1], ('update', 0, 0, screen.width, screen.height)]
+        changes = list(dict.fromkeys(self.changes))
+        if len(changes) > MAX_RECTANGLES:
+            x0 = min(change[-4] for change in changes)
+            y0 = min(change[-3] for change in changes)
+            x1 = max(change[-4] + change[-2] for change in changes)
+            y1 = max(change[-3] + change[-1] for change in changes)
+            changes = [('update', x0, y0, x1 - x0, y1 - y0)]
+        return changes
+
+    def sendUpdate(self):
+        rectangles = []
+        if self.cursorPending:
+            self.cursorPending = False
+            rectangles.append(self._cursorRectangle())
+        for change in self._pending():
+            if change[0] == 'resize':
+                if rfb.PSEUDO_DESKTOP_SIZE in self.encodings:
+                    self.width, self.height = change[1:]
+                    rectangles.append(rectangle(0, 0, self.width, self.height,
+                                                rfb.PSEUDO_DESKTOP_SIZE, b''))
+                continue
+            x, y, width, height = change[-4:]
+            if (change[0] == 'copy' and rfb.COPY_RECTANGLE_ENCODING in self.encodings and
+                    x + width <= self.width and y + height <= self.height and
+                    change[1] + width <= self.width and change[2] + height <= self.height):
+                rectangles.append(rectangle(x, y, width, height, rfb.COPY_RECTANGLE_ENCODING,
+                                            pack("!HH", change[1], change[2])))
+                continue
+            rectangles.extend(self._encode(x, y, width, height))
+        self.changes = []
+        if not rectangles:
+            return
+        self.requested = False
+        self.updates += 1
+        self.rectangles += len(rectangles)
+        self.send(framebuffer_update(rectangles, rfb.PSEUDO_LAST_RECT in self.encodings))
+
+    def _encode(self, x, y, width, height):
+        """pixel rectangles, clipped to the size the client knows"""
+        width = min(width, self.width - x)
+        height = min(height, self.height - y)
+        if width <= 0 or height <= 0:
+            return []
+        encoder = self.encoder
+        screen = self.server.screen
+        size = encoder.max_size or max(width, height)
+        rectangles = []
+        for ty in range(y, y + height, size):
+            th = min(size, y + height - ty)
+            for tx in range(x, x + width, size):
+                tw = min(size, x + width - tx)
+                data = self.pixformat.convert(screen.rect(tx, ty, tw, th))
+                rectangles.append(rectangle(tx, ty, tw, th, encoder.encoding,
+                                            encoder.encode(data, tw, th)))
+        return rectangles
+
+    def _cursorRectangle(self):
+        height = len(CURSOR)
+        width = len(CURSOR[0])
+        black = self.pixformat.pixel(b'\x00\x00\x00\x00')
+        white = self.pixformat.pixel(b'\xff\xff\xff\x00')
+        pixels = b''.join(white if char == 'O' else black for line in CURSOR for char in line)
+        mask = bytearray()
+        for line in CURSOR:
+            bits = int(''.join('0' if char == '.' else '1' for char in line), 2)
+            mask += bits.to_bytes((width + 7) // 8, 'big')
+        return rectangle(0, 0, width, height, rfb.PSEUDO_CURSOR, pixels + bytes(mask))
+
+    # ------------------------------------------------------
+    # latency and bandwidth
+    # ------------------------------------------------------
+
+    def send(self, data):
+        self.bytesSent += len(data)
+        if not self.server.latency and not self.server.bandwidth and not self._delayed:
+            self.transport.write(data)
+            return
+        self._delayed.append((self.loop.time() + self.server.latency, data))
+        if self._pump_handle is None:
+            self._pump()
+
+    def _pump(self):
+        """writes what is due and what the bandwidth allows, then waits
+           for the next message or more credit"""
+        self._pump_handle = None
+        if self.transport.is_closing():
+            self._delayed.clear()
+            return
+        bandwidth = self.server.bandwidth
+        while self._delayed:
+            now = self.loop.time()
+            due, data = self._delayed[0]
+            if due > now:
+                self._pump_handle = self.loop.call_at(due, self._pump)
+                return
+            if not bandwidth:
+                self.transport.write(data)
+                self._delayed.popleft()
+                continue
+            if self._credit_time is None:
+                self._credit_time = now
+            self._credit = min(self._credit + (now - self._credit_time) * bandwidth,
+                               max(BURST, bandwidth / 100))
+            self._credit_time = now
+            size = min(len(data), int(self._credit))
+            if size <= 0:
+                self._pump_handle = self.loop.call_at(
+                    now + min(len(data), BURST) / bandwidth, self._pump)
+                return
+            self.transport.write(data[:size])
+            self._credit -= size
+            if size < len(data):
+                self._delayed[0] = (due, data[size:])
+            else:
+                self._delayed.popleft()
+
+
+class _BufferTransport:
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+def session(encodings, frames, width=320, height=240, page_frames=100, pixformat=None):
+    """what a client asking for encodings receives in frames framebuffer
+       updates, made without a connection or a loop. the client keeps
+       the ServerInit pixel format (pixformat, a PixelFormat) and asks
+       for every update after the screen changed"""
+    server = RFBServer(None, width, height, pixformat, rate=0, page_frames=page_frames)
+    transport = _BufferTransport()
+    connection = server.protocol()
+    connection.connection_made(transport)
+    connection.data_received(b'RFB 003.003\n' + b'\x01' +
+                             pack("!BxH%di" % len(encodings), 2, len(encodings), *encodings) +
+                             pack("!BBHHHH", 3, 0, 0, 0, width, height))
+    for n in range(frames - 1):
+        server.changed(server.screen.step())
+        connection.data_received(pack("!BBHHHH", 3, 1, 0, 0, width, height))
+    return b''.join(transport.data)
+
+
+async def serve(host='127.0.0.1', port=5900, **options):
+    """starts a server, returns (asyncio server, RFBServer). options
+       are the RFBServer arguments"""
+    loop = asyncio.get_running_loop()
+    server = RFBServer(loop, **options)
+    listener = await loop.create_server(server.protocol, host, port)
+    return listener, server
+
+
+def _size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Synthetic MFD VNC server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5900)
+    parser.add_argument('--size', type=_size, default=(320, 240), help="WIDTHxHEIGHT")
+    parser.add_argument('--format', choices=sorted(PIXEL_FORMATS), default='bgr888',
+                        help="pixel format of ServerInit")
+    parser.add_argument('--encoding', choices=sorted(ENCODING_NAMES),
+                        help="used when the client supports it")
+    parser.add_argument('--rate', type=float, default=20.0,
+                        help="frames per second, 0 as fast as the client asks")
+    parser.add_argument('--latency', type=float, default=0.0, help="milliseconds")
+    parser.add_argument('--bandwidth', type=float, default=0.0, help="kB/s, 0 unlimited")
+    parser.add_argument('--page-frames', type=int, default=100,
+                        help="frames per page, 0 stays on one page")
+    parser.add_argument('--resize', type=_size, action='append', default=[],
+                        help="WIDTHxHEIGHT to switch to on page changes")
+    args = parser.parse_args()
+    listener, server = await serve(
+        args.host, args.port, width=args.size[0], height=args.size[1],
+        pixformat=PIXEL_FORMATS[args.format],
+        encoding=ENCODING_NAMES.get(args.encoding), rate=args.rate,
+        latency=args.latency / 1000, bandwidth=args.bandwidth * 1000,
+        page_frames=args.page_frames, sizes=args.resize)
+    print("serving %dx%d on %s:%d" % (args.size[0], args.size[1], args.host, args.port))
+    async with listener:
+        await listener.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,212 @@
+"""
+Client side copy of the remote screen.
+
+The pixels are a NumPy (height, width, bytes per pixel) uint8 array in
+the wire pixel format. Writes are slice operations on the array and
+mark a coarse grid of dirty tiles, which is turned into a small set of
+rectangles once per frame for uploading.
+
+SharedFramebuffer keeps the pixels in shared memory, so a decoder
+process writes them and the display process uploads them. The dirty
+rectangles of each frame are passed through a small ring next to the
+pixels.
+
+MIT License
+"""
+
+import struct
+import sys
+from multiprocessing import shared_memory
+
+import numpy
+
+# size of the dirty tracking tiles in pixels
+DIRTY_TILE = 16
+
+
+class ShadowFramebuffer:
+    def __init__(self, width, height, bypp, buffer=None):
+        """buffer: optional memory to keep the pixels in (e.g. shared
+           memory), must hold width * height * bypp bytes"""
+        self.width = width
+        self.height = height
+        self.bypp = bypp
+        if buffer is None:
+            self.pixels = numpy.zeros((height, width, bypp), numpy.uint8)
+        else:
+            self.pixels = numpy.ndarray((height, width, bypp), numpy.uint8, buffer)
+        self.dirty = numpy.zeros(((height + DIRTY_TILE - 1) // DIRTY_TILE,
+                                  (width + DIRTY_TILE - 1) // DIRTY_TILE), bool)
+
+    def damage(self, x, y, width, height):
+        self.dirty[y // DIRTY_TILE:(y + height + DIRTY_TILE - 1) // DIRTY_TILE,
+                   x // DIRTY_TILE:(x + width + DIRTY_TILE - 1) // DIRTY_TILE] = True
+
+    def update(self, x, y, width, height, data):
+        """raw pixels, data is a bytes-like object"""
+        self.pixels[y:y + height, x:x + width] = \
+            numpy.frombuffer(data, numpy.uint8, width * height * self.bypp).reshape(
+                height, width, self.bypp)
+        self.damage(x, y, width, height)
+
+    def fill(self, color, rectangles):
+        """fill a list of (x, y, width, height) with a packed color"""
+        pixel = numpy.frombuffer(color, numpy.uint8, self.bypp)
+        pixels = self.pixels
+        damage = self.damage
+        for (x, y, width, height) in rectangles:
+            pixels[y:y + height, x:x + width] = pixel
+            damage(x, y, width, height)
+
+    def copy(self, srcx, srcy, x, y, width, height):
+        """copyrect, overlapping source and target are fine"""
+        self.pixels[y:y + height, x:x + width] = \
+            self.pixels[srcy:srcy + height, srcx:srcx + width]
+        self.damage(x, y, width, height)
+
+    def takeDirty(self):
+        """the dirty region as few (x, y, width, height) rectangles, the
+           dirty state is cleared. runs of dirty tiles in a tile row are
+           merged with equal runs of the rows below."""
+        rectangles = _gridRectangles(self.dirty, self.width, self.height)
+        self.dirty[:] = False
+        return rectangles
+
+    def close(self):
+        """release the pixels"""
+        self.pixels = None
+
+    def snapshot(self):
+        """copy of the current screen, for screenshots and diff()"""
+        return self.pixels.copy()
+
+    def diff(self, snapshot):
+        """rectangles (on the dirty tile grid) that changed since
+           snapshot was taken"""
+        changed = (self.pixels != snapshot).any(axis=2)
+        rows, columns = self.dirty.shape
+        padded = numpy.zeros((rows * DIRTY_TILE, columns * DIRTY_TILE), bool)
+        padded[:self.height, :self.width] = changed
+        grid = padded.reshape(rows, DIRTY_TILE, columns, DIRTY_TILE).any(axis=(1, 3))
+        return _gridRectangles(grid, self.width, self.height)
+
+
+# dirty rectangles kept in the shared ring. when the reader falls
+# further behind, it uploads the whole screen
+RING_SIZE = 256
+# rectangles written, frames written
+_RING_HEADER = struct.Struct("=QQ")
+_RING_ENTRY = struct.Struct("=HHHH")
+_RING_BYTES = _RING_HEADER.size + RING_SIZE * _RING_ENTRY.size
+
+
+class SharedFramebuffer(ShadowFramebuffer):
+    """ShadowFramebuffer in shared memory, one process writes it and
+       calls publish() after each frame, one other process attaches by
+       name and uploads what takeDirty() returns.
+       the reader may see pixels of a frame that is not published yet,
+       they are uploaded again with that frame."""
+
+    def __init__(self, width, height, bypp, name=None):
+        """name: attach to the memory created by the writer"""
+        self.owner = name is None
+        size = _RING_BYTES + width * height * bypp
+        if self.owner or sys.version_info < (3, 13):
+            # before 3.13 attaching registers the memory with the
+            # resource tracker as well. the decoder processes share the
+            # tracker of the display process, it is the entry the writer
+            # removes with unlink()
+            self.memory = shared_memory.SharedMemory(name, create=self.owner, size=size)
+        else:
+            # the writer removes the memory, not the reader
+            self.memory = shared_memory.SharedMemory(name, size=size, track=False)
+        self.name = self.memory.name
+        self.ring = self.memory.buf[:_RING_BYTES]
+        ShadowFramebuffer.__init__(self, width, height, bypp,
+                                   self.memory.buf[_RING_BYTES:_RING_BYTES + width * height * bypp])
+        if self.owner:
+            _RING_HEADER.pack_into(self.ring, 0, 0, 0)
+        else:
+            # the reader starts with a full upload
+            self.damage(0, 0, width, height)
+        # rectangles taken by the reader
+        self.read = _RING_HEADER.unpack_from(self.ring, 0)[0]
+
+    def publish(self):
+        """writer: a frame is complete, pass its dirty rectangles to
+           the reader. returns the number of rectangles"""
+        rectangles = ShadowFramebuffer.takeDirty(self)
+        ring = self.ring
+        written, frames = _RING_HEADER.unpack_from(ring, 0)
+        for rectangle in rectangles:
+            _RING_ENTRY.pack_into(ring, _RING_HEADER.size + written % RING_SIZE * _RING_ENTRY.size,
+                                  *rectangle)
+            written += 1
+        # the counters go last, the reader never sees half written entries
+        _RING_HEADER.pack_into(ring, 0, written, frames + 1)
+        return len(rectangles)
+
+    def frames(self):
+        """frames published so far"""
+        return _RING_HEADER.unpack_from(self.ring, 0)[1]
+
+    def takeDirty(self):
+        """reader: rectangles published since the last call, plus the
+           ones damaged locally"""
+        ring = self.ring
+        written = _RING_HEADER.unpack_from(ring, 0)[0]
+        rectangles = ShadowFramebuffer.takeDirty(self)
+        if written - self.read <= RING_SIZE:
+            rectangles.extend(_RING_ENTRY.unpack_from(ring, _RING_HEADER.size + n % RING_SIZE * _RING_ENTRY.size)
+                              for n in range(self.read, written))
+        # entries overwritten while they were read count as lost as well
+        if _RING_HEADER.unpack_from(ring, 0)[0] - self.read > RING_SIZE:
+            rectangles = [(0, 0, self.width, self.height)]
+        self.read = written
+        return rectangles
+
+    def close(self):
+        """unmap, the writer also removes the memory"""
+        # the numpy array and the ring keep the mapping alive
+        self.pixels = None
+        self.ring.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def _gridRectangles(grid, width, height):
+    """bool tile grid -> list of pixel rectangles clipped to the screen"""
+    rectangles = []
+    # (start column, end column) -> [row, rows] of the run being extended
+    open_runs = {}
+    for row, line in enumerate(grid.tolist()):
+        runs = {}
+        column = 0
+        columns = len(line)
+        while column < columns:
+            if not line[column]:
+                column += 1
+                continue
+            start = column
+            while column < columns and line[column]:
+                column += 1
+            run = open_runs.pop((start, column), None)
+            if run is None:
+                run = [row, 0]
+            run[1] += 1
+            runs[(start, column)] = run
+        for key, run in open_runs.items():
+            rectangles.append(_runRectangle(key, run, width, height))
+        open_runs = runs
+    for key, run in open_runs.items():
+        rectangles.append(_runRectangle(key, run, width, height))
+    return rectangles
+
+
+def _runRectangle(columns, run, width, height):
+    x = columns[0] * DIRTY_TILE
+    y = run[0] * DIRTY_TILE
+    return (x, y,
+            min(columns[1] * DIRTY_TILE, width) - x,
+            min((run[0] + run[1]) * DIRTY_TILE, height) - y)
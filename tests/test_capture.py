@@ -0,0 +1,71 @@
+import capture
+import rfb
+import rfbserver
+
+from test_decoders import PaintClient, Transport
+
+FRAMES = 6
+CHUNK = 1000
+# bgr888, what the server sends
+PIXEL_FORMAT = dict(bpp=32, depth=24, bigendian=0, truecolor=1, redmax=255, greenmax=255,
+                    bluemax=255, redshift=0, greenshift=8, blueshift=16)
+
+
+class RecordingClient(PaintClient):
+    def vncConnectionMade(self):
+        PaintClient.vncConnectionMade(self)
+        self.setPixelFormat(**PIXEL_FORMAT)
+
+
+def record(path, stream, close=True):
+    client = RecordingClient()
+    client.capture = capture.Capture(str(path))
+    client.connection_made(Transport())
+    view = memoryview(stream)
+    for pos in range(0, len(view), CHUNK):
+        client.data_received(view[pos:pos + CHUNK])
+    if close:
+        client.capture.close()
+    return client
+
+
+def session():
+    return rfbserver.session([rfb.ZRLE_ENCODING, rfb.COPY_RECTANGLE_ENCODING], FRAMES,
+                             page_frames=3)
+
+
+def test_round_trip(tmp_path):
+    stream = session()
+    recorded = record(tmp_path / 'session.rfb', stream)
+    replay = capture.Replay(str(tmp_path / 'session.rfb'))
+    try:
+        assert replay.size == len(stream)
+        assert [bytes(data) for data in replay.data()] == [
+            stream[pos:pos + CHUNK] for pos in range(0, len(stream), CHUNK)]
+        assert replay.pixformat == PIXEL_FORMAT
+        assert len(replay.updates) == FRAMES
+        for n in range(FRAMES):
+            offset = replay.updateOffset(n)
+            # a FramebufferUpdate message
+            assert stream[offset] == 0
+        client = PaintClient()
+        client.connection_made(Transport())
+        replay.feed(client)
+        assert client.updates == FRAMES
+        assert client.pixels == recorded.pixels
+    finally:
+        replay.close()
+
+
+def test_replay_without_index(tmp_path):
+    stream = session()
+    recorded = record(tmp_path / 'open.rfb', stream, close=False)
+    recorded.capture.file.flush()
+    replay = capture.Replay(str(tmp_path / 'open.rfb'))
+    try:
+        assert replay.size == len(stream)
+        assert replay.updates == []
+        assert b''.join(bytes(data) for data in replay.data()) == stream
+    finally:
+        replay.close()
+        recorded.capture.close()
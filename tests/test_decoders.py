@@ -0,0 +1,84 @@
+import pytest
+
+import rfb
+import rfbserver
+
+ENCODINGS = ('raw', 'rre', 'corre', 'hextile', 'zrle', 'tight')
+FRAMES = 12
+# a full redraw in the middle of the session
+PAGE_FRAMES = 6
+
+
+class Transport:
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class PaintClient(rfb.RFBClient):
+    """paints the updates into a bytearray in the wire pixel format"""
+
+    def __init__(self):
+        rfb.RFBClient.__init__(self, None)
+        self.pixels = None
+        self.updates = 0
+
+    def vncConnectionMade(self):
+        self.pixels = bytearray(self.width * self.height * self.bypp)
+
+    def commitUpdate(self, rectangles=None):
+        self.updates += 1
+
+    def updateRectangle(self, x, y, width, height, data):
+        bypp = self.bypp
+        line = width * bypp
+        for row in range(height):
+            start = ((y + row) * self.width + x) * bypp
+            self.pixels[start:start + line] = data[row * line:(row + 1) * line]
+
+    def fillRectangle(self, x, y, width, height, color):
+        self.updateRectangle(x, y, width, height, bytes(color) * (width * height))
+
+    def copyRectangle(self, srcx, srcy, x, y, width, height):
+        bypp = self.bypp
+        line = width * bypp
+        rows = [self.pixels[((srcy + row) * self.width + srcx) * bypp:][:line]
+                for row in range(height)]
+        self.updateRectangle(x, y, width, height, b''.join(rows))
+
+
+def decode(stream, chunk=1448):
+    client = PaintClient()
+    client.connection_made(Transport())
+    view = memoryview(stream)
+    for pos in range(0, len(view), chunk):
+        client.data_received(view[pos:pos + chunk])
+    return client
+
+
+def expected_screen(frames, width=320, height=240):
+    screen = rfbserver.MFDScreen(width, height, PAGE_FRAMES)
+    screen.redraw()
+    for n in range(frames - 1):
+        screen.step()
+    return bytes(screen.pixels)
+
+
+@pytest.mark.parametrize('pixformat', sorted(rfbserver.PIXEL_FORMATS))
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_decoder_matches_server_screen(encoding, pixformat):
+    wire = rfbserver.PIXEL_FORMATS[pixformat]
+    encodings = [rfbserver.ENCODING_NAMES[encoding], rfb.COPY_RECTANGLE_ENCODING,
+                 rfb.PSEUDO_LAST_RECT]
+    stream = rfbserver.session(encodings, FRAMES, page_frames=PAGE_FRAMES, pixformat=wire)
+    client = decode(stream)
+    assert client.updates == FRAMES
+    assert client.pixels == wire.convert(expected_screen(FRAMES))
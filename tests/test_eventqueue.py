@@ -0,0 +1,103 @@
+from sdl2 import rect
+
+from orbitermfdclient import (EventQueue, EV_UPDATE_RECT, EV_FILL_RECT,
+                              EV_COPY_RECT)
+
+
+def update(x, y, width, height):
+    data = bytes(width * height * 4)
+    return (EV_UPDATE_RECT, (rect.SDL_Rect(x, y, width, height), data, width * 4))
+
+
+def fill(color, *rectangles):
+    return (EV_FILL_RECT, (color, list(rectangles)))
+
+
+def ports(frame):
+    return [(ev[1][0].x, ev[1][0].y, ev[1][0].w, ev[1][0].h)
+            for ev in frame if ev[0] == EV_UPDATE_RECT]
+
+
+def test_open_frame_does_not_cover_committed_update():
+    queue = EventQueue()
+    queue.add(update(0, 0, 64, 64))
+    assert queue.commit()
+    queue.add(update(0, 0, 128, 128))
+    (frame,) = queue.take()
+    assert ports(frame) == [(0, 0, 64, 64)]
+
+
+def test_open_frame_does_not_merge_into_committed_fill():
+    queue = EventQueue()
+    queue.add(fill(b'\x01', (0, 0, 10, 10)))
+    assert queue.commit()
+    queue.add(fill(b'\x01', (0, 10, 10, 10)))
+    (frame,) = queue.take()
+    assert frame == [fill(b'\x01', (0, 0, 10, 10))]
+    queue.commit()
+    (frame,) = queue.take()
+    assert frame == [fill(b'\x01', (0, 10, 10, 10))]
+
+
+def test_cover_within_open_frame():
+    queue = EventQueue()
+    queue.add(update(0, 0, 64, 64))
+    queue.add(update(0, 0, 128, 128))
+    queue.commit()
+    (frame,) = queue.take()
+    assert ports(frame) == [(0, 0, 128, 128)]
+    assert queue.dropped == 1
+
+
+def test_take_covers_older_committed_frames():
+    queue = EventQueue(across_frames=True)
+    queue.add(update(0, 0, 64, 64))
+    queue.commit()
+    queue.add(update(0, 0, 128, 128))
+    queue.commit()
+    frames = queue.take()
+    assert [ports(frame) for frame in frames] == [[], [(0, 0, 128, 128)]]
+    assert queue.bytes == 0
+
+
+def test_take_keeps_frames_before_copy():
+    queue = EventQueue(across_frames=True)
+    queue.add(update(0, 0, 64, 64))
+    queue.commit()
+    queue.add((EV_COPY_RECT, (0, 0, 64, 64, 64, 0)))
+    queue.add(update(0, 0, 128, 128))
+    queue.commit()
+    frames = queue.take()
+    assert ports(frames[0]) == [(0, 0, 64, 64)]
+
+
+def test_take_one_frame_at_a_time():
+    queue = EventQueue(across_frames=False)
+    queue.add(update(0, 0, 64, 64))
+    queue.commit()
+    queue.add(update(0, 0, 128, 128))
+    queue.commit()
+    assert [ports(frame) for frame in queue.take(1)] == [[(0, 0, 64, 64)]]
+    assert [ports(frame) for frame in queue.take(1)] == [[(0, 0, 128, 128)]]
+
+
+def view_update(buffer, x, y, width, height):
+    data = memoryview(buffer)[:width * height * 4]
+    return (EV_UPDATE_RECT, (rect.SDL_Rect(x, y, width, height), data, width * 4))
+
+
+def test_waiting_frames_do_not_pin_receive_buffers():
+    buffer = bytearray(64 << 10)
+    queue = EventQueue()
+    queue.add(view_update(buffer, 0, 0, 8, 8))
+    queue.commit()
+    # the renderer keeps up, no copy
+    (frame,) = queue.take()
+    assert isinstance(frame[0][1][1], memoryview)
+    queue.add(view_update(buffer, 0, 0, 8, 8))
+    queue.commit()
+    queue.add(view_update(buffer, 8, 0, 8, 8))
+    queue.commit()
+    frames = queue.take()
+    assert [type(ev[1][1]) for frame in frames for ev in frame] == [bytes, bytes]
+    assert queue.bytes == 0
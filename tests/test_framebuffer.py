@@ -0,0 +1,46 @@
+import pytest
+import sdl2
+import sdl2.ext
+
+import orbitermfdclient
+from orbitermfdclient import Framebuffer, EV_RESIZE, EV_CURSOR
+
+
+@pytest.fixture(scope='module')
+def renderer():
+    sdl2.ext.init()
+    window = sdl2.ext.Window('test', size=(64, 64))
+    renderer = sdl2.ext.Renderer(window, flags=sdl2.render.SDL_RENDERER_SOFTWARE)
+    yield renderer
+    renderer.destroy()
+    window.close()
+    sdl2.ext.quit()
+
+
+@pytest.fixture
+def cursors(monkeypatch):
+    """cursors made and freed, the dummy video driver has none"""
+    made = []
+    freed = []
+
+    def create(shape, hotx, hoty):
+        made.append(object())
+        return made[-1]
+
+    monkeypatch.setattr(orbitermfdclient.mouse, 'SDL_CreateColorCursor', create)
+    monkeypatch.setattr(orbitermfdclient.mouse, 'SDL_FreeCursor', freed.append)
+    return made, freed
+
+
+def test_cursor_kept_over_resize(renderer, cursors):
+    made, freed = cursors
+    framebuffer = Framebuffer(renderer)
+    framebuffer.apply([(EV_RESIZE, (32, 32)),
+                       (EV_CURSOR, (0, 0, 2, 1, bytes(8), b'\x80'))])
+    assert framebuffer.cursor is made[0]
+    framebuffer.apply([(EV_RESIZE, (48, 40))])
+    assert framebuffer.cursor is made[0]
+    assert freed == []
+    framebuffer.destroy()
+    assert freed == made
+    assert framebuffer.cursor is None
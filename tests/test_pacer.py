@@ -0,0 +1,48 @@
+from orbitermfdclient import UpdatePacer
+
+
+class Loop:
+    def __init__(self):
+        self.delays = []
+
+    def call_later(self, delay, callback):
+        self.delays.append(delay)
+        return self
+
+
+class Client:
+    def __init__(self):
+        self.loop = Loop()
+        self.requests = 0
+
+    def framebufferUpdateRequest(self, incremental=0):
+        self.requests += 1
+
+
+def test_as_fast_as_possible():
+    client = Client()
+    pacer = UpdatePacer(client, 0)
+    pacer.start()
+    pacer.updateReceived(0)
+    assert client.requests == 2
+    assert client.loop.delays == []
+
+
+def test_backoff_without_frequency():
+    client = Client()
+    pacer = UpdatePacer(client, 0)
+    pacer.start()
+    # frames wait for the renderer
+    pacer.updateReceived(3)
+    assert client.requests == 1
+    (delay,) = client.loop.delays
+    assert 0 < delay <= pacer.backoff_interval * pacer.backoff
+
+
+def test_backoff_stretches_frequency():
+    client = Client()
+    pacer = UpdatePacer(client, 10)
+    pacer.start()
+    pacer.updateReceived(3)
+    (delay,) = client.loop.delays
+    assert 0.1 < delay <= 0.1 * pacer.backoff
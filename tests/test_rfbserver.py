@@ -0,0 +1,11 @@
+import rfbserver
+
+
+def test_resize_to_another_scale():
+    screen = rfbserver.MFDScreen(320, 240, page_frames=2, sizes=[(320, 240), (640, 480)])
+    encoder = rfbserver.HextileEncoder()
+    for n in range(6):
+        screen.step()
+        assert len(screen.pixels) == screen.width * screen.height * 4
+        encoder.encode(screen.rect(0, 0, screen.width, screen.height),
+                       screen.width, screen.height)
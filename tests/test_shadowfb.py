@@ -0,0 +1,70 @@
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+import rfb
+import rfbserver
+import shadowfb
+
+from test_decoders import PaintClient, Transport, decode
+
+
+class ShadowClient(PaintClient):
+    """the updates go to a ShadowFramebuffer, a snapshot after each"""
+
+    def vncConnectionMade(self):
+        self.shadow = shadowfb.ShadowFramebuffer(self.width, self.height, self.bypp)
+        self.snapshot = self.shadow.snapshot()
+        self.missed = 0
+
+    def commitUpdate(self, rectangles=None):
+        # every changed tile must be in the dirty region
+        dirty = numpy.zeros((self.height, self.width), bool)
+        for (x, y, width, height) in self.shadow.takeDirty():
+            dirty[y:y + height, x:x + width] = True
+        changed = (self.shadow.pixels != self.snapshot).any(axis=2)
+        self.missed += int((changed & ~dirty).sum())
+        self.snapshot = self.shadow.snapshot()
+        self.updates += 1
+
+    def updateRectangle(self, x, y, width, height, data):
+        self.shadow.update(x, y, width, height, data)
+
+    def fillRectangles(self, color, rectangles):
+        self.shadow.fill(color, rectangles)
+
+    def fillRectangle(self, x, y, width, height, color):
+        self.shadow.fill(color, [(x, y, width, height)])
+
+    def copyRectangle(self, srcx, srcy, x, y, width, height):
+        self.shadow.copy(srcx, srcy, x, y, width, height)
+
+
+@pytest.mark.parametrize('encoding', (rfb.HEXTILE_ENCODING, rfb.ZRLE_ENCODING))
+def test_shadow_matches_painted_screen(encoding):
+    stream = rfbserver.session([encoding, rfb.COPY_RECTANGLE_ENCODING], 8, page_frames=4)
+    client = ShadowClient()
+    client.connection_made(Transport())
+    client.data_received(stream)
+    assert client.updates == 8
+    assert client.missed == 0
+    assert client.shadow.pixels.tobytes() == bytes(decode(stream).pixels)
+
+
+def test_shared_framebuffer_reader_sees_published_frames():
+    writer = shadowfb.SharedFramebuffer(64, 48, 4)
+    try:
+        reader = shadowfb.SharedFramebuffer(64, 48, 4, writer.name)
+        try:
+            # the reader starts with the whole screen
+            assert reader.takeDirty() == [(0, 0, 64, 48)]
+            writer.fill(b'\x01\x02\x03\x00', [(16, 16, 16, 16)])
+            assert writer.publish() == 1
+            assert reader.frames() == 1
+            assert reader.takeDirty() == [(16, 16, 16, 16)]
+            assert reader.pixels[20, 20].tobytes() == b'\x01\x02\x03\x00'
+            assert reader.takeDirty() == []
+        finally:
+            reader.close()
+    finally:
+        writer.close()
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+import rfb
+import rfbserver
+from orbitermfdclient import Option, VNCClient, load_options, EV_RESIZE, EV_UPDATE_RECT
+
+FRAMES = 4
+
+
+class Transport:
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def client_for(loop, skip_frames):
+    option = Option()
+    option.skip_frames = skip_frames
+    client = VNCClient(loop, None, option)
+    client.connection_made(Transport())
+    return client
+
+
+def stream():
+    return rfbserver.session([rfb.RAW_ENCODING], FRAMES, page_frames=0)
+
+
+@pytest.mark.parametrize('skip_frames', (False, True))
+def test_frames_appear_when_committed(loop, skip_frames):
+    client = client_for(loop, skip_frames)
+    data = stream()
+    # the last update is not complete
+    client.data_received(data[:-1])
+    # the resize of the connection and the complete updates
+    assert len(client.pending) == FRAMES
+    client.data_received(data[-1:])
+    assert len(client.pending) == FRAMES + 1
+    frames = client.nextFrames()
+    assert len(frames) == FRAMES + 1
+    assert [ev[0] for ev in frames[0]] == [EV_RESIZE]
+    assert not client.hasFrames()
+
+
+def test_one_frame_at_a_time(loop):
+    client = client_for(loop, False)
+    data = stream()
+    client.data_received(data)
+    assert [ev[0] for ev in client.nextFrames(1)[0]] == [EV_RESIZE]
+    # then the full screen update
+    (frame,) = client.nextFrames(1)
+    assert [ev[0] for ev in frame] == [EV_UPDATE_RECT]
+    port = frame[0][1][0]
+    assert (port.w, port.h) == (320, 240)
+    while client.hasFrames():
+        (frame,) = client.nextFrames(1)
+        assert frame
+    assert not client.commits
+
+
+def test_mfds_share_the_wake_event(loop, tmp_path):
+    ini = tmp_path / 'VNCMFD.ini'
+    ini.write_text("[MFD1]\nVNCPort=5901\nXSize=320\nYSize=240\n"
+                   "[MFD2]\nVNCPort=5902\nXSize=320\nYSize=240\n")
+    options = load_options(str(ini))
+    assert [(option.section, option.port) for option in options] == [
+        ('MFD1', 5901), ('MFD2', 5902)]
+    wake = asyncio.Event()
+    clients = [VNCClient(loop, None, option, wake) for option in options]
+    for client in clients:
+        client.connection_made(Transport())
+    clients[0].data_received(stream())
+    assert wake.is_set()
+    assert clients[0].hasFrames()
+    assert not clients[1].hasFrames()